@@ -0,0 +1,141 @@
+"""
+Native ASGI handler of the snapshot event stream. Django's ASGI handler iterates streaming responses
+on the event loop, so a blocking event stream would stall the server; this handler waits for events
+asynchronously instead and serves any number of idle clients from a single process. All other
+requests are passed on to Django.
+"""
+import asyncio
+import json
+
+from importlib import import_module
+from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.contrib.auth.models import User
+from django.db import connection
+from django.http import HttpRequest
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from . import events
+from .signing import InvalidSignature, verify_stream_token
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin1')
+    return None
+
+
+def _query(scope):
+    return dict(parse_qsl(scope['query_string'].decode('latin1')))
+
+
+def _authenticate(scope):
+    """
+    Returns the id of the user authenticated by the stream token of the '?token=' parameter, the
+    'Authorization: Token' header or the session cookie of the request, or None. The API token is
+    only accepted in the header, see backend.api.authentication.StreamTokenAuthentication.
+    """
+    try:
+        stream_token = _query(scope).get('token')
+        if stream_token:
+            try:
+                user_id = verify_stream_token(stream_token)
+            except InvalidSignature:
+                return None
+            return user_id if User.objects.filter(id=user_id, is_active=True).exists() else None
+
+        authorization = (_header(scope, b'authorization') or '').split()
+        if len(authorization) == 2 and authorization[0].lower() == 'token':
+            token = Token.objects.select_related('user').filter(key=authorization[1]).first()
+            return token.user.id if token is not None and token.user.is_active else None
+
+        cookies = {}
+        for cookie in (_header(scope, b'cookie') or '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            cookies[name] = value
+        if settings.SESSION_COOKIE_NAME not in cookies:
+            return None
+
+        request = HttpRequest()
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore(cookies[settings.SESSION_COOKIE_NAME])
+        user = get_user(request)
+        return user.id if user.is_authenticated and user.is_active else None
+    finally:
+        # not called by django's request handling, so it will not clean up the connection for us
+        connection.close()
+
+
+def _cors_headers(scope):
+    origin = _header(scope, b'origin')
+    if origin is None or not getattr(settings, 'CORS_ORIGIN_ALLOW_ALL', False):
+        return []
+    headers = [(b'access-control-allow-origin', origin.encode('latin1')), (b'vary', b'Origin')]
+    if getattr(settings, 'CORS_ALLOW_CREDENTIALS', False):
+        headers.append((b'access-control-allow-credentials', b'true'))
+    return headers
+
+
+async def event_stream(scope, receive, send):
+    """
+    Serves the events of the authenticated user as server-sent events, see the snapshots' 'events'
+    action.
+    """
+    user_id = await sync_to_async(_authenticate)(scope)
+    if user_id is None:
+        await send({
+            'type': 'http.response.start',
+            'status': 401,
+            'headers': [(b'content-type', b'application/json'), *_cors_headers(scope)],
+        })
+        await send({'type': 'http.response.body', 'body': json.dumps({'detail': 'Authentication credentials were not provided.'}).encode()})
+        return
+
+    last_event_id = events.parse_last_event_id(_header(scope, b'last-event-id') or _query(scope).get('last_event_id'))
+    subscription = await sync_to_async(events.event_layer.subscribe)(user_id, last_event_id, asyncio.get_running_loop())
+
+    async def stream():
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                *_cors_headers(scope),
+            ],
+        })
+        while True:
+            event = await subscription.aget(settings.CAMERAFY_EVENT_HEARTBEAT)
+            await send({'type': 'http.response.body', 'body': event.encode() if event is not None else events.HEARTBEAT, 'more_body': True})
+
+    task = asyncio.ensure_future(stream())
+    try:
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    finally:
+        task.cancel()
+        subscription.close()
+
+
+class EventStreamMiddleware:
+    """
+    ASGI middleware serving the event stream natively and passing all other requests to app.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._path = None
+
+    async def __call__(self, scope, receive, send):
+        if self._path is None:
+            self._path = reverse('camerafysnapshot-events')
+
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == self._path:
+            await event_stream(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
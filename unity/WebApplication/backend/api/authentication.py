@@ -0,0 +1,29 @@
+from django.contrib.auth.models import User
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from .signing import InvalidSignature, verify_stream_token
+
+
+class StreamTokenAuthentication(BaseAuthentication):
+    """
+    Authentication by a short-lived event stream token given as '?token=' query parameter, for
+    clients which cannot set request headers, e.g. browser EventSource connections. The API token
+    itself is never accepted in the query string, where it would end up in server and proxy logs.
+    See backend.api.signing.stream_token().
+    """
+
+    def authenticate(self, request):
+        token = request.query_params.get('token')
+        if not token:
+            return None
+
+        try:
+            user_id = verify_stream_token(token)
+        except InvalidSignature as e:
+            raise AuthenticationFailed(str(e))
+
+        user = User.objects.filter(id=user_id, is_active=True).first()
+        if user is None:
+            raise AuthenticationFailed('User inactive or deleted.')
+        return user, token
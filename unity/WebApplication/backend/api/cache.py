@@ -0,0 +1,112 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class LocalMediaFile:
+    """
+    A file below MEDIA_ROOT which is not managed by a storage, e.g. a cache entry.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+
+class DiskLRUCache:
+    """
+    Size bounded on-disk cache. Entries are files named by the hash of their key, a cache hit
+    refreshes the entry's access time, which is used to evict the least recently used entries once
+    the total size exceeds max_bytes. Eviction scans the whole directory, so it frees space down to
+    low_water_ratio of max_bytes at once instead of scanning again on the next put. Modification
+    times are left untouched, so they can still be used for HTTP caching of the entries.
+    """
+
+    def __init__(self, directory, max_bytes, media_root=None, low_water_ratio=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water_ratio = low_water_ratio
+        self.media_root = media_root
+        self._lock = threading.Lock()
+        self._bytes = None
+
+    def _path(self, key, extension):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}{extension}")
+
+    def _file(self, path):
+        name = os.path.relpath(path, self.media_root).replace('\\', '/') if self.media_root else path
+        return LocalMediaFile(name, path)
+
+    def _scan(self):
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+        return entries
+
+    def get(self, key, extension=''):
+        """
+        Returns the cached file for key, or None if there is no such entry.
+        """
+        path = self._path(key, extension)
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            return None
+        return self._file(path)
+
+    def put(self, key, write, extension=''):
+        """
+        Adds an entry for key, whose content is written by calling write(f) with a file object
+        opened for binary writing. Returns the cached file.
+        """
+        path = self._path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._evict(keep=path)
+
+        return self._file(path)
+
+    def _evict(self, keep):
+        entries = sorted(self._scan())
+        self._bytes = sum(size for _, size, _ in entries)
+        low_water = self.max_bytes * self.low_water_ratio
+        for atime, size, path in entries:
+            if self._bytes <= low_water:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # e.g. still opened for sending on Windows, evicted by a later put
+                continue
+            self._bytes -= size
@@ -0,0 +1,304 @@
+"""
+Per-user event stream announcing snapshot changes, so clients only fetch what changed instead of
+polling the snapshot listing. Events are fanned out to the subscribed clients by an event layer:
+the in-memory layer delivers within a single process, the database layer stores events in
+CamerafyEvent and every process polls them, for deployments with several worker processes. The
+stream is served as server-sent events, natively by the ASGI application (see backend.asgi) and by
+the snapshots' 'events' action under WSGI.
+"""
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models.events import CamerafyEvent
+
+logger = logging.getLogger(__name__)
+
+# number of events queued for a slow client before it has to resynchronize
+SUBSCRIBER_QUEUE_SIZE = 256
+# number of recent events the in-memory layer keeps to replay them to reconnecting clients
+REPLAY_BUFFER_SIZE = 1024
+# maximum number of events the database layer dispatches per poll
+POLL_BATCH_SIZE = 1000
+# number of ids the database layer looks back, rows of transactions committed out of id order
+# become visible late
+POLL_LOOKBACK = 100
+
+# event telling a client it missed events and has to reload its data
+RESYNC = 'resync'
+
+# comment line sent to idle clients, so proxies do not close the connection
+HEARTBEAT = b': keep-alive\n\n'
+
+
+class Event:
+    """
+    An event of given type announced to a user. Events without id are not replayable.
+    """
+
+    def __init__(self, id, user_id, type, data):
+        self.id = id
+        self.user_id = user_id
+        self.type = type
+        self.data = data
+
+    def encode(self):
+        """
+        Returns the event in server-sent events format.
+        """
+        id = f"id: {self.id}\n" if self.id is not None else ''
+        return f"{id}event: {self.type}\ndata: {json.dumps(self.data)}\n\n".encode()
+
+
+class Subscription:
+    """
+    The queue of events of a user delivered to a single client. Events are put from any thread
+    and taken either blocking or, if subscribed with an event loop, by a coroutine running in it.
+    """
+
+    def __init__(self, layer, user_id, loop=None):
+        self.layer = layer
+        self.user_id = user_id
+        self._loop = loop
+        self._queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE) if loop is not None else queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        # ids of replayed events, which must not be delivered again when dispatched
+        self._replayed = set()
+
+    def put(self, event, replayed=False):
+        if replayed:
+            self._replayed.add(event.id)
+        elif event.id in self._replayed:
+            self._replayed.discard(event.id)
+            return
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._put, event)
+        else:
+            self._put(event)
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except (queue.Full, asyncio.QueueFull):
+            # the client cannot keep up, drop its backlog and let it reload everything instead
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(Event(None, self.user_id, RESYNC, {}))
+
+    def get(self, timeout):
+        """
+        Blocks until the next event is available, returns None after timeout seconds.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def aget(self, timeout):
+        """
+        Waits for the next event, returns None after timeout seconds.
+        """
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.layer.unsubscribe(self)
+
+
+class InMemoryEventLayer:
+    """
+    Fans out events to the subscribers of the current process. Event ids are '<epoch>-<n>', where
+    the epoch is random per layer instance, so ids issued before a restart are never mistaken for
+    recent ones once the counter catches up.
+    """
+
+    # whether replayed events may still be dispatched afterwards
+    replays_pending = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(set)
+        # (n, event) of the recent events
+        self._recent = collections.deque(maxlen=REPLAY_BUFFER_SIZE)
+        self._ids = itertools.count(1)
+        self.epoch = secrets.token_hex(4)
+
+    def publish(self, user_id, type, data):
+        """
+        Announces an event to all clients of user_id once the current transaction has been
+        committed, nothing is announced if it is rolled back.
+        """
+        transaction.on_commit(lambda: self._publish(user_id, type, data))
+
+    def _publish(self, user_id, type, data):
+        with self._lock:
+            n = next(self._ids)
+            event = Event(f"{self.epoch}-{n}", user_id, type, data)
+            self._recent.append((n, event))
+            self._dispatch(event)
+
+    def _dispatch(self, event):
+        # called with the lock held, so a subscription never misses an event between its replay
+        # and its registration; putting events never blocks
+        for subscription in self._subscribers.get(event.user_id, ()):
+            subscription.put(event)
+
+    def _replay(self, user_id, last_event_id):
+        epoch, _, n = last_event_id.rpartition('-')
+        if epoch != self.epoch or not n.isdigit():
+            # issued before a restart or by another process
+            return None
+        n = int(n)
+        if not self._recent or n > self._recent[-1][0] or n < self._recent[0][0] - 1:
+            # unknown or too old
+            return None
+        return [e for i, e in self._recent if i > n and e.user_id == user_id]
+
+    def subscribe(self, user_id, last_event_id=None, loop=None):
+        """
+        Returns a new subscription to the events of user_id, see Subscription for loop. Events
+        after last_event_id are replayed, a 'resync' event is delivered if they are not known.
+        """
+        subscription = Subscription(self, user_id, loop)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+            if last_event_id is not None:
+                missed = self._replay(user_id, last_event_id)
+                for event in missed if missed is not None else [Event(None, user_id, RESYNC, {})]:
+                    subscription.put(event, replayed=self.replays_pending and event.id is not None)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+
+class DatabaseEventLayer(InMemoryEventLayer):
+    """
+    Stores events as CamerafyEvent rows in the transaction causing them, a background thread of
+    every process polls new rows and dispatches them to its subscribers. Events are kept for the
+    given retention time in seconds and replayed to reconnecting clients meanwhile.
+    """
+
+    replays_pending = True
+
+    def __init__(self, poll_interval, retention):
+        super().__init__()
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._thread = None
+        self._last_id = None
+        # ids dispatched recently, which are polled again while within the look back
+        self._dispatched = set()
+        self._dispatched_order = collections.deque()
+
+    def publish(self, user_id, type, data):
+        CamerafyEvent.objects.create(user_id=user_id, type=type, data=json.dumps(data))
+
+    def _replay(self, user_id, last_event_id):
+        if not last_event_id.isdigit():
+            return None
+        last_event_id = int(last_event_id)
+        if not CamerafyEvent.objects.filter(id__lte=last_event_id).exists():
+            # pruned already
+            return None
+        return [
+            Event(e.id, e.user_id, e.type, json.loads(e.data))
+            for e in CamerafyEvent.objects.filter(user_id=user_id, id__gt=last_event_id).order_by('id')
+        ]
+
+    def subscribe(self, user_id, last_event_id=None, loop=None):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._last_id = CamerafyEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+                # the rows within the look back have been committed before, only rows becoming
+                # visible late are dispatched
+                for id in CamerafyEvent.objects.filter(id__gt=self._last_id - POLL_LOOKBACK).order_by('id').values_list('id', flat=True):
+                    if id not in self._dispatched:
+                        self._dispatched.add(id)
+                        self._dispatched_order.append(id)
+                self._thread = threading.Thread(target=self._run, name='event-poller', daemon=True)
+                self._thread.start()
+        return super().subscribe(user_id, last_event_id, loop)
+
+    def _poll(self):
+        # dispatches the rows committed since the last poll
+        rows = list(CamerafyEvent.objects.filter(id__gt=self._last_id - POLL_LOOKBACK).order_by('id')[:POLL_LOOKBACK + POLL_BATCH_SIZE])
+        with self._lock:
+            for row in rows:
+                if row.id not in self._dispatched:
+                    self._dispatched.add(row.id)
+                    self._dispatched_order.append(row.id)
+                    self._dispatch(Event(row.id, row.user_id, row.type, json.loads(row.data)))
+                self._last_id = max(self._last_id, row.id)
+
+            while self._dispatched_order and self._dispatched_order[0] <= self._last_id - POLL_LOOKBACK:
+                self._dispatched.discard(self._dispatched_order.popleft())
+
+    def _run(self):
+        pruned = 0
+        while True:
+            try:
+                self._poll()
+                if time.monotonic() - pruned > self.retention / 10:
+                    CamerafyEvent.objects.filter(created__lt=timezone.now() - datetime.timedelta(seconds=self.retention)).delete()
+                    pruned = time.monotonic()
+            except Exception:
+                logger.exception('Failed to poll events.')
+            finally:
+                # this is not a request thread, so django will not clean up the connection for us
+                connection.close()
+
+            time.sleep(self.poll_interval)
+
+
+def parse_last_event_id(value):
+    """
+    Returns the id of a 'Last-Event-ID' header, or None if missing. Ids are interpreted by the event
+    layer, which asks the client to resynchronize if it does not know them.
+    """
+    value = value.strip() if value is not None else ''
+    return value or None
+
+
+def stream_events(subscription):
+    """
+    Yields the events of a blocking subscription in server-sent events format, with heartbeats
+    while idle. The subscription is closed when the client disconnects.
+    """
+    try:
+        while True:
+            event = subscription.get(settings.CAMERAFY_EVENT_HEARTBEAT)
+            yield event.encode() if event is not None else HEARTBEAT
+    finally:
+        subscription.close()
+
+
+def publish(user_id, type, data):
+    """
+    Announces an event of given type to the clients of user_id, see InMemoryEventLayer.publish().
+    """
+    event_layer.publish(user_id, type, data)
+
+
+if settings.CAMERAFY_EVENT_LAYER == 'database':
+    event_layer = DatabaseEventLayer(settings.CAMERAFY_EVENT_POLL_INTERVAL, settings.CAMERAFY_EVENT_RETENTION)
+else:
+    event_layer = InMemoryEventLayer()
@@ -0,0 +1,316 @@
+"""
+Decoding of the snapshot formats Pillow does not support, i.e. OpenEXR and raw texture data. Images
+are decoded in blocks of rows, so memory stays bounded even for very large frames, which the strip
+pipeline (see pipeline) reduces and tone-maps into 8-bit images. Like imaging, this module runs in
+worker processes and must therefore not depend on any Django machinery.
+
+Scanline EXR files without compression or with RLE, ZIPS or ZIP compression are decoded directly,
+any other EXR file requires the optional 'OpenEXR' package.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import OpenEXR
+    import Imath
+except ImportError:
+    OpenEXR = None
+
+# formats decoded by this module
+HDR_FORMATS = ('EXR', 'RAW')
+
+# number of image rows decoded at once
+BLOCK_ROWS = 256
+
+EXR_MAGIC = 20000630
+
+# EXR version flags of files which are not single part scanline images
+EXR_TILED_FLAG = 0x200
+EXR_DEEP_FLAG = 0x800
+EXR_MULTIPART_FLAG = 0x1000
+
+# EXR compression methods and the number of scanlines they compress together
+EXR_NO_COMPRESSION = 0
+EXR_RLE_COMPRESSION = 1
+EXR_ZIPS_COMPRESSION = 2
+EXR_ZIP_COMPRESSION = 3
+EXR_LINES_PER_CHUNK = {
+    EXR_NO_COMPRESSION: 1,
+    EXR_RLE_COMPRESSION: 1,
+    EXR_ZIPS_COMPRESSION: 1,
+    EXR_ZIP_COMPRESSION: 16,
+}
+
+# EXR pixel types (UINT, HALF, FLOAT) as little endian numpy types
+EXR_PIXEL_TYPES = {
+    0: np.dtype('<u4'),
+    1: np.dtype('<f2'),
+    2: np.dtype('<f4'),
+}
+
+# default tone mapping, see tone_map()
+DEFAULT_TONE_MAP = {
+    'operator': 'aces',
+    'exposure': 0.0,
+    'gamma': 2.2,
+}
+
+
+class ExrHeader:
+    """
+    The attributes of an EXR file relevant for decoding it.
+    """
+
+    def __init__(self, version, channels, compression, data_window, line_order, offset):
+        self.version = version
+        # list of (name, numpy dtype, x sampling, y sampling) in file order
+        self.channels = channels
+        self.compression = compression
+        # (x min, y min, x max, y max), inclusive
+        self.data_window = data_window
+        self.line_order = line_order
+        # file position of the chunk offset table
+        self.offset = offset
+
+    @property
+    def width(self):
+        return self.data_window[2] - self.data_window[0] + 1
+
+    @property
+    def height(self):
+        return self.data_window[3] - self.data_window[1] + 1
+
+
+def _read_string(f):
+    chars = bytearray()
+    while True:
+        c = f.read(1)
+        if not c:
+            raise ValueError('Truncated EXR header.')
+        if c == b'\0':
+            return chars.decode('ascii', 'replace')
+        chars += c
+
+
+def read_exr_header(f):
+    """
+    Reads the header of the EXR file f is positioned at. Raises ValueError if f is not an EXR file.
+    """
+    magic, version = struct.unpack('<ii', f.read(8))
+    if magic != EXR_MAGIC:
+        raise ValueError('Not an EXR file.')
+
+    channels, compression, data_window, line_order = None, EXR_NO_COMPRESSION, None, 0
+    while True:
+        name = _read_string(f)
+        if not name:
+            break
+        type = _read_string(f)
+        size, = struct.unpack('<i', f.read(4))
+        value = f.read(size)
+
+        if name == 'channels' and type == 'chlist':
+            channels = []
+            position = 0
+            while value[position:position + 1] not in (b'\0', b''):
+                end = value.index(b'\0', position)
+                pixel_type, _, x_sampling, y_sampling = struct.unpack('<iiii', value[end + 1:end + 17])
+                channels.append((value[position:end].decode('ascii', 'replace'), EXR_PIXEL_TYPES[pixel_type], x_sampling, y_sampling))
+                position = end + 17
+        elif name == 'compression':
+            compression = value[0]
+        elif name == 'dataWindow':
+            data_window = struct.unpack('<iiii', value)
+        elif name == 'lineOrder':
+            line_order = value[0]
+
+    if channels is None or data_window is None:
+        raise ValueError('EXR header misses channels or data window.')
+
+    return ExrHeader(version, channels, compression, data_window, line_order, f.tell())
+
+
+def _undo_predictor(data):
+    # reverses the byte delta encoding and interleaving of the RLE and ZIP compressions
+    t = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    t[1:] -= 128
+    t = (np.cumsum(t) & 0xff).astype(np.uint8)
+
+    out = np.empty_like(t)
+    half = (len(t) + 1) // 2
+    out[0::2] = t[:half]
+    out[1::2] = t[half:]
+    return out.tobytes()
+
+
+def _rle_decompress(data, size):
+    out = bytearray()
+    position = 0
+    while position < len(data) and len(out) < size:
+        count = struct.unpack_from('<b', data, position)[0]
+        position += 1
+        if count < 0:
+            out += data[position:position - count]
+            position -= count
+        else:
+            out += data[position:position + 1] * (count + 1)
+            position += 1
+    return bytes(out)
+
+
+def _exr_rgba_channels(header):
+    names = [name for name, _, _, _ in header.channels]
+    if all(c in names for c in 'RGB'):
+        selected = ['R', 'G', 'B']
+    elif 'Y' in names:
+        selected = ['Y', 'Y', 'Y']
+    else:
+        raise ValueError(f"EXR file has no RGB or Y channels, found {', '.join(names)}.")
+    if 'A' in names:
+        selected.append('A')
+    if any(x != 1 or y != 1 for _, _, x, y in header.channels):
+        raise ValueError('Subsampled EXR channels are not supported.')
+    return selected
+
+
+def _exr_blocks_builtin(f, header, rows):
+    if header.version & (EXR_TILED_FLAG | EXR_DEEP_FLAG | EXR_MULTIPART_FLAG):
+        raise ValueError('Only single part scanline EXR files can be decoded without the OpenEXR package.')
+    if header.compression not in EXR_LINES_PER_CHUNK:
+        raise ValueError(f"EXR compression {header.compression} requires the OpenEXR package.")
+
+    selected = _exr_rgba_channels(header)
+    width, height, y_min = header.width, header.height, header.data_window[1]
+    lines_per_chunk = EXR_LINES_PER_CHUNK[header.compression]
+    chunks = (height + lines_per_chunk - 1) // lines_per_chunk
+
+    # every scanline holds the values of all channels one after another
+    line_type = np.dtype([(name, dtype, (width,)) for name, dtype, _, _ in header.channels])
+
+    f.seek(header.offset)
+    offsets = np.frombuffer(f.read(8 * chunks), dtype='<u8')
+
+    block = np.empty((min(rows, height), width, len(selected)), dtype=np.float32)
+    filled = 0
+    first = 0
+    # chunks may be stored in any order, read them by their position in the image
+    for chunk in range(chunks):
+        f.seek(int(offsets[chunk]))
+        y, size = struct.unpack('<ii', f.read(8))
+        data = f.read(size)
+
+        lines = min(lines_per_chunk, y_min + height - y)
+        expected = lines * line_type.itemsize
+        if size < expected:
+            if header.compression == EXR_RLE_COMPRESSION:
+                data = _undo_predictor(_rle_decompress(data, expected))
+            elif header.compression in (EXR_ZIPS_COMPRESSION, EXR_ZIP_COMPRESSION):
+                data = _undo_predictor(zlib.decompress(data))
+
+        scanlines = np.frombuffer(data, dtype=line_type, count=lines)
+        position = 0
+        while position < lines:
+            count = min(lines - position, len(block) - filled)
+            for index, name in enumerate(selected):
+                block[filled:filled + count, :, index] = scanlines[name][position:position + count]
+            filled += count
+            position += count
+            if filled == len(block):
+                yield block
+                first += filled
+                filled = 0
+                block = np.empty((min(rows, height - first), width, len(selected)), dtype=np.float32)
+
+    if filled:
+        yield block[:filled]
+
+
+def _exr_blocks_openexr(path, rows):
+    exr = OpenEXR.InputFile(path)
+    try:
+        header = exr.header()
+        window = header['dataWindow']
+        width = window.max.x - window.min.x + 1
+        names = list(header['channels'].keys())
+        selected = ['R', 'G', 'B'] if all(c in names for c in 'RGB') else ['Y', 'Y', 'Y']
+        if 'A' in names:
+            selected.append('A')
+
+        pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
+        for y in range(window.min.y, window.max.y + 1, rows):
+            last = min(y + rows - 1, window.max.y)
+            data = exr.channels(selected, pixel_type, y, last)
+            block = np.empty((last - y + 1, width, len(selected)), dtype=np.float32)
+            for index, channel in enumerate(data):
+                block[:, :, index] = np.frombuffer(channel, dtype=np.float32).reshape(last - y + 1, width)
+            yield block
+    finally:
+        exr.close()
+
+
+def exr_blocks(path, rows=BLOCK_ROWS):
+    """
+    Yields the pixels of the EXR file at path from top to bottom in blocks of up to rows rows, as
+    float32 arrays of shape (rows, width, 3) or (rows, width, 4) with linear RGB(A) values.
+    """
+    if OpenEXR is not None:
+        yield from _exr_blocks_openexr(path, rows)
+        return
+
+    with open(path, 'rb') as f:
+        yield from _exr_blocks_builtin(f, read_exr_header(f), rows)
+
+
+def raw_blocks(path, size, rows=BLOCK_ROWS):
+    """
+    Yields the pixels of raw ARGB32 texture data at path, as uploaded by Unity, from top to bottom in
+    blocks of up to rows rows, as uint8 arrays of shape (rows, width, 4) with RGBA values. Raw data
+    has no header, so the image size has to be given.
+    """
+    width, height = size
+    with open(path, 'rb') as f:
+        length = f.seek(0, 2)
+        if length != width * height * 4:
+            raise ValueError(f"Raw image data of {length} bytes does not match a {width}x{height} ARGB32 image.")
+
+        # texture data starts with the bottom row; blocks are read rather than memory-mapped, so
+        # the pages of the file do not add up in the resident memory of the process
+        for bottom in range(height, 0, -rows):
+            top = max(bottom - rows, 0)
+            f.seek(top * width * 4)
+            block = np.frombuffer(f.read((bottom - top) * width * 4), dtype=np.uint8).reshape(bottom - top, width, 4)
+            yield block[::-1, :, [1, 2, 3, 0]]
+
+
+def tone_map(block, operator='aces', exposure=0.0, gamma=2.2):
+    """
+    Maps a float32 block of linear RGB(A) values to 8-bit display values. The colors are scaled by
+    2^exposure, compressed by the 'reinhard' or 'aces' (filmic) operator, or just clipped with
+    'clamp', and gamma encoded. Alpha is only clipped. The block is modified in place.
+    """
+    rgb = block[..., :3]
+    np.nan_to_num(rgb, copy=False, nan=0.0, posinf=65504.0, neginf=0.0)
+    np.maximum(rgb, 0.0, out=rgb)
+    if exposure:
+        np.multiply(rgb, np.float32(2.0 ** exposure), out=rgb)
+
+    if operator == 'reinhard':
+        np.divide(rgb, rgb + np.float32(1.0), out=rgb)
+    elif operator == 'aces':
+        # Narkowicz's fit of the ACES filmic curve, x(2.51x + 0.03) / (x(2.43x + 0.59) + 0.14)
+        numerator = rgb * (np.float32(2.51) * rgb + np.float32(0.03))
+        denominator = rgb * (np.float32(2.43) * rgb + np.float32(0.59)) + np.float32(0.14)
+        np.divide(numerator, denominator, out=rgb)
+    elif operator != 'clamp':
+        raise ValueError(f"Unknown tone mapping operator '{operator}'.")
+
+    np.clip(block, 0.0, 1.0, out=block)
+    if gamma != 1.0:
+        np.power(rgb, np.float32(1.0 / gamma), out=rgb)
+
+    np.multiply(block, np.float32(255.0), out=block)
+    np.rint(block, out=block)
+    return block.astype(np.uint8)
+
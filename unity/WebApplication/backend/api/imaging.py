@@ -0,0 +1,171 @@
+"""
+Image processing helpers. These functions are executed in worker processes and must therefore
+not depend on any Django machinery.
+"""
+from io import BytesIO
+
+from PIL import Image
+
+from . import hdr, pipeline
+
+# maps camerafy image formats to the matching Pillow encoder
+PIL_FORMATS = {
+    'PNG': 'PNG',
+    'TGA': 'TGA',
+    'JPG': 'JPEG',
+}
+
+# additional formats images can be transcoded to for clients, see transcode_image()
+VARIANT_PIL_FORMATS = {
+    **PIL_FORMATS,
+    'WEBP': 'WEBP',
+}
+
+# minimum width images are decoded at to compute their difference hash
+DHASH_DECODE_WIDTH = 64
+
+
+def thumbnail_format(format):
+    """
+    Returns the camerafy image format a thumbnail of an image in given format is stored in.
+    """
+    return format if format in PIL_FORMATS else 'PNG'
+
+
+def can_decode(format):
+    """
+    Returns whether images in given camerafy image format can be decoded.
+    """
+    return format in PIL_FORMATS or format in hdr.HDR_FORMATS
+
+
+def open_image(path, format=None, size=None, max_width=None, tone_map=None):
+    """
+    Decodes the image at path into an 8-bit Pillow image, strip by strip through the pipeline. If
+    max_width is given, the image is reduced by the largest integer factor keeping it at least
+    max_width pixels wide while decoding, so huge images never have to be held in memory at full
+    size. HDR images (EXR, RAW) are tone-mapped, raw images require their size.
+    """
+    image = pipeline.open_strips(path, format, size, max_width)
+    if max_width:
+        image = image.reduce(image.width // max_width)
+    return image.tone_map(tone_map).to_image()
+
+
+def scaled_size(size, width):
+    """
+    Returns the aspect preserving (width, height) of an image with given size scaled to width.
+    Images are never scaled up.
+    """
+    width = min(width, size[0])
+    return width, max(1, round(width * size[1] / size[0]))
+
+
+def encode_image(image, format, **params):
+    """
+    Encodes image in given camerafy image format and returns the encoded bytes. Additional params
+    are passed to the Pillow encoder.
+    """
+    if format == 'JPG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    in_memory_file = BytesIO()
+    image.save(in_memory_file, VARIANT_PIL_FORMATS[format], **params)
+    return in_memory_file.getvalue()
+
+
+def transcode_image(path, f, format, quality, source_format=None, source_size=None, tone_map=None):
+    """
+    Re-encodes the image at path in given camerafy image format or 'WEBP' into the binary file
+    object f, without metadata but the color profile. PNG and TGA images are transcoded strip by
+    strip, lossy encoders use the given quality. See open_image() for the source parameters.
+    """
+    image = pipeline.open_strips(path, source_format, source_size).tone_map(tone_map).strip_metadata()
+    if format == 'JPG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(f, VARIANT_PIL_FORMATS[format], quality=quality)
+
+
+def _thumbnails(image, widths, format):
+    sizes = sorted({scaled_size(image.size, width) for width in widths}, reverse=True)
+
+    thumbnails = []
+    current = image
+    for size in sizes:
+        current = current.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        thumbnails.append((current.width, current.height, encode_image(current, format)))
+
+    return thumbnails[::-1], current
+
+
+def create_thumbnails(path, widths, format, source_format=None, source_size=None, tone_map=None):
+    """
+    Creates aspect preserving downscaled versions of the image at path for all given widths. The
+    image is decoded only once, reduced to about the largest width while decoding (see
+    open_image()), and each thumbnail is derived from the next larger one. Returns a list of
+    (width, height, data) tuples ordered by width, where data is the encoded thumbnail image in
+    given camerafy image format. See open_image() for the source parameters.
+    """
+    with open_image(path, source_format, source_size, max(widths), tone_map) as image:
+        return _thumbnails(image, widths, format)[0]
+
+
+def create_snapshot_thumbnails(path, widths, format, source_format=None, source_size=None, tone_map=None):
+    """
+    Like create_thumbnails(), additionally returns the difference hash of the image computed from
+    the smallest thumbnail, i.e. the tuple (thumbnails, dhash).
+    """
+    with open_image(path, source_format, source_size, max(widths), tone_map) as image:
+        thumbnails, smallest = _thumbnails(image, widths, format)
+        return thumbnails, difference_hash(smallest)
+
+
+def difference_hash(image):
+    """
+    Returns the 64 bit difference hash (dHash) of a Pillow image: the image is reduced to 9x8 gray
+    pixels and each bit tells whether a pixel is brighter than its right neighbour. Near-identical
+    images have hashes with a small Hamming distance.
+    """
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    hash = 0
+    for y in range(8):
+        for x in range(8):
+            hash = (hash << 1) | (pixels[y * 9 + x] > pixels[y * 9 + x + 1])
+    return hash
+
+
+def image_hash(path, format=None, size=None, tone_map=None):
+    """
+    Returns the difference hash of the image at path, decoded at reduced resolution where the 
+    format allows it. See open_image() for the parameters.
+    """
+    with open_image(path, format, size, DHASH_DECODE_WIDTH, tone_map) as image:
+        return difference_hash(image)
+
+
+def create_atlas(paths, columns, format):
+    """
+    Packs the images at paths into a single atlas image with a grid of given number of columns.
+    The grid cell size is given by the largest image. Returns the tuple (width, height, data, boxes),
+    where data is the encoded atlas image in given camerafy image format and boxes holds the 
+    (x, y, width, height) of every image in the atlas.
+    """
+    images = [Image.open(path) for path in paths]
+    try:
+        cell_width = max((image.width for image in images), default=0)
+        cell_height = max((image.height for image in images), default=0)
+        columns = max(1, min(columns, len(images)))
+        rows = (len(images) + columns - 1) // columns
+
+        atlas = Image.new('RGBA' if format == 'PNG' else 'RGB', (max(1, cell_width * columns), max(1, cell_height * rows)))
+        boxes = []
+        for index, image in enumerate(images):
+            x = (index % columns) * cell_width
+            y = (index // columns) * cell_height
+            atlas.paste(image.convert(atlas.mode), (x, y))
+            boxes.append((x, y, image.width, image.height))
+    finally:
+        for image in images:
+            image.close()
+
+    return atlas.width, atlas.height, encode_image(atlas, format), boxes
@@ -0,0 +1,150 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from ... import imaging, pipeline
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# formats of the generated images, which are all decoded strip by strip
+BENCHMARK_FORMATS = ['PNG', 'TGA', 'RAW']
+
+# operations measured on every image, 'pillow' decodes it as a whole for comparison
+OPERATIONS = ['thumbnails', 'transcode', 'pillow']
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the current process in bytes, or None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(operation, path, format, size, widths, quality):
+    """
+    Runs an operation on the image at path in a fresh worker process, returns the tuple (seconds,
+    peak RSS before, peak RSS after).
+    """
+    before = peak_rss()
+    started = time.perf_counter()
+    if operation == 'thumbnails':
+        imaging.create_thumbnails(path, widths, 'PNG', format, size)
+    elif operation == 'transcode':
+        with open(os.devnull, 'wb') as f:
+            imaging.transcode_image(path, f, 'PNG', quality, format, size)
+    else:
+        with Image.open(path) as image:
+            image.load()
+            image.thumbnail((max(widths), max(widths)), Image.LANCZOS)
+    return time.perf_counter() - started, before, peak_rss()
+
+
+def _pattern(top, rows, width, height):
+    # opaque smooth gradients with a little noise, so the images compress like rendered frames
+    y = np.arange(top, top + rows, dtype=np.float32)[:, None] / height
+    x = np.arange(width, dtype=np.float32)[None, :] / width
+    pixels = np.full((rows, width, 4), 255, dtype=np.float32)
+    pixels[:, :, 0] = x * 255
+    pixels[:, :, 1] = y * 255
+    pixels[:, :, 2] = (x + y) * 127.5
+    pixels[:, :, :3] += np.random.default_rng(top).integers(-4, 5, (rows, width, 1))
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def generate(path, format, width, height):
+    """
+    Writes a synthetic RGBA image in given format strip by strip.
+    """
+    rows = max(1, pipeline.STRIP_BYTES // (width * 4))
+    with open(path, 'wb') as f:
+        if format == 'RAW':
+            # raw texture data is stored bottom up as ARGB
+            for bottom in range(height, 0, -rows):
+                top = max(bottom - rows, 0)
+                f.write(np.ascontiguousarray(_pattern(top, bottom - top, width, height)[::-1, :, [3, 0, 1, 2]]).tobytes())
+        else:
+            strips = (_pattern(top, min(rows, height - top), width, height) for top in range(0, height, rows))
+            pipeline.StripImage(width, height, 'RGBA', strips).save(f, format, compress_level=1)
+
+
+def format_bytes(size):
+    if size is None:
+        return 'n/a'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the strip based image pipeline on synthetic images of growing size: creates the '
+        'thumbnails of each image and transcodes it, and reports the time and peak resident memory of '
+        'every run, measured in a fresh worker process. Decoding the whole image with Pillow is measured '
+        'for comparison.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 4096, 8192, 16384], metavar='width',
+            help='Widths of the images, which have a 16:9 aspect ratio.')
+        parser.add_argument('--formats', nargs='+', choices=BENCHMARK_FORMATS, default=BENCHMARK_FORMATS,
+            help='Formats of the images.')
+        parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS,
+            help='Operations to measure, Pillow cannot decode raw images.')
+        parser.add_argument('--directory', default=None,
+            help='Directory the images are generated in, a temporary directory by default.')
+
+    def handle(self, *args, **options):
+        if any(width < 16 for width in options['sizes']):
+            raise CommandError('--sizes must be at least 16 pixels.')
+        if resource is None:
+            self.stderr.write('Peak memory cannot be measured on this platform, only times are reported.')
+
+        directory = options['directory'] or tempfile.mkdtemp(prefix='camerafy-benchmark-')
+        os.makedirs(directory, exist_ok=True)
+        try:
+            self.stdout.write(f"{'image':>18} {'format':>6} {'file':>10} {'operation':>10} {'time':>8} {'peak RSS':>10} {'growth':>10}")
+            for width in options['sizes']:
+                height = width * 9 // 16
+                for format in options['formats']:
+                    self.benchmark(directory, format, width, height, options['operations'])
+        finally:
+            if options['directory'] is None:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def benchmark(self, directory, format, width, height, operations):
+        path = os.path.join(directory, f"benchmark_{width}x{height}.{format.lower()}")
+        generate(path, format, width, height)
+        try:
+            file_size = os.path.getsize(path)
+            for operation in operations:
+                if operation == 'pillow' and not imaging.PIL_FORMATS.get(format):
+                    continue
+
+                # every run gets its own process, so the peak memory of earlier runs does not count
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    seconds, before, after = executor.submit(
+                        measure, operation, path, format, (width, height),
+                        settings.CAMERAFY_THUMBNAIL_WIDTHS, settings.CAMERAFY_VARIANT_QUALITY).result()
+
+                growth = after - before if after is not None else None
+                self.stdout.write(
+                    f"{f'{width}x{height}':>18} {format:>6} {format_bytes(file_size):>10} {operation:>10} "
+                    f"{seconds:>7.2f}s {format_bytes(after):>10} {format_bytes(growth):>10}")
+        finally:
+            os.remove(path)
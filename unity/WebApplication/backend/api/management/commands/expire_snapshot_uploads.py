@@ -0,0 +1,59 @@
+import datetime
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...models import snapshots as snapshotModels
+from ...uploads import upload_writer
+
+
+class Command(BaseCommand):
+    help = ('Removes chunked snapshot uploads which have not received any data for CAMERAFY_UPLOAD_EXPIRY '
+        'seconds together with their partially received data, as well as files in the upload directory '
+        'left behind by crashed requests.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expiry', type=float, default=settings.CAMERAFY_UPLOAD_EXPIRY,
+            help='Number of seconds after the last received data an upload expires.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Only report the uploads and files which would be removed.')
+
+    def handle(self, *args, **options):
+        if options['expiry'] < 0:
+            raise CommandError('--expiry must not be negative.')
+
+        cutoff = timezone.now() - datetime.timedelta(seconds=options['expiry'])
+        expired = snapshotModels.CamerafySnapshotUpload.objects.filter(updated__lt=cutoff)
+
+        removed = 0
+        for upload_id in expired.values_list('id', flat=True).iterator():
+            if not options['dry_run']:
+                # the upload may have been resumed meanwhile
+                if not expired.filter(id=upload_id).delete()[0]:
+                    continue
+                upload_writer.discard(upload_id)
+            removed += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f"Upload '{upload_id}' expired.")
+
+        # partial files of deleted uploads and chunks of crashed requests, files of running requests
+        # are written to right now
+        stale_files = 0
+        uploads = {str(upload_id) for upload_id in snapshotModels.CamerafySnapshotUpload.objects.values_list('id', flat=True)}
+        if os.path.isdir(settings.CAMERAFY_UPLOAD_DIR):
+            for entry in os.scandir(settings.CAMERAFY_UPLOAD_DIR):
+                if not entry.is_file() or entry.stat().st_mtime >= cutoff.timestamp():
+                    continue
+                if entry.name.endswith('.part') and entry.name.split('.')[0] in uploads:
+                    continue
+                if not options['dry_run']:
+                    os.remove(entry.path)
+                stale_files += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"Stale upload file '{entry.name}'.")
+
+        self.stdout.write(
+            f"{'Would remove' if options['dry_run'] else 'Removed'} {removed} expired uploads "
+            f"and {stale_files} stale upload files.")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ...models import snapshots as snapshotModels
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-user snapshot statistics (storage usage, snapshot and unseen counts) and corrects any drift.'
+
+    def handle(self, *args, **options):
+        # users with statistics, snapshots or thumbnails
+        user_ids = set(snapshotModels.CamerafySnapshotUserStats.objects.values_list('user_id', flat=True))
+        user_ids.update(snapshotModels.CamerafySnapshot.objects.values_list('author_id', flat=True).distinct())
+        user_ids.update(snapshotModels.CamerafySnapshotThumbnail.objects.values_list('author_id', flat=True).distinct())
+
+        corrected = 0
+        for user_id in sorted(user_ids):
+            corrections = snapshotModels.CamerafySnapshotUserStats.objects.reconcile(user_id)
+            if corrections:
+                corrected += 1
+                self.stdout.write(f"User {user_id}: " + ', '.join(
+                    f"{field} {recorded} -> {actual}" for field, (recorded, actual) in corrections.items()))
+
+        self.stdout.write(f"Reconciled {len(user_ids)} users, corrected {corrected}.")
@@ -0,0 +1,160 @@
+import json
+import os
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import imaging, tiering
+from ...models import camfymodels as camfyModels
+from ...models import environments as environmentModels
+from ...models import snapshots as snapshotModels
+from ...storage import local_file, media_sweeper
+from ...thumbnails import replace_thumbnail, store_snapshot_thumbnails
+
+# models owning thumbnails, in the order they are processed
+THUMBNAIL_KINDS = ['snapshots', 'environments', 'camfymodels']
+
+
+class Command(BaseCommand):
+    help = ('Regenerates the thumbnails of all snapshots, environments and models in the current size and '
+        'format, e.g. after changing CAMERAFY_THUMBNAIL_WIDTHS. The perceptual hashes of the snapshots '
+        'are recomputed as well. Progress is checkpointed, so an '
+        'interrupted run continues where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*', metavar='kind',
+            help=f"Thumbnails to regenerate, one of {', '.join(THUMBNAIL_KINDS)}; all by default.")
+        parser.add_argument('--workers', type=int, default=settings.CAMERAFY_THUMBNAIL_WORKERS,
+            help='Number of worker processes.')
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='Number of rows processed between two checkpoints.')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, 'regenerate_thumbnails.json'),
+            help='File the progress is saved to, removed once all thumbnails are regenerated.')
+        parser.add_argument('--restart', action='store_true',
+            help='Ignore the progress of a previous run.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--workers and --batch-size must be positive.')
+        unknown = set(options['kinds']) - set(THUMBNAIL_KINDS)
+        if unknown:
+            raise CommandError(f"Unknown thumbnails '{', '.join(sorted(unknown))}'.")
+
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = {}
+        if not options['restart'] and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as f:
+                self.checkpoint = json.load(f)
+            self.stdout.write(f"Resuming from checkpoint '{self.checkpoint_path}'.")
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            # keep the workers busy without queueing up the results of a whole batch in memory
+            self.executor = executor
+            self.max_pending = 2 * options['workers']
+            for kind in options['kinds'] or THUMBNAIL_KINDS:
+                self.regenerate(kind, options['batch_size'])
+
+        # replaced files are removed in the background, wait for it before exiting
+        media_sweeper.join()
+
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def save_checkpoint(self):
+        # replace the file atomically, so an interruption never leaves a corrupt checkpoint behind
+        with open(f"{self.checkpoint_path}.tmp", 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(f"{self.checkpoint_path}.tmp", self.checkpoint_path)
+
+    def regenerate(self, kind, batch_size):
+        if kind == 'snapshots':
+            queryset = snapshotModels.CamerafySnapshot.objects.all()
+        elif kind == 'environments':
+            queryset = environmentModels.EnvironmentThumbnail.objects.all()
+        else:
+            queryset = camfyModels.CamfyModelThumbnail.objects.all()
+
+        # rows created later (including the regenerated thumbnails) are not processed again
+        progress = self.checkpoint.setdefault(kind, {'last_id': 0, 'max_id': queryset.order_by('-id').values_list('id', flat=True).first() or 0})
+        queryset = queryset.filter(id__gt=progress['last_id'], id__lte=progress['max_id']).order_by('id')
+
+        total = queryset.count()
+        processed = failed = thumbnails = 0
+        started = time.monotonic()
+
+        while True:
+            batch = list(queryset.filter(id__gt=progress['last_id'])[:batch_size])
+            if not batch:
+                break
+
+            pending = {}
+            for row in batch:
+                if len(pending) >= self.max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        created, error = self.store(kind, pending.pop(future), future)
+                        thumbnails += created
+                        failed += 1 if error else 0
+
+                try:
+                    pending[self.submit(kind, row)] = row
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Failed to regenerate {kind} thumbnail of '{row.id}': {e}")
+
+            for future in wait(pending).done:
+                created, error = self.store(kind, pending[future], future)
+                thumbnails += created
+                failed += 1 if error else 0
+
+            processed += len(batch)
+            progress['last_id'] = batch[-1].id
+            self.save_checkpoint()
+
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"{kind}: {processed}/{total} processed, {failed} failed, "
+                f"{processed / elapsed:.1f} rows/s, {thumbnails / elapsed:.1f} thumbnails/s")
+
+        self.stdout.write(f"Regenerated {thumbnails} {kind} thumbnails of {processed} rows ({failed} failed).")
+
+    def submit(self, kind, row):
+        if kind == 'snapshots':
+            return self.executor.submit(
+                imaging.create_snapshot_thumbnails,
+                local_file(tiering.open_image(row)).path,
+                settings.CAMERAFY_THUMBNAIL_WIDTHS,
+                imaging.thumbnail_format(row.format),
+                row.format,
+                (row.width, row.height),
+                settings.CAMERAFY_HDR_TONE_MAP)
+
+        # the stored thumbnail is the only source there is, so it is re-encoded and never enlarged
+        return self.executor.submit(
+            imaging.create_thumbnails,
+            local_file(row.image).path,
+            [min(row.width, max(settings.CAMERAFY_THUMBNAIL_WIDTHS))],
+            imaging.thumbnail_format(row.format),
+            row.format)
+
+    def store(self, kind, row, future):
+        """
+        Swaps the thumbnails created by future in, returns the number of created thumbnails and
+        whether it failed.
+        """
+        try:
+            if kind == 'snapshots':
+                thumbnails, phash = future.result()
+                return len(thumbnails) if store_snapshot_thumbnails(row.id, row.format, thumbnails, phash) else 0, False
+
+            thumbnails = future.result()
+            owner_model = environmentModels.Environment if kind == 'environments' else camfyModels.CamfyModel
+            width, height, data = thumbnails[-1]
+            created = replace_thumbnail(row, owner_model, imaging.thumbnail_format(row.format), width, height, data)
+            return 1 if created is not None else 0, False
+        except Exception as e:
+            self.stderr.write(f"Failed to regenerate {kind} thumbnail of '{row.id}': {e}")
+            return 0, True
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import tiering
+from ...models import snapshots as snapshotModels
+from ...storage import local_file
+from ...thumbnails import ThumbnailWorkerPool
+
+
+class Command(BaseCommand):
+    help = ('Creates the thumbnails of all snapshots whose thumbnail is still pending, e.g. because the '
+        'server was restarted or crashed before it was created; thumbnail jobs are only kept in memory. '
+        'Thumbnails a running server is creating right now may be created twice, which is harmless.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--failed', action='store_true',
+            help='Retry snapshots whose thumbnail creation failed as well.')
+        parser.add_argument('--workers', type=int, default=settings.CAMERAFY_THUMBNAIL_WORKERS,
+            help='Number of worker processes.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive.')
+
+        statuses = [snapshotModels.CamerafySnapshot.THUMBNAIL_PENDING]
+        if options['failed']:
+            statuses.append(snapshotModels.CamerafySnapshot.THUMBNAIL_FAILED)
+
+        pool = ThumbnailWorkerPool(options['workers'])
+        enqueued = 0
+        for snapshot in snapshotModels.CamerafySnapshot.objects.filter(thumbnail_status__in=statuses).order_by('id').iterator():
+            try:
+                pool.enqueue(snapshot.id, local_file(tiering.open_image(snapshot)).path, snapshot.format, (snapshot.width, snapshot.height))
+            except Exception as e:
+                self.stderr.write(f"Failed to schedule thumbnail creation for snapshot '{snapshot.id}': {e}")
+                continue
+            enqueued += 1
+
+        pool.join()
+        stats = pool.stats()
+        self.stdout.write(f"Created the thumbnails of {stats['processed'] - stats['failed']} of {enqueued} snapshots ({stats['failed']} failed).")
@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import orphans
+
+
+class Command(BaseCommand):
+    help = ('Reports media files no database row references and rows whose media file is missing, '
+        'e.g. left behind by crashed uploads or deletions. Orphaned files are deleted with --delete.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true',
+            help='Delete the orphaned files instead of only reporting them.')
+        parser.add_argument('--min-age', type=float, default=1.0,
+            help='Minimum age in hours of orphaned files, newer files may belong to an upload in progress.')
+
+    def handle(self, *args, **options):
+        if options['min_age'] < 0:
+            raise CommandError('--min-age must not be negative.')
+
+        started = time.monotonic()
+        found, scanned = orphans.find_orphans(time.time() - options['min_age'] * 60 * 60)
+
+        deleted = reclaimed = 0
+        for name, size in found:
+            if options['delete']:
+                if not orphans.delete_orphan(name):
+                    continue
+                deleted += 1
+                reclaimed += size
+            if options['verbosity'] > 1:
+                self.stdout.write(f"Orphaned file '{name}' ({size} bytes){' deleted' if options['delete'] else ''}.")
+
+        dangling = 0
+        for model, name in orphans.find_dangling(scanned):
+            dangling += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{model.__name__} references missing file '{name}'.")
+
+        self.stdout.write(
+            f"Scanned {len(scanned)} files in {time.monotonic() - started:.1f}s: {len(found)} orphaned files "
+            f"({sum(size for _, size in found)} bytes), {dangling} rows referencing missing files.")
+        if options['delete']:
+            self.stdout.write(f"Deleted {deleted} orphaned files, {reclaimed} bytes reclaimed.")
@@ -0,0 +1,65 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import tiering
+from ...models import snapshots as snapshotModels
+from ...storage import media_sweeper
+
+
+class Command(BaseCommand):
+    help = 'Moves old snapshots into the cold storage tier by recompressing them losslessly.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CAMERAFY_TIER_AFTER_DAYS,
+            help='Minimum age in days of the snapshots to move.')
+        parser.add_argument('--codec', choices=list(tiering.CODEC_EXTENSIONS), default=settings.CAMERAFY_TIER_CODEC,
+            help='Codec of the cold tier, formats the codec cannot store losslessly fall back to zstd.')
+        parser.add_argument('--include-unseen', action='store_true',
+            help='Also move snapshots which have not been seen yet.')
+        parser.add_argument('--limit', type=int, default=None,
+            help='Maximum number of snapshots to move.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Only report the bytes which would be reclaimed.')
+
+    def handle(self, *args, **options):
+        if options['codec'] not in tiering.available_codecs():
+            raise CommandError(f"Codec '{options['codec']}' requires the 'zstandard' package.")
+
+        queryset = snapshotModels.CamerafySnapshot.objects.filter(
+            tier=snapshotModels.CamerafySnapshot.TIER_HOT,
+            created__lte=datetime.date.today() - datetime.timedelta(days=options['days'])
+        ).order_by('id')
+        if not options['include_unseen']:
+            queryset = queryset.filter(seen=True)
+        if options['limit'] is not None:
+            queryset = queryset[:options['limit']]
+
+        moved = skipped = failed = 0
+        bytes_before = bytes_after = 0
+        for snapshot in queryset.iterator():
+            try:
+                sizes = tiering.tier_snapshot(snapshot, options['codec'], dry_run=options['dry_run'])
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Failed to move snapshot '{snapshot.title}': {e}")
+                continue
+
+            if sizes is None:
+                skipped += 1
+                continue
+
+            moved += 1
+            bytes_before += sizes[0]
+            bytes_after += sizes[1]
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{snapshot.title}: {sizes[0]} -> {sizes[1]} bytes")
+
+        # replaced files are removed in the background, wait for it before exiting
+        media_sweeper.join()
+
+        self.stdout.write(
+            f"{'Would move' if options['dry_run'] else 'Moved'} {moved} snapshots into the cold tier "
+            f"({skipped} skipped, {failed} failed): {bytes_before} -> {bytes_after} bytes, "
+            f"{bytes_before - bytes_after} bytes reclaimed.")
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-18 06:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_touchpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerafysnapshot',
+            name='thumbnail_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('ready', 'ready'), ('failed', 'failed')], default='ready', max_length=8),
+        ),
+        migrations.AlterField(
+            model_name='camerafysnapshot',
+            name='thumbnail',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.CamerafySnapshotThumbnail'),
+        ),
+    ]
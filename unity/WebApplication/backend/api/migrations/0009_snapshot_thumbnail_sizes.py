@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-18 06:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_thumbnails(apps, schema_editor):
+    # existing thumbnails belong to the snapshot referencing them
+    CamerafySnapshot = apps.get_model('api', 'CamerafySnapshot')
+    CamerafySnapshotThumbnail = apps.get_model('api', 'CamerafySnapshotThumbnail')
+    for snapshot_id, thumbnail_id in CamerafySnapshot.objects.exclude(thumbnail=None).values_list('id', 'thumbnail_id'):
+        CamerafySnapshotThumbnail.objects.filter(id=thumbnail_id).update(snapshot_id=snapshot_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_snapshot_thumbnail_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerafysnapshotthumbnail',
+            name='snapshot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thumbnails', to='api.CamerafySnapshot'),
+        ),
+        migrations.RunPython(link_thumbnails, migrations.RunPython.noop),
+    ]
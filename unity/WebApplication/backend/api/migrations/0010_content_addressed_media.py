@@ -0,0 +1,37 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:00
+
+import backend.api.models.snapshots
+import backend.api.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_snapshot_thumbnail_sizes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'camfy_media_blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='camerafysnapshot',
+            name='image',
+            field=models.ImageField(storage=backend.api.storage.ContentAddressedStorage(), upload_to=backend.api.models.snapshots.snapshots_storage),
+        ),
+        migrations.AlterField(
+            model_name='camerafysnapshotthumbnail',
+            name='image',
+            field=models.ImageField(storage=backend.api.storage.ContentAddressedStorage(), upload_to=backend.api.models.snapshots.snapshots_thumbnail_storage),
+        ),
+    ]
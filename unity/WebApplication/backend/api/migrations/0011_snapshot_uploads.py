@@ -0,0 +1,34 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0010_content_addressed_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CamerafySnapshotUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('description', models.TextField(max_length=1024)),
+                ('format', models.CharField(choices=[('PNG', 'PNG'), ('TGA', 'TGA'), ('JPG', 'JPG'), ('EXR', 'EXR'), ('RAW', 'RAW')], max_length=3)),
+                ('width', models.PositiveSmallIntegerField()),
+                ('height', models.PositiveSmallIntegerField()),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'camfy_snapshot_upload',
+            },
+        ),
+    ]
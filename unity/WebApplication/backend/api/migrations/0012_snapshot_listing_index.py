@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_snapshot_uploads'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='camerafysnapshot',
+            index=models.Index(fields=['author', 'created', 'id'], name='camfy_snapshot_listing_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_snapshot_listing_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerafysnapshot',
+            name='tier',
+            field=models.CharField(choices=[('hot', 'hot'), ('cold', 'cold')], default='hot', max_length=4),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_unseen(apps, schema_editor):
+    # initialize the counters from the existing snapshots
+    CamerafySnapshot = apps.get_model('api', 'CamerafySnapshot')
+    CamerafySnapshotUserStats = apps.get_model('api', 'CamerafySnapshotUserStats')
+    unseen = CamerafySnapshot.objects.filter(seen=False).values('author').annotate(count=models.Count('id'))
+    CamerafySnapshotUserStats.objects.bulk_create([
+        CamerafySnapshotUserStats(user_id=row['author'], unseen=row['count']) for row in unseen
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('api', '0013_snapshot_storage_tier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CamerafySnapshotUserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unseen', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'camfy_snapshot_user_stats',
+            },
+        ),
+        migrations.RunPython(count_unseen, migrations.RunPython.noop),
+    ]
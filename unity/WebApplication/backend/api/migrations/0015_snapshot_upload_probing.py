@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_snapshot_user_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='camerafysnapshotupload',
+            name='format',
+            field=models.CharField(blank=True, choices=[('PNG', 'PNG'), ('TGA', 'TGA'), ('JPG', 'JPG'), ('EXR', 'EXR'), ('RAW', 'RAW')], max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='camerafysnapshotupload',
+            name='height',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='camerafysnapshotupload',
+            name='width',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+def count_usage(apps, schema_editor):
+    # initialize the usage from the existing snapshots and thumbnails
+    CamerafySnapshot = apps.get_model('api', 'CamerafySnapshot')
+    CamerafySnapshotThumbnail = apps.get_model('api', 'CamerafySnapshotThumbnail')
+    CamerafySnapshotUserStats = apps.get_model('api', 'CamerafySnapshotUserStats')
+
+    usage = {}
+    for row in CamerafySnapshot.objects.values('author').annotate(count=models.Count('id'), bytes=models.Sum('size')):
+        usage[row['author']] = [row['count'], row['bytes']]
+    for row in CamerafySnapshotThumbnail.objects.values('author').annotate(bytes=models.Sum('size')):
+        usage.setdefault(row['author'], [0, 0])[1] += row['bytes']
+
+    for user_id, (count, bytes) in usage.items():
+        CamerafySnapshotUserStats.objects.update_or_create(user_id=user_id, defaults={'snapshot_count': count, 'bytes_used': bytes})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_snapshot_upload_probing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerafysnapshotuserstats',
+            name='bytes_used',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='camerafysnapshotuserstats',
+            name='quota',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='camerafysnapshotuserstats',
+            name='snapshot_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='camerafysnapshotuserstats',
+            index=models.Index(fields=['-bytes_used'], name='camfy_snapshot_usage_idx'),
+        ),
+        migrations.RunPython(count_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_snapshot_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerafysnapshot',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.14 on 2026-10-18 08:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_snapshot_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camerafysnapshotupload',
+            name='updated',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
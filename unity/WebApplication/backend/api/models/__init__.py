@@ -1,2 +1,4 @@
 from .environments import *
-from .snapshots import *
\ No newline at end of file
+from .events import *
+from .snapshots import *
+from .storage import *
\ No newline at end of file
@@ -1,3 +1,5 @@
+import os
+import time
 
 # all supported image formats
 IMAGE_FORMAT_CHOICES = [
@@ -6,4 +8,28 @@ IMAGE_FORMAT_CHOICES = [
     ('JPG', 'JPG'),
     ('EXR', 'EXR'),
     ('RAW', 'RAW'),
-]
\ No newline at end of file
+]
+
+# mime types of all supported image formats
+IMAGE_FORMAT_MIME_TYPES = {
+    'PNG': 'image/png',
+    'TGA': 'image/x-tga',
+    'JPG': 'image/jpeg',
+    'EXR': 'image/x-exr',
+    'RAW': 'application/octet-stream',
+}
+
+# alphabet of ULIDs (Crockford's base32)
+ULID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+def new_ulid():
+    """
+    Returns a new ULID, a 26 character identifier which sorts by creation time (millisecond 
+    resolution) and carries 80 random bits, so identifiers created concurrently do not collide.
+    """
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+    chars = []
+    for _ in range(26):
+        chars.append(ULID_ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
@@ -0,0 +1,16 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+
+class CamerafyEvent(models.Model):
+    # user the event is announced to
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # event type, e.g. 'snapshot.created'
+    type = models.CharField(max_length=32)
+    # event payload as json
+    data = models.TextField()
+    # timestamp when published, old events are pruned
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'camfy_events'
@@ -1,17 +1,256 @@
-from django.db import models
+import itertools
+import logging
+import tempfile
+import uuid
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from .common import *
+from .. import events, hdr, imaging, similarity
+from ..probing import validate_image
+from ..storage import local_file, snapshot_storage, media_sweeper
+
+logger = logging.getLogger(__name__)
+
+def hashes_cache_key(author_id):
+    return f"snapshot-hashes:{author_id}"
 
 def snapshots_storage(instance, filename):
-    # file will be uploaded to MEDIA_ROOT/snapshots/<user_id>/<filename>
+    # legacy location MEDIA_ROOT/snapshots/<user_id>/<filename>, the content addressed
+    # snapshot storage only keeps the file extension
     return f"snapshots/{instance.author.id}/{filename}"
 
 def snapshots_thumbnail_storage(instance, filename):
-    # file will be uploaded to MEDIA_ROOT/snapshots/<user_id>/thumbnails/<filename>
+    # legacy location MEDIA_ROOT/snapshots/<user_id>/thumbnails/<filename>, the content addressed
+    # snapshot storage only keeps the file extension
     return f"snapshots/{instance.author.id}/thumbnails/{filename}"
 
+class CamerafySnapshotManager(models.Manager):
+
+    def _new_snapshot(self, author, image, format=None, width=None, height=None, description=''):
+        # the real format and dimensions are taken from the image header, client supplied values
+        # are only checked against them
+        info = validate_image(image, format, width, height, settings.CAMERAFY_MAX_IMAGE_SIZE)
+        format, width, height = info.format, info.width, info.height
+
+        title = f"snapshot-{new_ulid()}"
+        # rename save file for uploaded snapshot
+        image.name = f"{title}.{format}"
+
+        return self.model(
+            author=author,
+            title=title,
+            description=description,
+            image=image,
+            thumbnail=None,
+            thumbnail_status=self.model.THUMBNAIL_PENDING,
+            format=format,
+            width=width,
+            height=height,
+            size=image.size,
+            seen=False
+        )
+
+    def _schedule_thumbnails(self, snapshots):
+        from ..thumbnails import thumbnail_pool
+
+        # create downscaled thumbnail versions of the images once the snapshots are committed
+        def enqueue():
+            for snapshot in snapshots:
+                # the snapshots have been stored already, so failing here must not fail the request;
+                # their thumbnails stay pending until 'requeue_pending_thumbnails' is run
+                try:
+                    thumbnail_pool.enqueue(snapshot.id, local_file(snapshot.image).path, snapshot.format, (snapshot.width, snapshot.height))
+                except Exception:
+                    logger.exception(f"Failed to schedule thumbnail creation for snapshot {snapshot.id}.")
+        transaction.on_commit(enqueue)
+
+    def _image_hash(self, image, format, size):
+        # files handed over by path (e.g. completed chunked uploads) are not opened
+        if hasattr(image, 'temporary_file_path'):
+            return imaging.image_hash(image.temporary_file_path(), format, size, settings.CAMERAFY_HDR_TONE_MAP)
+
+        if format not in hdr.HDR_FORMATS:
+            # Pillow decodes in-memory uploads right away
+            try:
+                return imaging.image_hash(image, format, size)
+            finally:
+                image.seek(0)
+
+        with tempfile.NamedTemporaryFile() as f:
+            for chunk in image.chunks():
+                f.write(chunk)
+            f.flush()
+            image.seek(0)
+            return imaging.image_hash(f.name, format, size, settings.CAMERAFY_HDR_TONE_MAP)
+
+    def _author_hashes(self, author_id):
+        # (id, phash) rows of the author's snapshots packed into a single int64 array, which is
+        # kept in the cache shared by all processes until one of the author's hashes changes
+        data = cache.get(hashes_cache_key(author_id))
+        if data is None:
+            rows = self.filter(author_id=author_id, phash__isnull=False).values_list('id', 'phash').iterator()
+            data = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).tobytes()
+            cache.set(hashes_cache_key(author_id), data, settings.CAMERAFY_SIMILARITY_CACHE_TIMEOUT)
+        return np.frombuffer(data, dtype=np.int64).reshape(-1, 2)
+
+    def invalidate_hashes(self, author_ids):
+        """
+        Drops the cached perceptual hashes of the authors with given ids once the current transaction
+        has been committed. Has to be called whenever snapshots with a hash are created, deleted or
+        their hash changes.
+        """
+        keys = [hashes_cache_key(author_id) for author_id in set(author_ids)]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def similar(self, author_id, phash, max_distance, exclude_id=None):
+        """
+        Returns the (snapshot id, distance) of the author's snapshots whose perceptual hash is at
+        most max_distance bits different from phash, closest first. Only reading the author's 
+        hashes costs a query, they are loaded from the cache as one packed array. A snapshot
+        deleted concurrently may still be returned.
+        """
+        rows = self._author_hashes(author_id)
+        if exclude_id is not None:
+            rows = rows[rows[:, 0] != exclude_id]
+        return similarity.nearest(rows[:, 0], rows[:, 1], phash, max_distance)
+
+    def create_snapshot(self, author, image, format=None, width=None, height=None, description='', dedupe=False):
+        """
+        Creates a new unseen snapshot from an image file. Format and dimensions are probed from the
+        image header and, if given, must match it; raises ImageProbeError otherwise. Raises 
+        QuotaExceeded if the author's storage quota does not allow storing the image. Thumbnail 
+        generation is scheduled once the current transaction has been committed. If dedupe is set,
+        DuplicateSnapshot is raised if the author already has a near-identical snapshot.
+        """
+        snapshot = self._new_snapshot(author, image, format, width, height, description)
+
+        if dedupe:
+            # the image is decoded at reduced size right away, its thumbnails are still created later
+            snapshot.phash = similarity.to_signed(self._image_hash(image, snapshot.format, (snapshot.width, snapshot.height)))
+            duplicates = self.similar(author.id, snapshot.phash, settings.CAMERAFY_DUPLICATE_DISTANCE)
+            existing = self.in_bulk([id for id, _ in duplicates])
+            for id, distance in duplicates:
+                if id in existing:
+                    raise DuplicateSnapshot(existing[id], distance)
+
+        with transaction.atomic():
+            # account for the snapshot before its file is stored
+            CamerafySnapshotUserStats.objects.add(author.id, unseen=1, snapshots=1, bytes=snapshot.size, enforce_quota=True)
+            snapshot.save(force_insert=True)
+            if snapshot.phash is not None:
+                self.invalidate_hashes([author.id])
+            self._schedule_thumbnails([snapshot])
+            events.publish(author.id, 'snapshot.created', {'ids': [snapshot.id]})
+
+        return snapshot
+
+    def create_snapshots(self, author, images):
+        """
+        Creates new unseen snapshots for a batch of images with a single insert. Each image is 
+        given as dict of create_snapshot() keyword arguments except 'dedupe', batches are never
+        deduplicated. Returns the created snapshots in the same order.
+        """
+        with transaction.atomic():
+            snapshots = [self._new_snapshot(author, **image) for image in images]
+            # account for the snapshots before their files are stored
+            CamerafySnapshotUserStats.objects.add(
+                author.id, unseen=len(snapshots), snapshots=len(snapshots), bytes=sum(s.size for s in snapshots), enforce_quota=True)
+            snapshots = self.bulk_create(snapshots)
+
+            # not every database returns primary keys from bulk inserts, but titles are unique
+            ids = dict(self.filter(title__in=[s.title for s in snapshots]).values_list('title', 'id'))
+            for snapshot in snapshots:
+                snapshot.id = ids[snapshot.title]
+
+            self._schedule_thumbnails(snapshots)
+            events.publish(author.id, 'snapshot.created', {'ids': [s.id for s in snapshots]})
+
+        return snapshots
+
+    def delete_snapshots(self, ids):
+        """
+        Deletes the snapshots with given ids and all their thumbnails in a single transaction. The
+        media files are removed in the background once the transaction has been committed. Returns
+        the number of deleted snapshots.
+        """
+        with transaction.atomic():
+            # lock the snapshots to delete, writing before reading also makes sqlite take the write
+            # lock right away, see MediaBlobManager.acquire()
+            self.filter(id__in=ids).update(thumbnail_status=models.F('thumbnail_status'))
+
+            authors = dict(self.filter(id__in=ids).values_list('id', 'author_id'))
+            ids = list(authors)
+            thumbnail_ids = set(CamerafySnapshotThumbnail.objects.filter(
+                models.Q(snapshot_id__in=ids) | models.Q(camerafysnapshot__id__in=ids)).values_list('id', flat=True))
+
+            # one name per row, every row holds a reference to its media file
+            names = list(self.filter(id__in=ids).values_list('image', flat=True))
+            names += list(CamerafySnapshotThumbnail.objects.filter(id__in=thumbnail_ids).values_list('image', flat=True))
+
+            # remove the deleted snapshots and thumbnails from their authors' statistics
+            changes = {}
+            for row in self.filter(id__in=ids).values('author').annotate(
+                    count=models.Count('id'), unseen=models.Count('id', filter=models.Q(seen=False)), bytes=models.Sum('size')):
+                changes[row['author']] = {'unseen': -row['unseen'], 'snapshots': -row['count'], 'bytes': -row['bytes']}
+            for row in CamerafySnapshotThumbnail.objects.filter(id__in=thumbnail_ids).values('author').annotate(bytes=models.Sum('size')):
+                changes.setdefault(row['author'], {'bytes': 0})
+                changes[row['author']]['bytes'] -= row['bytes']
+            for author_id, change in changes.items():
+                CamerafySnapshotUserStats.objects.add(author_id, **change)
+
+            CamerafySnapshotThumbnail.objects.filter(id__in=thumbnail_ids).delete()
+            self.filter(id__in=ids).delete()
+            media_sweeper.schedule(snapshot_storage, names)
+            self.invalidate_hashes(authors.values())
+
+            for author_id in set(authors.values()):
+                events.publish(author_id, 'snapshot.deleted', {'ids': [id for id, a in authors.items() if a == author_id]})
+
+        return len(ids)
+
+    def set_seen(self, author_id, ids, seen=True):
+        """
+        Sets the 'seen' flag of the snapshots of given author with given ids in a single update and
+        keeps the author's unseen counter in sync. Returns the number of changed snapshots.
+        """
+        with transaction.atomic():
+            # only snapshots whose flag actually changes are counted
+            updated = self.filter(author_id=author_id, id__in=ids, seen=not seen).update(seen=seen)
+            if updated:
+                CamerafySnapshotUserStats.objects.add(author_id, unseen=-updated if seen else updated)
+                # snapshots selected by a filter are not listed, clients reload their flags then
+                events.publish(author_id, 'snapshot.seen', {
+                    'ids': [int(id) for id in ids] if isinstance(ids, (list, tuple)) else None,
+                    'seen': seen,
+                    'unseen': CamerafySnapshotUserStats.objects.unseen(author_id)
+                })
+
+        return updated
+
+
 class CamerafySnapshot(models.Model):
+    THUMBNAIL_PENDING = 'pending'
+    THUMBNAIL_READY = 'ready'
+    THUMBNAIL_FAILED = 'failed'
+    THUMBNAIL_STATUS_CHOICES = (
+        (THUMBNAIL_PENDING, 'pending'),
+        (THUMBNAIL_READY, 'ready'),
+        (THUMBNAIL_FAILED, 'failed')
+    )
+    TIER_HOT = 'hot'
+    TIER_COLD = 'cold'
+    TIER_CHOICES = (
+        (TIER_HOT, 'hot'),
+        (TIER_COLD, 'cold')
+    )
+
     # user who took the snapshot
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     # timestamp when snapshot was taken
@@ -20,8 +259,10 @@ class CamerafySnapshot(models.Model):
     title = models.CharField(unique=True, max_length=256)
     # snapshot description text
     description = models.TextField(max_length=1024)
-    # image thumbnail
-    thumbnail = models.ForeignKey('CamerafySnapshotThumbnail', on_delete=models.CASCADE)
+    # image thumbnail, created asynchronously after upload
+    thumbnail = models.ForeignKey('CamerafySnapshotThumbnail', blank=True, null=True, on_delete=models.CASCADE)
+    # state of the thumbnail generation
+    thumbnail_status = models.CharField(max_length=8, choices=THUMBNAIL_STATUS_CHOICES, default=THUMBNAIL_READY)
     # image format
     format = models.CharField(choices=IMAGE_FORMAT_CHOICES, max_length=3)
     # image width
@@ -30,18 +271,45 @@ class CamerafySnapshot(models.Model):
     height = models.PositiveSmallIntegerField()
     # image size in bytes
     size = models.PositiveIntegerField()
-    # image data
-    image = models.ImageField(upload_to=snapshots_storage)
+    # image data, losslessly recompressed if the snapshot is in the cold tier
+    image = models.ImageField(upload_to=snapshots_storage, storage=snapshot_storage)
+    # storage tier, see backend.api.tiering
+    tier = models.CharField(max_length=4, choices=TIER_CHOICES, default=TIER_HOT)
+    # 64 bit perceptual hash (dHash) stored as signed integer, computed with the thumbnails
+    phash = models.BigIntegerField(blank=True, null=True)
     # 'seen' flag
     seen = models.BooleanField()
+
+    objects = CamerafySnapshotManager()
     
     class Meta:
         db_table = 'camfy_snapshot'
+        indexes = [
+            # snapshot listing, see SnapshotCursorPagination
+            models.Index(fields=['author', 'created', 'id'], name='camfy_snapshot_listing_idx')
+        ]
+
+    def closest_thumbnail(self, width):
+        """
+        Returns the smallest thumbnail at least width pixels wide, or the largest thumbnail if there
+        is none. Falls back to the default thumbnail for snapshots without a thumbnail set.
+        """
+        thumbnails = sorted(self.thumbnails.all(), key=lambda t: t.width)
+        if not thumbnails:
+            return self.thumbnail
+
+        for thumbnail in thumbnails:
+            if thumbnail.width >= width:
+                return thumbnail
+
+        return thumbnails[-1]
 
 
 class CamerafySnapshotThumbnail(models.Model):
     # user who took the snapshot
     author = models.ForeignKey(User, on_delete=models.CASCADE)
+    # snapshot this thumbnail was derived from
+    snapshot = models.ForeignKey('CamerafySnapshot', blank=True, null=True, related_name='thumbnails', on_delete=models.CASCADE)
     # image format
     format = models.CharField(choices=IMAGE_FORMAT_CHOICES, max_length=3)
     # image width
@@ -51,7 +319,174 @@ class CamerafySnapshotThumbnail(models.Model):
     # image size in bytes
     size = models.PositiveIntegerField()
     # image data
-    image = models.ImageField(upload_to=snapshots_thumbnail_storage)
+    image = models.ImageField(upload_to=snapshots_thumbnail_storage, storage=snapshot_storage)
+
+    class Meta:
+        db_table = 'camfy_snapshot_thumbnail'
+
+class CamerafySnapshotUpload(models.Model):
+    # upload identifier
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # user the uploaded snapshot belongs to
+    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    # timestamp when the upload was started
+    created = models.DateTimeField(auto_now_add=True)
+    # timestamp when data was last received, uploads expire CAMERAFY_UPLOAD_EXPIRY seconds later
+    updated = models.DateTimeField(default=timezone.now, db_index=True)
+    # snapshot description text
+    description = models.TextField(max_length=1024)
+    # image format, probed from the received data if not given
+    format = models.CharField(choices=IMAGE_FORMAT_CHOICES, max_length=3, blank=True)
+    # image width, probed from the received data if not given
+    width = models.PositiveSmallIntegerField(blank=True, null=True)
+    # image height, probed from the received data if not given
+    height = models.PositiveSmallIntegerField(blank=True, null=True)
+    # expected total size in bytes, if announced by the client
+    size = models.BigIntegerField(blank=True, null=True)
+    # number of bytes received so far
+    offset = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'camfy_snapshot_upload'
+
+class QuotaExceeded(Exception):
+    """
+    Storing a snapshot would exceed its author's storage quota.
+    """
+
+
+class DuplicateSnapshot(Exception):
+    """
+    The author already has a near-identical snapshot, which is given with its hash distance.
+    """
+
+    def __init__(self, snapshot, distance):
+        super().__init__(f"Snapshot is a duplicate of '{snapshot.title}'.")
+        self.snapshot = snapshot
+        self.distance = distance
+
+
+class CamerafySnapshotUserStatsManager(models.Manager):
+
+    def _quota_condition(self, bytes):
+        # users without an individual quota are limited by the default quota, if there is one
+        default = settings.CAMERAFY_DEFAULT_QUOTA
+        individual = models.Q(quota__isnull=False, bytes_used__lte=models.F('quota') - bytes)
+        if default is None:
+            return individual | models.Q(quota__isnull=True)
+        return individual | models.Q(quota__isnull=True, bytes_used__lte=default - bytes)
+
+    def add(self, user_id, unseen=0, snapshots=0, bytes=0, enforce_quota=False):
+        """
+        Adds the given (possibly negative) numbers of unseen snapshots, snapshots and bytes used to
+        the statistics of the user with given id, registering them if necessary. If enforce_quota is
+        set, raises QuotaExceeded instead of exceeding the user's storage quota. Must be called 
+        inside a transaction.
+        """
+        changes = {}
+        for field, value in [('unseen', unseen), ('snapshot_count', snapshots), ('bytes_used', bytes)]:
+            if value:
+                changes[field] = models.F(field) + value
+        if not changes:
+            return
+
+        # write before reading, see MediaBlobManager.acquire()
+        while True:
+            queryset = self.filter(user_id=user_id)
+            if (queryset.filter(self._quota_condition(bytes)) if enforce_quota else queryset).update(**changes):
+                return
+            if enforce_quota and queryset.exists():
+                raise QuotaExceeded(f"Storing {bytes} more bytes would exceed the storage quota of {self.quota(user_id)} bytes.")
+
+            try:
+                with transaction.atomic():
+                    self.create(user_id=user_id, unseen=max(unseen, 0), snapshot_count=max(snapshots, 0), bytes_used=max(bytes, 0))
+                    if enforce_quota and not self.filter(user_id=user_id).filter(self._quota_condition(0)).exists():
+                        raise QuotaExceeded(f"Storing {bytes} bytes would exceed the storage quota of {self.quota(user_id)} bytes.")
+                return
+            except IntegrityError:
+                # registered concurrently, update that one
+                continue
+
+    def has_quota(self, user_id, bytes):
+        """
+        Returns whether the user with given id could store bytes more bytes right now.
+        """
+        if not self.filter(user_id=user_id).exists():
+            return settings.CAMERAFY_DEFAULT_QUOTA is None or bytes <= settings.CAMERAFY_DEFAULT_QUOTA
+        return self.filter(self._quota_condition(bytes), user_id=user_id).exists()
+
+    def quota(self, user_id):
+        """
+        Returns the storage quota in bytes of the user with given id, None if unlimited.
+        """
+        quota = self.filter(user_id=user_id).values_list('quota', flat=True).first()
+        return quota if quota is not None else settings.CAMERAFY_DEFAULT_QUOTA
+
+    def unseen(self, user_id):
+        """
+        Returns the number of unseen snapshots of the user with given id.
+        """
+        return self.filter(user_id=user_id).values_list('unseen', flat=True).first() or 0
+
+    def usage(self, user_id):
+        """
+        Returns the storage usage of the user with given id.
+        """
+        stats = self.filter(user_id=user_id).first()
+        return {
+            'snapshots': stats.snapshot_count if stats is not None else 0,
+            'bytes_used': stats.bytes_used if stats is not None else 0,
+            'quota': self.quota(user_id),
+        }
+
+    def reconcile(self, user_id):
+        """
+        Recomputes the statistics of the user with given id from the stored snapshots and corrects
+        them if they drifted. Returns a dict of the corrected fields mapped to their (recorded, 
+        actual) values.
+        """
+        with transaction.atomic():
+            # lock the statistics, so concurrent uploads and deletions of this user wait until we are
+            # done, writing first also makes sqlite take the write lock right away
+            self.filter(user_id=user_id).update(unseen=models.F('unseen'))
+            stats, _ = self.get_or_create(user_id=user_id)
+
+            snapshots = CamerafySnapshot.objects.filter(author_id=user_id).aggregate(
+                snapshot_count=models.Count('id'),
+                unseen=models.Count('id', filter=models.Q(seen=False)),
+                bytes_used=models.Sum('size'))
+            thumbnails = CamerafySnapshotThumbnail.objects.filter(author_id=user_id).aggregate(bytes_used=models.Sum('size'))
+
+            actual = {
+                'unseen': snapshots['unseen'],
+                'snapshot_count': snapshots['snapshot_count'],
+                'bytes_used': (snapshots['bytes_used'] or 0) + (thumbnails['bytes_used'] or 0),
+            }
+            corrections = {field: (getattr(stats, field), value) for field, value in actual.items() if getattr(stats, field) != value}
+            if corrections:
+                self.filter(user_id=user_id).update(**actual)
+
+        return corrections
+
+
+class CamerafySnapshotUserStats(models.Model):
+    # user these statistics belong to
+    user = models.OneToOneField(User, primary_key=True, related_name='snapshot_stats', on_delete=models.CASCADE)
+    # number of snapshots not seen yet, kept in sync by CamerafySnapshotManager
+    unseen = models.PositiveIntegerField(default=0)
+    # number of snapshots, kept in sync by CamerafySnapshotManager
+    snapshot_count = models.PositiveIntegerField(default=0)
+    # bytes used by snapshots and their thumbnails, kept in sync by CamerafySnapshotManager
+    bytes_used = models.BigIntegerField(default=0)
+    # storage quota in bytes, CAMERAFY_DEFAULT_QUOTA applies if not set
+    quota = models.BigIntegerField(blank=True, null=True)
+
+    objects = CamerafySnapshotUserStatsManager()
 
     class Meta:
-        db_table = 'camfy_snapshot_thumbnail'
\ No newline at end of file
+        db_table = 'camfy_snapshot_user_stats'
+        indexes = [
+            # top consumers listing
+            models.Index(fields=['-bytes_used'], name='camfy_snapshot_usage_idx')
+        ]
@@ -0,0 +1,49 @@
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+
+
+class MediaBlobManager(models.Manager):
+
+    def acquire(self, name, size):
+        """
+        Adds a reference to the blob with given storage name, registering the blob if necessary.
+        Must be called inside a transaction.
+        """
+        # write before reading, so sqlite takes the write lock right away instead of failing to 
+        # upgrade a read lock held by a concurrent transaction
+        while not self.filter(name=name).update(refcount=F('refcount') + 1):
+            try:
+                with transaction.atomic():
+                    self.create(name=name, size=size, refcount=1)
+                return
+            except IntegrityError:
+                # registered concurrently, add the reference to that one
+                continue
+
+    def release(self, name):
+        """
+        Removes a reference from the blob with given storage name. Returns True if this was the last
+        reference and the blob is no longer registered, False if the blob is still referenced, or 
+        None if the blob is unknown. Must be called inside a transaction.
+        """
+        while True:
+            if self.filter(name=name, refcount__gt=1).update(refcount=F('refcount') - 1):
+                return False
+            if self.filter(name=name, refcount__lte=1).delete()[0]:
+                return True
+            if not self.filter(name=name).exists():
+                return None
+
+
+class MediaBlob(models.Model):
+    # content addressed storage name of the blob
+    name = models.CharField(unique=True, max_length=256)
+    # blob size in bytes
+    size = models.BigIntegerField()
+    # number of files referencing this blob
+    refcount = models.PositiveIntegerField(default=0)
+
+    objects = MediaBlobManager()
+
+    class Meta:
+        db_table = 'camfy_media_blobs'
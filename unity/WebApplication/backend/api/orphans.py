@@ -0,0 +1,222 @@
+"""
+Reconciliation of the stored media files with the database. Files no row references (e.g. left
+behind by a crashed upload) are orphans, rows whose file is missing are dangling. Referenced names
+are loaded in chunks and kept as sorted array of 64 bit name hashes, so millions of them take a
+few megabytes and are matched against the scanned files in vectorized batches.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import camfymodels as camfyModels
+from .models import environments as environmentModels
+from .models import snapshots as snapshotModels
+from .models.storage import MediaBlob
+from .storage import is_local, snapshot_storage
+
+# directories of the media storage holding the files referenced by the database
+MEDIA_DIRECTORIES = ['blobs', 'snapshots']
+
+# model fields referencing media files
+MEDIA_FIELDS = [
+    (snapshotModels.CamerafySnapshot, 'image'),
+    (snapshotModels.CamerafySnapshotThumbnail, 'image'),
+    (environmentModels.EnvironmentThumbnail, 'image'),
+    (camfyModels.CamfyModelThumbnail, 'image'),
+]
+
+# number of names loaded from the database or matched against it at once
+ORPHAN_CHUNK_SIZE = 10000
+
+
+def name_keys(names):
+    """
+    Returns the 64 bit hashes of the media names as numpy array. Colliding hashes only make an
+    orphan look referenced, never the other way round.
+    """
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little') for name in names),
+        dtype=np.uint64, count=len(names))
+
+
+def contains(sorted_keys, keys):
+    """
+    Returns a boolean array telling which keys are in the sorted key array.
+    """
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[index] == keys
+
+
+def _chunked(iterable):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == ORPHAN_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def referenced_names():
+    """
+    Yields chunks of the (model, name) of all media files referenced by the database.
+    """
+    for model, field in MEDIA_FIELDS:
+        names = model.objects.exclude(**{field: ''}).values_list(field, flat=True).iterator(chunk_size=ORPHAN_CHUNK_SIZE)
+        for chunk in _chunked(names):
+            yield model, chunk
+
+
+def referenced_keys():
+    """
+    Returns the sorted keys of all media names referenced by the database.
+    """
+    keys = [name_keys(chunk) for _, chunk in referenced_names()]
+    return np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.uint64)
+
+
+class _ObjectEntry:
+    """
+    Directory entry of a file of a remote storage, whose listing includes size and modification time.
+    """
+
+    def __init__(self, size, mtime):
+        self.st_size = size
+        self.st_mtime = mtime
+
+    def stat(self, follow_symlinks=False):
+        return self
+
+
+def _scan_remote(storage, directory):
+    if hasattr(storage, 'scan'):
+        yield from storage.scan(f"{directory}/")
+        return
+
+    directories, files = storage.listdir(directory)
+    for name in files:
+        name = f"{directory}/{name}"
+        yield name, storage.size(name), storage.get_modified_time(name).timestamp()
+    for subdirectory in directories:
+        yield from _scan_remote(storage, f"{directory}/{subdirectory}")
+
+
+def scan_media(root=None, directories=MEDIA_DIRECTORIES):
+    """
+    Yields the (name, directory entry) of all files below the media directories. The upload and
+    cache directories hold files not referenced by the database and are skipped. Files of remote
+    storages are listed in pages, their entries are stat'ed already.
+    """
+    storage = snapshot_storage.backend
+    if not is_local(storage):
+        for directory in directories:
+            for name, size, mtime in _scan_remote(storage, directory):
+                yield name, _ObjectEntry(size, mtime)
+        return
+
+    root = root or settings.MEDIA_ROOT
+    skip = {os.path.abspath(path) for path in (
+        settings.CAMERAFY_UPLOAD_DIR, settings.CAMERAFY_HOT_CACHE_DIR, settings.CAMERAFY_VARIANT_CACHE_DIR,
+        settings.CAMERAFY_ATLAS_CACHE_DIR)}
+
+    stack = [os.path.join(root, directory) for directory in directories]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.abspath(entry.path) not in skip:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield os.path.relpath(entry.path, root).replace(os.sep, '/'), entry
+
+
+def find_orphans(min_mtime, root=None):
+    """
+    Scans the media directories for files not referenced by the database and last modified before
+    min_mtime, files written more recently might belong to a transaction still in progress. Returns
+    the list of (name, size) of the orphans and the sorted keys of all scanned files.
+    """
+    referenced = referenced_keys()
+
+    orphans = []
+    scanned = []
+    for chunk in _chunked(scan_media(root)):
+        names = [name for name, _ in chunk]
+        entries = [entry for _, entry in chunk]
+        keys = name_keys(names)
+        scanned.append(keys)
+
+        # only unreferenced files need a stat call
+        for index in np.flatnonzero(~contains(referenced, keys)):
+            try:
+                stat = entries[index].stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < min_mtime:
+                orphans.append((names[index], stat.st_size))
+
+    scanned = np.unique(np.concatenate(scanned)) if scanned else np.zeros(0, dtype=np.uint64)
+    return orphans, scanned
+
+
+def find_dangling(scanned, root=None):
+    """
+    Yields the (model, name) of the referenced media files which do not exist, given the sorted
+    keys of all files found by find_orphans().
+    """
+    root = root or settings.MEDIA_ROOT
+    storage = snapshot_storage.backend
+    local = is_local(storage)
+
+    for model, names in referenced_names():
+        for index in np.flatnonzero(~contains(scanned, name_keys(names))):
+            # files outside of the scanned directories or stored after the scan are not in scanned
+            if not (os.path.exists(os.path.join(root, names[index])) if local else storage.exists(names[index])):
+                yield model, names[index]
+
+
+def is_referenced(name):
+    return any(model.objects.filter(**{field: name}).exists() for model, field in MEDIA_FIELDS)
+
+
+def delete_orphan(name, root=None):
+    """
+    Deletes an orphaned media file unless it has been referenced in the meantime. Returns whether
+    the file has been deleted.
+    """
+    storage = snapshot_storage.backend
+    staging = f"{snapshot_storage.prefix}/staging/"
+
+    with transaction.atomic():
+        if name.startswith(f"{snapshot_storage.prefix}/") and not name.startswith(staging):
+            # register a reference first, a concurrent upload of identical content waits for it and
+            # stores the file again instead of reusing the one deleted here; writing first also makes
+            # sqlite take the write lock right away, see MediaBlobManager.acquire()
+            MediaBlob.objects.acquire(name, 0)
+            if is_referenced(name):
+                MediaBlob.objects.release(name)
+                return False
+            MediaBlob.objects.filter(name=name).delete()
+        elif is_referenced(name):
+            return False
+
+        if is_local(storage):
+            try:
+                os.remove(os.path.join(root or settings.MEDIA_ROOT, name))
+            except FileNotFoundError:
+                pass
+        else:
+            storage.delete(name)
+
+    return True
@@ -0,0 +1,85 @@
+import base64
+import datetime
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class SnapshotCursorPagination(BasePagination):
+    """
+    Keyset pagination over snapshots ordered by (created, id). The cursor holds the position of the
+    first or last snapshot of the current page, so fetching any page costs the same as fetching the
+    first one, no matter how many snapshots a user has.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            return max(1, min(page_size, self.max_page_size))
+        except (KeyError, ValueError):
+            return settings.REST_FRAMEWORK['PAGE_SIZE']
+
+    def encode_cursor(self, reverse, snapshot):
+        position = f"{'r' if reverse else 'n'}|{snapshot.created.isoformat()}|{snapshot.id}"
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, created, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return direction == 'r', datetime.date.fromisoformat(created), int(id)
+        except (TypeError, ValueError):
+            raise NotFound('Invalid cursor.')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        reverse, created, id = self.decode_cursor(cursor) if cursor else (False, None, None)
+
+        if reverse:
+            queryset = queryset.filter(Q(created__lt=created) | Q(created=created, id__lt=id)).order_by('-created', '-id')
+        elif cursor:
+            queryset = queryset.filter(Q(created__gt=created) | Q(created=created, id__gt=id)).order_by('created', 'id')
+        else:
+            queryset = queryset.order_by('created', 'id')
+
+        # fetch one additional snapshot to learn if there is another page in this direction
+        page = list(queryset[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        if reverse:
+            page.reverse()
+
+        self.has_next = has_more if not reverse else True
+        self.has_previous = (cursor is not None) if not reverse else has_more
+        self.page = page
+        return page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(False, self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(True, self.page[0]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
@@ -0,0 +1,496 @@
+"""
+Strip based image processing. Images are decoded into strips of whole rows which flow through a
+chain of stages (tone mapping, mode conversion, downscaling, metadata stripping) into a sink
+encoding or collecting them, so only a few strips are held in memory at a time however large the
+image is. Strips are numpy arrays of shape (rows, width, channels) holding 8-bit values, or linear
+float32 values for HDR images until they are tone-mapped.
+
+PNG (8-bit, not interlaced), uncompressed TGA, EXR and raw images are decoded strip by strip, PNG
+and TGA files are written strip by strip. Any other image is decoded by Pillow as a whole, JPEGs at
+reduced scale when the image is downscaled. Like imaging, this module runs in worker processes and
+must therefore not depend on any Django machinery.
+"""
+import copy
+import struct
+import zlib
+
+from io import BytesIO
+
+import numpy as np
+
+from PIL import Image
+
+from . import hdr
+
+# number of bytes of decoded pixels per strip, stages need a small multiple of it
+STRIP_BYTES = 2 * 1024 * 1024
+
+# number of bytes of image data read from a file at once
+READ_CHUNK_SIZE = 64 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# color types of the PNG images decoded strip by strip and their number of channels
+PNG_COLOR_TYPES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# PNG color types of the strip modes
+PNG_MODE_COLOR_TYPES = {'L': 0, 'LA': 4, 'RGB': 2, 'RGBA': 6}
+
+# ancillary PNG chunks describing the colors, which metadata stripping keeps
+PNG_COLOR_CHUNKS = (b'iCCP', b'sRGB', b'gAMA', b'cHRM')
+
+# ancillary PNG chunks depending on the mode of the image, which are dropped when it changes
+PNG_MODE_CHUNKS = (b'bKGD', b'hIST', b'sBIT')
+
+# prefix of the EXIF data of Pillow images, which is not part of PNG eXIf chunks
+EXIF_PREFIX = b'Exif\0\0'
+
+# PNG scanline filter type encoded rows are filtered with
+PNG_PAETH_FILTER = 4
+
+# modes of the strips by their number of channels
+MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+
+def _png_chunk(type, data):
+    return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+
+class StripImage:
+    """
+    An image flowing through the pipeline. strips is an iterator over its strips, so an image can
+    be consumed only once. Stages return a new image and decode nothing before a sink consumes it.
+    metadata holds the ancillary PNG chunks (type, data) of the source, linear tells whether the
+    strips hold linear float32 values which need to be tone-mapped. lossless is False if the source
+    pixels had to be converted to fit a strip mode, e.g. those of 16-bit PNGs.
+    """
+
+    def __init__(self, width, height, mode, strips, metadata=(), linear=False, lossless=True):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.strips = strips
+        self.metadata = list(metadata)
+        self.linear = linear
+        self.lossless = lossless
+
+    def _derive(self, strips, **attributes):
+        image = copy.copy(self)
+        image.strips = strips
+        image.__dict__.update(attributes)
+        return image
+
+    def tone_map(self, params=None):
+        """
+        Maps linear HDR values to 8-bit display values with given hdr.tone_map() parameters.
+        """
+        if not self.linear:
+            return self
+        params = {**hdr.DEFAULT_TONE_MAP, **(params or {})}
+        return self._derive((hdr.tone_map(strip, **params) for strip in self.strips), linear=False)
+
+    def convert(self, mode):
+        """
+        Converts the pixels to mode ('L', 'LA', 'RGB' or 'RGBA'), gray values are computed like
+        Pillow does, missing alpha is opaque.
+        """
+        if mode == self.mode:
+            return self
+        return self._derive(
+            (_convert(strip, self.mode, mode, self.linear) for strip in self.strips),
+            mode=mode,
+            metadata=[(type, data) for type, data in self.metadata if type not in PNG_MODE_CHUNKS])
+
+    def reduce(self, factor):
+        """
+        Downscales the image by an integer factor averaging boxes of factor x factor pixels, with
+        premultiplied alpha. Rows and columns not filling a whole box are dropped.
+        """
+        factor = min(factor, self.width, self.height)
+        if factor <= 1:
+            return self
+        return self._derive(
+            _reduce(self.strips, factor, self.mode in ('LA', 'RGBA'), self.linear),
+            width=self.width // factor,
+            height=self.height // factor)
+
+    def strip_metadata(self, keep=PNG_COLOR_CHUNKS):
+        """
+        Drops all metadata (e.g. EXIF data, texts or timestamps) except the chunks of given types,
+        by default the ones needed to display the colors correctly.
+        """
+        return self._derive(self.strips, metadata=[(type, data) for type, data in self.metadata if type in keep])
+
+    def icc_profile(self):
+        """
+        Returns the ICC color profile of the image, or None.
+        """
+        for type, data in self.metadata:
+            if type == b'iCCP':
+                # profile name, null separator, compression method and the compressed profile
+                return zlib.decompress(data[data.index(b'\0') + 2:])
+        return None
+
+    def to_image(self):
+        """
+        Collects the strips into a Pillow image, which should only be done with downscaled images.
+        """
+        if self.linear:
+            raise ValueError('HDR images have to be tone-mapped first.')
+        strips = list(self.strips)
+        pixels = np.concatenate(strips) if strips else np.zeros((self.height, self.width, len(self.mode)), dtype=np.uint8)
+        image = Image.fromarray(pixels[:, :, 0] if self.mode == 'L' else pixels)
+        icc_profile = self.icc_profile()
+        if icc_profile is not None:
+            image.info['icc_profile'] = icc_profile
+        return image
+
+    def save(self, f, format, **params):
+        """
+        Encodes the image into the binary file object f with given Pillow format. PNG and TGA files
+        are written strip by strip, any other format is encoded from the collected image. Further
+        params are passed to the encoder, PNG files only take 'compress_level'.
+        """
+        if self.linear:
+            raise ValueError('HDR images have to be tone-mapped first.')
+        if format == 'PNG':
+            return self._write_png(f, params.get('compress_level', 6))
+        if format == 'TGA':
+            return self._write_tga(f)
+
+        image = self.to_image()
+        if 'icc_profile' in image.info:
+            params.setdefault('icc_profile', image.info['icc_profile'])
+        exif = next((data for type, data in self.metadata if type == b'eXIf'), None)
+        if exif is not None:
+            params.setdefault('exif', EXIF_PREFIX + exif)
+        image.save(f, format, **params)
+
+    def _write_png(self, f, compress_level):
+        f.write(PNG_SIGNATURE)
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, PNG_MODE_COLOR_TYPES[self.mode], 0, 0, 0)))
+        for type, data in self.metadata:
+            f.write(_png_chunk(type, data))
+
+        compressor = zlib.compressobj(compress_level)
+        prior = None
+        for strip in self.strips:
+            rows = np.ascontiguousarray(strip, dtype=np.uint8).reshape(len(strip), -1)
+            data = compressor.compress(_paeth_filter(rows, prior, len(self.mode)))
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+            prior = rows[-1].copy()
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+
+    def _write_tga(self, f):
+        image = self.convert('RGBA') if self.mode == 'LA' else self
+        gray = image.mode == 'L'
+        alpha_bits = 8 if image.mode == 'RGBA' else 0
+        # uncompressed true color or gray image with top-left origin
+        f.write(struct.pack('<BBB5sHHHHBB', 0, 0, 3 if gray else 2, b'', 0, 0, image.width, image.height, 8 * len(image.mode), 0x20 | alpha_bits))
+
+        order = [0] if gray else [2, 1, 0, 3][:len(image.mode)]
+        for strip in image.strips:
+            f.write(np.ascontiguousarray(strip[:, :, order], dtype=np.uint8).tobytes())
+
+
+def _paeth_filter(rows, prior, channels):
+    # filters all rows with the Paeth predictor, which only depends on known pixels when encoding
+    x = rows.astype(np.int16)
+    up = np.empty_like(x)
+    up[0] = prior if prior is not None else 0
+    up[1:] = x[:-1]
+    left = np.zeros_like(x)
+    left[:, channels:] = x[:, :-channels]
+    upleft = np.zeros_like(x)
+    upleft[:, channels:] = up[:, :-channels]
+
+    estimate = left + up - upleft
+    distance_left = np.abs(estimate - left)
+    distance_up = np.abs(estimate - up)
+    distance_upleft = np.abs(estimate - upleft)
+    predictor = np.where(
+        (distance_left <= distance_up) & (distance_left <= distance_upleft), left,
+        np.where(distance_up <= distance_upleft, up, upleft))
+
+    filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = PNG_PAETH_FILTER
+    # differences wrap around modulo 256
+    filtered[:, 1:] = (x - predictor).astype(np.uint8)
+    return filtered
+
+
+def _convert(strip, source, target, linear):
+    opaque = 1.0 if linear else 255
+    color = np.repeat(strip[:, :, :1], 3, axis=2) if source in ('L', 'LA') else strip[:, :, :3]
+    alpha = strip[:, :, -1:] if source in ('LA', 'RGBA') else np.full(strip.shape[:2] + (1,), opaque, dtype=strip.dtype)
+
+    if target in ('L', 'LA'):
+        if source in ('L', 'LA'):
+            color = strip[:, :, :1]
+        else:
+            # ITU-R 601-2 luma, like Pillow
+            gray = color[:, :, 0:1] * 0.299 + color[:, :, 1:2] * 0.587 + color[:, :, 2:3] * 0.114
+            color = gray.astype(np.float32) if linear else np.rint(gray).astype(np.uint8)
+
+    return np.concatenate([color, alpha], axis=2) if target in ('LA', 'RGBA') else np.ascontiguousarray(color)
+
+
+def _box_reduce(block, factor, alpha, linear):
+    rows, columns = block.shape[0] // factor, block.shape[1] // factor
+    block = block[:rows * factor, :columns * factor].astype(np.float32)
+    if alpha:
+        block[:, :, :-1] *= block[:, :, -1:] / (1.0 if linear else 255.0)
+
+    reduced = block.reshape(rows, factor, columns, factor, block.shape[2]).mean(axis=(1, 3), dtype=np.float32)
+    if alpha:
+        coverage = reduced[:, :, -1:] / (1.0 if linear else 255.0)
+        np.divide(reduced[:, :, :-1], coverage, out=reduced[:, :, :-1], where=coverage > 0)
+
+    if linear:
+        return reduced
+    return np.clip(np.rint(reduced), 0, 255).astype(np.uint8)
+
+
+def _reduce(strips, factor, alpha, linear):
+    carry = None
+    for strip in strips:
+        if carry is not None:
+            strip = np.concatenate([carry, strip])
+        # rows not filling a whole box are reduced together with the next strip
+        rows = len(strip) // factor * factor
+        carry = strip[rows:].copy() if rows < len(strip) else None
+        if rows:
+            yield _box_reduce(strip[:rows], factor, alpha, linear)
+
+
+def _strip_rows(width, channels, itemsize=1, strip_bytes=STRIP_BYTES):
+    return max(1, strip_bytes // max(1, width * channels * itemsize))
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated image data.')
+    return data
+
+
+def png_bit_depth(f):
+    """
+    Returns the bits per sample of the PNG image in binary file object f according to its header,
+    or None if f is no PNG. f is read from its current position.
+    """
+    header = f.read(25)
+    if len(header) != 25 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return header[24]
+
+
+def _open_png(f, strip_bytes):
+    # returns None for PNG images which are not decoded strip by strip
+    if f.read(8) != PNG_SIGNATURE:
+        return None
+
+    header = palette = transparency = None
+    metadata = []
+    while True:
+        length, type = struct.unpack('>I4s', _read_exactly(f, 8))
+        if type == b'IDAT':
+            break
+        data = _read_exactly(f, length)
+        f.read(4)
+        if type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', data)
+        elif type == b'PLTE':
+            palette = data
+        elif type == b'tRNS':
+            transparency = data
+        elif type == b'IEND':
+            return None
+        elif type[:1].islower():
+            metadata.append((type, data))
+
+    width, height, depth, color_type, _, _, interlace = header
+    if depth != 8 or interlace or color_type not in PNG_COLOR_TYPES or (transparency is not None and color_type != 3):
+        return None
+
+    channels = PNG_COLOR_TYPES[color_type]
+    if color_type == 3:
+        # palette images are expanded
+        mode = 'RGBA' if transparency is not None else 'RGB'
+        metadata = [(type, data) for type, data in metadata if type not in PNG_MODE_CHUNKS]
+    else:
+        mode = MODES[channels]
+
+    # chunks of the single strip images decoded by Pillow, see _png_strips()
+    palette_chunks = b''
+    if palette is not None:
+        palette_chunks += _png_chunk(b'PLTE', palette)
+    if transparency is not None:
+        palette_chunks += _png_chunk(b'tRNS', transparency)
+
+    rows = _strip_rows(width, 4 if color_type == 3 else channels, strip_bytes=strip_bytes)
+    strips = _png_strips(f, length, width, height, color_type, palette_chunks, mode, rows)
+    return StripImage(width, height, mode, strips, metadata)
+
+
+def _png_strips(f, length, width, height, color_type, palette_chunks, mode, rows):
+    """
+    Yields the strips of the PNG image, whose first IDAT chunk of given length f is positioned at.
+    The image data is inflated strip by strip; the filtered rows of each strip are unfiltered by
+    Pillow, wrapped into an uncompressed PNG image of their own, preceded by the last unfiltered
+    row of the previous strip which the filters of the first row refer to.
+    """
+    stride = width * PNG_COLOR_TYPES[color_type] + 1
+    inflater = zlib.decompressobj()
+    remaining = length
+    done = False
+
+    def read():
+        nonlocal remaining, done
+        while remaining == 0 and not done:
+            f.read(4)
+            length, type = struct.unpack('>I4s', _read_exactly(f, 8))
+            if type == b'IDAT':
+                remaining = length
+            else:
+                done = True
+        if done:
+            return b''
+        data = f.read(min(remaining, READ_CHUNK_SIZE))
+        if not data:
+            raise ValueError('Truncated PNG image data.')
+        remaining -= len(data)
+        return data
+
+    buffer = bytearray()
+    prior = b''
+    top = 0
+    while top < height:
+        count = min(rows, height - top)
+        size = count * stride
+        while len(buffer) < size:
+            data = inflater.unconsumed_tail or read()
+            inflated = inflater.decompress(data, size - len(buffer))
+            if not data and not inflated:
+                raise ValueError('Truncated PNG image data.')
+            buffer += inflated
+
+        # the previous row is stored without filter, so it is taken as it is
+        body = (b'\0' + prior if prior else b'') + bytes(buffer[:size])
+        del buffer[:size]
+        header = struct.pack('>IIBBBBB', width, count + (1 if prior else 0), 8, color_type, 0, 0, 0)
+        png = PNG_SIGNATURE + _png_chunk(b'IHDR', header) + palette_chunks + _png_chunk(b'IDAT', zlib.compress(body, 0)) + _png_chunk(b'IEND', b'')
+
+        with Image.open(BytesIO(png)) as image:
+            raw = np.asarray(image)
+            pixels = np.asarray(image.convert(mode)) if color_type == 3 else raw
+        prior = raw[-1].tobytes()
+        start = 1 if len(pixels) > count else 0
+        yield pixels[start:].reshape(count, width, -1)
+        top += count
+
+
+def _open_tga(f, strip_bytes):
+    # returns None for TGA images which are not decoded strip by strip, e.g. RLE compressed ones
+    header = _read_exactly(f, 18)
+    id_length, color_map_type, image_type = header[0], header[1], header[2]
+    width, height, depth, descriptor = struct.unpack('<HHBB', header[12:18])
+    if color_map_type != 0 or descriptor & 0x10 or (image_type, depth) not in ((2, 24), (2, 32), (3, 8)):
+        return None
+
+    channels = depth // 8
+    offset = 18 + id_length
+    # rows are stored from the bottom up unless the origin is at the top
+    top_down = bool(descriptor & 0x20)
+    order = [0] if channels == 1 else [2, 1, 0, 3][:channels]
+    rows = _strip_rows(width, channels, strip_bytes=strip_bytes)
+
+    def strips():
+        for top in range(0, height, rows):
+            count = min(rows, height - top)
+            first = top if top_down else height - top - count
+            f.seek(offset + first * width * channels)
+            strip = np.frombuffer(_read_exactly(f, count * width * channels), dtype=np.uint8).reshape(count, width, channels)
+            yield strip[:, :, order] if top_down else strip[::-1, :, order]
+
+    return StripImage(width, height, MODES[channels], strips())
+
+
+def _open_pillow(f, max_width, strip_bytes):
+    # Pillow opens 16-bit RGB(A) PNGs as 8-bit images of the same mode, so the depth is read first
+    depth = png_bit_depth(f)
+    f.seek(0)
+    image = Image.open(f)
+    if max_width:
+        # lets the JPEG decoder scale down by a power of two while decoding
+        image.draft('RGB', (max_width, max(1, max_width * image.height // image.width)))
+    # palette and bilevel images are expanded without loss
+    lossless = (image.mode in ('1', 'P') or image.mode in MODES.values()) and (depth is None or depth <= 8)
+    if image.mode == '1':
+        image = image.convert('L')
+    elif image.mode not in MODES.values():
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+    metadata = []
+    if image.info.get('icc_profile'):
+        metadata.append((b'iCCP', b'icc\0\0' + zlib.compress(image.info['icc_profile'])))
+    if image.info.get('exif'):
+        exif = image.info['exif']
+        metadata.append((b'eXIf', exif[len(EXIF_PREFIX):] if exif.startswith(EXIF_PREFIX) else exif))
+
+    pixels = np.asarray(image).reshape(image.height, image.width, -1)
+    rows = _strip_rows(image.width, pixels.shape[2], strip_bytes=strip_bytes)
+    strips = (pixels[top:top + rows] for top in range(0, image.height, rows))
+    return StripImage(image.width, image.height, image.mode, strips, metadata, lossless=lossless)
+
+
+def _closing(strips, f):
+    try:
+        yield from strips
+    finally:
+        f.close()
+
+
+def open_strips(file, format=None, size=None, max_width=None, strip_bytes=STRIP_BYTES):
+    """
+    Opens the image at path file, or binary file object, in given camerafy image format as
+    StripImage. Unknown formats are detected from the file. EXR and raw images must be given by
+    path, raw images require their size. If the image is going to be reduced to about max_width
+    pixels, Pillow decodes JPEGs at reduced scale right away.
+    """
+    if format == 'RAW':
+        if size is None:
+            raise ValueError('The size of raw images has to be given.')
+        width, height = size
+        rows = _strip_rows(width, 4, strip_bytes=strip_bytes)
+        return StripImage(width, height, 'RGBA', hdr.raw_blocks(file, size, rows))
+
+    if format == 'EXR':
+        with open(file, 'rb') as f:
+            header = hdr.read_exr_header(f)
+        channels = 4 if any(name == 'A' for name, _, _, _ in header.channels) else 3
+        rows = _strip_rows(header.width, channels, 4, strip_bytes)
+        return StripImage(header.width, header.height, MODES[channels], hdr.exr_blocks(file, rows), linear=True)
+
+    owned = isinstance(file, str)
+    f = open(file, 'rb') if owned else file
+    try:
+        f.seek(0)
+        image = _open_png(f, strip_bytes) if format in (None, 'PNG') else None
+        if image is None and format == 'TGA':
+            f.seek(0)
+            image = _open_tga(f, strip_bytes)
+        if image is not None:
+            if owned:
+                # the file is read while the strips are consumed
+                image.strips = _closing(image.strips, f)
+                owned = False
+            return image
+
+        f.seek(0)
+        return _open_pillow(f, max_width, strip_bytes)
+    finally:
+        if owned:
+            f.close()
@@ -0,0 +1,192 @@
+"""
+Header-only probing of uploaded images. Only the first bytes of a file are read to learn its real
+format, dimensions and bit depth, so uploads can be validated before anything is decoded or stored.
+"""
+import struct
+
+from . import hdr
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# number of channels of the PNG color types (gray, rgb, palette, gray + alpha, rgba)
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# JPEG start of frame markers, all 0xC0-0xCF markers except DHT, JPG and DAC
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# TGA image types (color mapped, true color, grayscale, each uncompressed and run length encoded)
+TGA_IMAGE_TYPES = {1, 2, 3, 9, 10, 11}
+TGA_PIXEL_DEPTHS = {8, 15, 16, 24, 32}
+# signature at the end of the footer of TGA 2.0 files, TGA 1.0 files have no footer
+TGA_FOOTER_SIGNATURE = b'TRUEVISION-XFILE.\0'
+TGA_FOOTER_SIZE = 26
+TGA_HEADER_SIZE = 18
+
+# bytes per pixel of raw ARGB32 texture data
+RAW_BYTES_PER_PIXEL = 4
+
+
+class ImageProbeError(ValueError):
+    """
+    The probed file is not a valid image of the expected format and size.
+    """
+
+
+class ImageInfo:
+    """
+    Format, dimensions and bits per pixel of a probed image.
+    """
+
+    def __init__(self, format, width, height, bit_depth):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+
+    def __repr__(self):
+        return f"ImageInfo({self.format}, {self.width}x{self.height}, {self.bit_depth} bit)"
+
+
+def _probe_png(f):
+    header = f.read(33)
+    if len(header) < 33 or header[12:16] != b'IHDR':
+        raise ImageProbeError('Truncated PNG header.')
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', header[16:26])
+    return ImageInfo('PNG', width, height, bit_depth * PNG_CHANNELS.get(color_type, 1))
+
+
+def _read_jpeg(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise ImageProbeError('Truncated JPEG header.')
+    return data
+
+
+def _probe_jpeg(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ImageProbeError('JPEG file has no frame header.')
+        # fill bytes may precede a marker
+        while marker[1] == 0xFF:
+            marker = marker[1:] + _read_jpeg(f, 1)
+        if 0xD0 <= marker[1] <= 0xD9 or marker[1] == 0x01:
+            # markers without segment
+            continue
+
+        # the segment length includes its own two bytes
+        length, = struct.unpack('>H', _read_jpeg(f, 2))
+        if length < 2:
+            raise ImageProbeError('Invalid JPEG segment length.')
+        if marker[1] in JPEG_SOF_MARKERS:
+            precision, height, width, components = struct.unpack('>BHHB', _read_jpeg(f, 6))
+            return ImageInfo('JPG', width, height, precision * components)
+        f.seek(length - 2, 1)
+
+
+def _probe_exr(f):
+    try:
+        header = hdr.read_exr_header(f)
+    except (ValueError, KeyError, struct.error) as e:
+        raise ImageProbeError(f"Invalid EXR header: {e}")
+    return ImageInfo('EXR', header.width, header.height, sum(dtype.itemsize * 8 for _, dtype, _, _ in header.channels))
+
+
+def _has_tga_footer(f):
+    size = f.seek(0, 2)
+    if size < TGA_HEADER_SIZE + TGA_FOOTER_SIZE:
+        return False
+    f.seek(size - len(TGA_FOOTER_SIGNATURE))
+    return f.read(len(TGA_FOOTER_SIGNATURE)) == TGA_FOOTER_SIGNATURE
+
+
+def _probe_tga(f):
+    f.seek(0)
+    header = f.read(TGA_HEADER_SIZE)
+    if len(header) < TGA_HEADER_SIZE:
+        raise ImageProbeError('Truncated TGA header.')
+    color_map_type, image_type = header[1], header[2]
+    width, height, pixel_depth = struct.unpack('<HHB', header[12:17])
+    if color_map_type not in (0, 1) or image_type not in TGA_IMAGE_TYPES or pixel_depth not in TGA_PIXEL_DEPTHS:
+        raise ImageProbeError('Invalid TGA header.')
+    return ImageInfo('TGA', width, height, pixel_depth)
+
+
+def probe_image(f, format=None):
+    """
+    Probes the image file object f, reading its header only. The format is detected from the file
+    signature, TGA files are detected from the signature of their TGA 2.0 footer. TGA 1.0 files 
+    have no signature and raw texture data has no header at all, so these are only recognized if
+    given as format. Raw images are returned without dimensions. Raises ImageProbeError if the file
+    is not a supported image.
+    """
+    if format == 'RAW':
+        # any bytes are valid texture data, which might look like a signature by chance
+        return ImageInfo('RAW', None, None, RAW_BYTES_PER_PIXEL * 8)
+
+    f.seek(0)
+    signature = f.read(8)
+    f.seek(0)
+
+    if signature.startswith(PNG_SIGNATURE):
+        return _probe_png(f)
+    if signature.startswith(b'\xff\xd8'):
+        return _probe_jpeg(f)
+    if signature[:4] == struct.pack('<i', hdr.EXR_MAGIC):
+        return _probe_exr(f)
+    if format == 'TGA' or _has_tga_footer(f):
+        return _probe_tga(f)
+
+    raise ImageProbeError("Unknown image format, TGA images without TGA 2.0 footer require 'format'.")
+
+
+def _probe_file(file, format):
+    # files handed over by path (e.g. completed chunked uploads) are not opened
+    if getattr(file, 'file', None) is None and hasattr(file, 'temporary_file_path'):
+        with open(file.temporary_file_path(), 'rb') as f:
+            return probe_image(f, format)
+
+    try:
+        return probe_image(file, format)
+    finally:
+        file.seek(0)
+
+
+def validate_image(file, format=None, width=None, height=None, max_size=None):
+    """
+    Probes an uploaded image file and checks it against the format and dimensions announced by the
+    client, which are all optional except for raw images and the format of TGA 1.0 images, see
+    probe_image(). Images wider or higher than max_size are rejected. Returns the ImageInfo of the file, raises ImageProbeError if validation fails.
+    """
+    format = format.upper() if format else None
+    width = int(width) if width not in (None, '') else None
+    height = int(height) if height not in (None, '') else None
+
+    info = _probe_file(file, format)
+
+    if format is not None and info.format != format:
+        raise ImageProbeError(f"File is a {info.format} image, not {format}.")
+
+    if info.format == 'RAW':
+        if width is None or height is None:
+            raise ImageProbeError("Raw images require 'width' and 'height'.")
+        if file.size != width * height * RAW_BYTES_PER_PIXEL:
+            raise ImageProbeError(f"Raw image data of {file.size} bytes does not match a {width}x{height} ARGB32 image.")
+        info.width, info.height = width, height
+
+    if (width is not None and width != info.width) or (height is not None and height != info.height):
+        if height is None:
+            expected = f"{width} pixels wide"
+        elif width is None:
+            expected = f"{height} pixels high"
+        else:
+            expected = f"{width}x{height}"
+        raise ImageProbeError(f"Image is {info.width}x{info.height}, not {expected}.")
+
+    if info.width < 1 or info.height < 1:
+        raise ImageProbeError('Image has no pixels.')
+    if max_size is not None and (info.width > max_size or info.height > max_size):
+        raise ImageProbeError(f"Image is {info.width}x{info.height}, exceeding the maximum size of {max_size}x{max_size}.")
+
+    return info
@@ -0,0 +1,117 @@
+import base64
+import os
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework import serializers
+
+from ..storage import is_local, open_media
+
+
+class EncodedThumbnailCache:
+    """
+    Size bounded LRU cache of base64 encoded thumbnail images shared by all thumbnail serializers.
+    Entries of local files are keyed by path and modification time, so a replaced file is never
+    served from the cache. Remote storages never overwrite a name, their entries are keyed by name
+    alone to save a request per thumbnail.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # statistics
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, file):
+        """
+        Returns the base64 encoded content of the given image field file.
+        """
+        if is_local(file.storage):
+            path = file.path
+            key = (path, os.stat(path).st_mtime_ns)
+        else:
+            key = (file.name, None)
+
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return encoded
+            self._misses += 1
+
+        with open_media(file) as f:
+            encoded = base64.b64encode(f.read())
+
+        if len(encoded) > self.max_bytes:
+            return encoded
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._bytes += len(encoded)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._evictions += 1
+
+        return encoded
+
+    def stats(self):
+        """
+        Returns the cache's hit, miss and eviction counters and its current size.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
+
+
+thumbnail_cache = EncodedThumbnailCache(settings.CAMERAFY_THUMBNAIL_CACHE_BYTES)
+
+
+class Base64ThumbnailSerializer(serializers.ModelSerializer):
+    """
+    Base class of all thumbnail serializers, embedding the image as base64 encoded string.
+    """
+
+    base64_image = serializers.SerializerMethodField()
+
+    def get_base64_image(self, obj):
+        """
+        Transform raw image file to base64 encoded string.
+        """
+        return thumbnail_cache.get(obj.image)
+
+
+class EmbeddedThumbnailMixin:
+    """
+    Serializes the 'thumbnail' field only if requested with '?embed=thumbnail', so listings which
+    do not render images skip reading the thumbnail files entirely. Serializers can declare further
+    optional fields in embedded_fields, keyed by the 'embed' value requesting them. Only used by
+    the snapshot serializer, environments and models always include their thumbnail.
+    """
+
+    embedded_fields = {'thumbnail': ['thumbnail']}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        request = self.context.get('request')
+        if request is not None:
+            embed = request.query_params.get('embed', '').split(',')
+            for key, fields in self.embedded_fields.items():
+                if key not in embed:
+                    for field in fields:
+                        self.fields.pop(field, None)
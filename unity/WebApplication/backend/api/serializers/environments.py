@@ -1,18 +1,10 @@
 from rest_framework import serializers
 
-from ..models import environments
-
-class EnvironmentThumbnailSerializer(serializers.ModelSerializer):
+from .common import Base64ThumbnailSerializer
 
-    base64_image = serializers.SerializerMethodField()
+from ..models import environments
 
-    def get_base64_image(self, obj):
-        """
-        Transform raw image file to base64 encoded string.
-        """
-        with open(obj.image.path, 'rb') as f:
-            image = File(f)
-            return base64.b64encode(image.read())
+class EnvironmentThumbnailSerializer(Base64ThumbnailSerializer):
 
     class Meta:
         model = environments.EnvironmentThumbnail
@@ -1,33 +1,68 @@
-import base64
-from django.core.files import File
 from rest_framework import serializers
 
-from ..models import snapshots
-
-class CamerafySnapshotThumbnailSerializer(serializers.ModelSerializer):
+from .common import Base64ThumbnailSerializer, EmbeddedThumbnailMixin
 
-    base64_image = serializers.SerializerMethodField()
+from .. import similarity
+from ..models import snapshots
+from ..signing import signed_media_url
 
-    def get_base64_image(self, obj):
-        """
-        Transform raw image file to base64 encoded string.
-        """
-        with open(obj.image.path, 'rb') as f:
-            image = File(f)
-            return base64.b64encode(image.read())
+class CamerafySnapshotThumbnailSerializer(Base64ThumbnailSerializer):
 
     class Meta:
         model = snapshots.CamerafySnapshotThumbnail
         fields = [
+            'id',
             'format', 
             'width',
             'height',
             'base64_image'
         ]
 
-class CamerafySnapshotSerializer(serializers.ModelSerializer):
+class CamerafySnapshotSerializer(EmbeddedThumbnailMixin, serializers.ModelSerializer):
     
-    thumbnail = CamerafySnapshotThumbnailSerializer(many=False)
+    # '?embed=url' adds expiring signed URLs of the image and thumbnail, see backend.api.signing
+    embedded_fields = {**EmbeddedThumbnailMixin.embedded_fields, 'url': ['url', 'thumbnail_url']}
+
+    thumbnail = serializers.SerializerMethodField()
+    url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    phash = serializers.SerializerMethodField()
+
+    def requested_thumbnail(self, obj):
+        """
+        Returns the default thumbnail, or the closest available size if the request asks for a
+        specific width with '?thumbnail_width=<width>'.
+        """
+        request = self.context.get('request')
+        width = request.query_params.get('thumbnail_width') if request is not None else None
+        return obj.closest_thumbnail(int(width)) if width is not None and width.isdigit() else obj.thumbnail
+
+    def get_thumbnail(self, obj):
+        thumbnail = self.requested_thumbnail(obj)
+        return CamerafySnapshotThumbnailSerializer(thumbnail).data if thumbnail is not None else None
+
+    def get_url(self, obj):
+        """
+        Signed URL of the image in its upload format, cold snapshots are restored when fetched.
+        """
+        request = self.context.get('request')
+        if request is None:
+            return None
+        format = obj.format if obj.tier == snapshots.CamerafySnapshot.TIER_COLD else None
+        return signed_media_url(obj.image.name, request.user.id, format, request)
+
+    def get_thumbnail_url(self, obj):
+        request = self.context.get('request')
+        thumbnail = self.requested_thumbnail(obj)
+        if request is None or thumbnail is None:
+            return None
+        return signed_media_url(thumbnail.image.name, request.user.id, request=request)
+
+    def get_phash(self, obj):
+        """
+        Serializes the perceptual hash as 16 digit hex string, JSON numbers cannot hold 64 bits.
+        """
+        return f"{similarity.to_unsigned(obj.phash):016x}" if obj.phash is not None else None
 
     class Meta:
         model = snapshots.CamerafySnapshot
@@ -36,10 +71,21 @@ class CamerafySnapshotSerializer(serializers.ModelSerializer):
             'title', 
             'description',
             'thumbnail',
+            'url',
+            'thumbnail_url',
+            'thumbnail_status',
             'created', 
             'format', 
             'width',
             'height',
             'size',
-            'seen'
-        ]
\ No newline at end of file
+            'seen',
+            'phash'
+        ]
+
+class SnapshotIdsSerializer(serializers.Serializer):
+    """
+    Validates the snapshot ids of bulk operations, given as JSON list or repeated form field.
+    """
+
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1))
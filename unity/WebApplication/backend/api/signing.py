@@ -0,0 +1,130 @@
+"""
+Expiring signed media URLs. A signed URL grants access to a single media file until it expires, so
+media can be served without running the API's permission checks, loading the user or touching the
+database, e.g. by the front web server, a CDN edge or the light-weight signed_media view.
+
+The signature is the unpadded urlsafe base64 HMAC-SHA256 of '<name>|<format>|<user>|<expires>'
+keyed with CAMERAFY_MEDIA_SIGNING_KEY, where name is the storage name of the file, format the
+upload format a cold snapshot is restored to (empty for files served as stored), user the id of
+the user the URL was issued to and expires a unix timestamp. Expiry timestamps are rounded up to
+CAMERAFY_SIGNED_URL_GRANULARITY, so the URL of a file stays the same for a while and can be cached.
+
+Event stream tokens are signed the same way, they authenticate a single user's event stream
+connection for CAMERAFY_STREAM_TOKEN_TTL seconds and are given as query parameter by EventSource
+clients, which cannot send the API token in a header.
+"""
+import base64
+import hashlib
+import hmac
+import time
+
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+
+
+class InvalidSignature(ValueError):
+    """
+    A signed media URL or event stream token is malformed, forged or expired.
+    """
+
+
+def signing_key():
+    """
+    Returns the key media URLs are signed with, derived from SECRET_KEY if not configured.
+    """
+    key = settings.CAMERAFY_MEDIA_SIGNING_KEY
+    if key is None:
+        key = hashlib.sha256(f"camerafy-media-url|{settings.SECRET_KEY}".encode()).hexdigest()
+    return key.encode()
+
+
+def media_signature(name, format, user_id, expires):
+    """
+    Returns the signature of a media URL, see the module documentation.
+    """
+    return _signature(f"{name}|{format or ''}|{user_id}|{expires}")
+
+
+def _signature(message):
+    digest = hmac.new(signing_key(), message.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def _verify(signature, expected, expires, now, kind):
+    if not hmac.compare_digest(signature.encode(), expected.encode()):
+        raise InvalidSignature('Invalid signature.')
+    if expires < (time.time() if now is None else now):
+        raise InvalidSignature(f"{kind} has expired.")
+
+
+def expiry(now=None):
+    """
+    Returns the expiry timestamp of a URL signed now, at least CAMERAFY_SIGNED_URL_TTL seconds ahead.
+    """
+    now = time.time() if now is None else now
+    granularity = settings.CAMERAFY_SIGNED_URL_GRANULARITY
+    return -(-int(now + settings.CAMERAFY_SIGNED_URL_TTL) // granularity) * granularity
+
+
+def signed_media_url(name, user_id, format=None, request=None):
+    """
+    Returns the signed URL of the media file with given storage name, issued to user_id. Cold
+    snapshots are restored to format when requested. The URL is absolute if request is given.
+    """
+    expires = expiry()
+    params = {'user': user_id, 'expires': expires}
+    if format:
+        params['format'] = format
+    params['signature'] = media_signature(name, format, user_id, expires)
+
+    url = f"{settings.CAMERAFY_SIGNED_MEDIA_URL}{quote(name)}?{urlencode(params)}"
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def verify_media_url(name, params, now=None):
+    """
+    Verifies the query parameters of a signed URL of the media file with given storage name.
+    Returns the tuple (format, expires), raises InvalidSignature if the URL is not valid (anymore).
+    """
+    try:
+        user_id = params['user']
+        expires = int(params['expires'])
+        format = params.get('format') or None
+        signature = params['signature']
+    except (KeyError, ValueError):
+        raise InvalidSignature('Incomplete signed URL.')
+
+    _verify(signature, media_signature(name, format, user_id, expires), expires, now, 'Signed URL')
+    return format, expires
+
+
+def stream_token_signature(user_id, expires):
+    """
+    Returns the signature of an event stream token, the message differs from any media URL's.
+    """
+    return _signature(f"event-stream|{user_id}|{expires}")
+
+
+def stream_token(user_id, now=None):
+    """
+    Returns a token authenticating the event stream of user_id for CAMERAFY_STREAM_TOKEN_TTL seconds
+    as '<user>.<expires>.<signature>', together with its expiry timestamp.
+    """
+    expires = int(time.time() if now is None else now) + settings.CAMERAFY_STREAM_TOKEN_TTL
+    return f"{user_id}.{expires}.{stream_token_signature(user_id, expires)}", expires
+
+
+def verify_stream_token(token, now=None):
+    """
+    Returns the id of the user an event stream token was issued to, raises InvalidSignature if the
+    token is not valid (anymore).
+    """
+    try:
+        user_id, expires, signature = token.split('.')
+        user_id, expires = int(user_id), int(expires)
+    except ValueError:
+        raise InvalidSignature('Malformed stream token.')
+
+    _verify(signature, stream_token_signature(user_id, expires), expires, now, 'Stream token')
+    return user_id
@@ -0,0 +1,58 @@
+"""
+Near-duplicate search over the 64 bit perceptual hashes of snapshots, see
+imaging.difference_hash(). The hashes of a user's snapshots are packed into a numpy array and
+compared to the query hash in a single vectorized XOR and popcount, which is fast enough for
+libraries of hundreds of thousands of snapshots without maintaining an index.
+"""
+import numpy as np
+
+HASH_BITS = 64
+
+# number of set bits of each byte value, for numpy versions without bitwise_count()
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def to_signed(hash):
+    """
+    Returns an unsigned 64 bit hash as signed integer, as it is stored in a BigIntegerField.
+    """
+    return hash - (1 << HASH_BITS) if hash >= 1 << (HASH_BITS - 1) else hash
+
+
+def to_unsigned(hash):
+    """
+    Returns a stored signed 64 bit hash as unsigned integer.
+    """
+    return hash + (1 << HASH_BITS) if hash < 0 else hash
+
+
+def pack_hashes(hashes):
+    """
+    Returns the stored (signed) hashes as numpy uint64 array.
+    """
+    return np.asarray(hashes, dtype=np.int64).view(np.uint64)
+
+
+def hamming_distances(hashes, hash):
+    """
+    Returns the Hamming distances of all hashes of the packed uint64 array to the given hash.
+    """
+    diff = hashes ^ np.uint64(to_unsigned(hash))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(diff)
+    return _POPCOUNT_TABLE[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def nearest(ids, hashes, hash, max_distance):
+    """
+    Returns the (id, distance) of all hashes within max_distance of hash, closest first. The ids
+    and stored hashes are given as sequences of equal length.
+    """
+    if not len(ids):
+        return []
+
+    ids = np.asarray(ids)
+    distances = hamming_distances(pack_hashes(hashes), hash)
+    matches = np.flatnonzero(distances <= max_distance)
+    matches = matches[np.argsort(distances[matches], kind='stable')]
+    return [(int(ids[i]), int(distances[i])) for i in matches]
@@ -0,0 +1,514 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import Storage, default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+from .cache import DiskLRUCache, LocalMediaFile
+from .models.storage import MediaBlob
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+# size of the chunks media files are copied with
+MEDIA_COPY_CHUNK_SIZE = 1024 * 1024
+
+# smallest part size S3 accepts for multipart uploads, except for the last part
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def is_local(storage):
+    """
+    Returns whether a storage keeps its files on the local file system, i.e. supports path().
+    """
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+class S3File(File):
+    """
+    A file of an S3 storage opened for reading, its content is streamed from the object store.
+    """
+
+    def __init__(self, name, response):
+        super().__init__(response['Body'], name)
+        self.mode = 'rb'
+        self.size = response['ContentLength']
+        self.last_modified = response['LastModified']
+
+
+@deconstructible
+class S3Storage(Storage):
+    """
+    Storage keeping files as objects of a bucket of an S3 compatible object store, configured by
+    CAMERAFY_S3_STORAGE, whose values can be overridden by keyword arguments. Large files are
+    uploaded and downloaded in parallel parts by a thread pool; the client, and with it its
+    connection pool, is shared by all threads, so small reads do not connect again. Like the file
+    system storage, existing names are never overwritten.
+    """
+
+    def __init__(self, **options):
+        if boto3 is None:
+            raise ImproperlyConfigured('The S3 media storage requires boto3.')
+        self.options = {**settings.CAMERAFY_S3_STORAGE, **options}
+        self.bucket = self.options['bucket']
+        self.location = self.options.get('location', '').strip('/')
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.options['multipart_threshold'],
+            multipart_chunksize=max(self.options['multipart_chunk_size'], S3_MIN_PART_SIZE),
+            max_concurrency=self.options['max_workers'],
+            use_threads=True)
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # clients are thread safe, sessions are not, so the client is created once under a lock
+        with self._lock:
+            if self._client is None:
+                self._client = boto3.session.Session().client(
+                    's3',
+                    endpoint_url=self.options.get('endpoint_url'),
+                    region_name=self.options.get('region_name'),
+                    aws_access_key_id=self.options.get('access_key'),
+                    aws_secret_access_key=self.options.get('secret_key'),
+                    config=Config(max_pool_connections=self.options['max_connections']))
+        return self._client
+
+    def key(self, name):
+        """
+        Returns the object key of the file with given storage name.
+        """
+        name = name.replace('\\', '/').lstrip('/')
+        return f"{self.location}/{name}" if self.location else name
+
+    def _not_found(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(name)
+            raise
+
+    def _open(self, name, mode='rb'):
+        return self.open_range(name, mode=mode)
+
+    def open_range(self, name, start=0, end=None, mode='rb'):
+        """
+        Opens the file for reading its inclusive byte range [start, end], all of it by default.
+        """
+        if 'r' not in mode or '+' in mode:
+            raise ValueError(f"Files of the S3 storage cannot be opened in mode '{mode}'.")
+
+        params = {'Bucket': self.bucket, 'Key': self.key(name)}
+        if end is not None and end < start:
+            # an empty range of an empty file
+            end = None
+        if start or end is not None:
+            params['Range'] = f"bytes={start}-{end if end is not None else ''}"
+        try:
+            return S3File(name, self.client.get_object(**params))
+        except ClientError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(name)
+            raise
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        # uploads parts of large files in parallel, small files are put in a single request
+        self.client.upload_fileobj(
+            content, self.bucket, self.key(name), ExtraArgs={'ContentType': content_type}, Config=self.transfer_config)
+        return name
+
+    def download(self, name, f):
+        """
+        Writes the content of the file into the binary file object f, large files are downloaded
+        in parallel ranges.
+        """
+        try:
+            self.client.download_fileobj(self.bucket, self.key(name), f, Config=self.transfer_config)
+        except ClientError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(name)
+            raise
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def exists(self, name):
+        try:
+            self._head(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stat(self, name):
+        """
+        Returns the size and the modification timestamp of the file with a single request.
+        """
+        head = self._head(name)
+        return head['ContentLength'], head['LastModified'].timestamp()
+
+    def size(self, name):
+        return self._head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        modified = self._head(name)['LastModified']
+        return modified if settings.USE_TZ else timezone.make_naive(modified)
+
+    def url(self, name):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=settings.CAMERAFY_SIGNED_URL_TTL)
+
+    def scan(self, prefix=''):
+        """
+        Yields the (name, size, modification timestamp) of all files whose name starts with prefix.
+        """
+        strip = len(self.key(''))
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.key(prefix)):
+            for entry in page.get('Contents', []):
+                yield entry['Key'][strip:], entry['Size'], entry['LastModified'].timestamp()
+
+    def listdir(self, path):
+        prefix = self.key(path).rstrip('/')
+        prefix = f"{prefix}/" if prefix else ''
+        directories, files = [], []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            directories += [p['Prefix'][len(prefix):].rstrip('/') for p in page.get('CommonPrefixes', [])]
+            files += [entry['Key'][len(prefix):] for entry in page.get('Contents', [])]
+        return directories, files
+
+
+class _RollbackGuard:
+    """
+    Calls callback(*args) once the current transaction has been rolled back. The guard is only
+    referenced by its on_commit hook, which django drops on rollback.
+    """
+
+    def __init__(self, callback, *args):
+        self._finalizer = weakref.finalize(self, callback, *args)
+        # a process exiting with the transaction still open is left to sweep_media_orphans
+        self._finalizer.atexit = False
+        transaction.on_commit(self._committed)
+
+    def _committed(self):
+        self._finalizer.detach()
+
+
+@deconstructible
+class ContentAddressedStorage(Storage):
+    """
+    Storage naming files by the SHA-256 hash of their content. Blobs are fanned out into hashed
+    subdirectories, e.g. 'blobs/ab/cd/abcd...ef.png', and are reference counted so identical files
+    are stored only once. A blob is removed when its last reference is deleted. Files not
+    registered as blob (e.g. stored before this storage was used) are deleted right away. The files
+    are kept by the backend storage, the project's default storage unless given.
+    """
+
+    def __init__(self, prefix='blobs', fanout=2, depth=2, backend=None):
+        self.prefix = prefix
+        self.fanout = fanout
+        self.depth = depth
+        self._backend = backend
+
+    @property
+    def backend(self):
+        return self._backend if self._backend is not None else default_storage
+
+    def blob_name(self, digest, extension):
+        """
+        Returns the storage name of a blob with given content hash.
+        """
+        parts = [digest[i * self.fanout:(i + 1) * self.fanout] for i in range(self.depth)]
+        return '/'.join([self.prefix, *parts, f"{digest}{extension}"])
+
+    def get_available_name(self, name, max_length=None):
+        # names are derived from the file content, so there is nothing to make unique
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()
+
+        if hasattr(content, 'temporary_file_path'):
+            # the file is already on disk, only hash it unless the hash is known already
+            content_hash = getattr(content, 'content_hash', None)
+            if content_hash is None:
+                digest = hashlib.sha256()
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                content_hash = digest.hexdigest()
+            return self._store_blob(self.blob_name(content_hash, extension), content.temporary_file_path(), content.size)
+
+        # stream content into a staging file while hashing it, next to the blobs if these are local
+        # so it is moved in place without copying
+        staging = self.backend.path(f"{self.prefix}/staging") if is_local(self.backend) else None
+        if staging is not None:
+            os.makedirs(staging, exist_ok=True)
+        fd, staging_path = tempfile.mkstemp(dir=staging)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            return self._store_blob(self.blob_name(digest.hexdigest(), extension), staging_path, size)
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+
+    def _store_blob(self, name, source_path, size):
+        with transaction.atomic():
+            MediaBlob.objects.acquire(name, size)
+
+            if is_local(self.backend):
+                full_path = self.backend.path(name)
+                stored = not os.path.exists(full_path)
+                if stored:
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    file_move_safe(source_path, full_path)
+                    if self.backend.file_permissions_mode is not None:
+                        os.chmod(full_path, self.backend.file_permissions_mode)
+            else:
+                stored = not self.backend.exists(name)
+                if stored:
+                    with open(source_path, 'rb') as f:
+                        self.backend.save(name, File(f, name))
+                    # stored files are usually read right away, e.g. to create thumbnails
+                    media_cache.put(name, lambda out: _copy_file(source_path, out), os.path.splitext(name)[1])
+
+            if stored:
+                # the file is stored right away so it can be read before the commit, it is removed
+                # again if the transaction registering it is rolled back
+                _RollbackGuard(media_sweeper.discard, self, [name])
+
+        return name
+
+    def discard_unreferenced(self, name):
+        """
+        Deletes the blob with given name unless it is referenced, e.g. after the transaction
+        storing it has been rolled back. Returns whether the blob has been deleted.
+        """
+        with transaction.atomic():
+            # a reference registered by a concurrent transaction is waited for, see delete_orphan()
+            MediaBlob.objects.acquire(name, 0)
+            if not MediaBlob.objects.release(name):
+                return False
+            self.backend.delete(name)
+        return True
+
+    def delete(self, name):
+        with transaction.atomic():
+            released = MediaBlob.objects.release(name)
+            # remove the file if it is no longer referenced or not managed as a blob
+            if released is not False:
+                self.backend.delete(name)
+
+    def _open(self, name, mode='rb'):
+        return self.backend.open(name, mode)
+
+    def path(self, name):
+        return self.backend.path(name)
+
+    def exists(self, name):
+        return self.backend.exists(name)
+
+    def size(self, name):
+        return self.backend.size(name)
+
+    def url(self, name):
+        return self.backend.url(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def get_accessed_time(self, name):
+        return self.backend.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.backend.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.backend.get_modified_time(name)
+
+
+snapshot_storage = ContentAddressedStorage()
+
+# local copies of the files of remote storages
+media_cache = DiskLRUCache(settings.CAMERAFY_MEDIA_CACHE_DIR, settings.CAMERAFY_MEDIA_CACHE_BYTES, media_root=settings.MEDIA_ROOT)
+
+
+def _copy_file(path, f):
+    with open(path, 'rb') as source:
+        shutil.copyfileobj(source, f, MEDIA_COPY_CHUNK_SIZE)
+
+
+class StoredFile:
+    """
+    A file of a storage known by its name only, e.g. from a signed URL. Provides the same
+    attributes as the files of model fields.
+    """
+
+    def __init__(self, name, storage=snapshot_storage):
+        self.name = name
+        self.storage = storage
+
+    @property
+    def path(self):
+        return self.storage.path(self.name)
+
+    def open(self, mode='rb'):
+        return self.storage.open(self.name, mode)
+
+
+def _remote_storage(file):
+    # the storage actually transferring the file, None for local files
+    if isinstance(file, LocalMediaFile) or is_local(file.storage):
+        return None
+    return getattr(file.storage, 'backend', file.storage)
+
+
+def local_file(file):
+    """
+    Returns a stored file (of a model field, StoredFile or LocalMediaFile) as LocalMediaFile, e.g.
+    to decode it. Files of remote storages are downloaded into the media cache first.
+    """
+    storage = _remote_storage(file)
+    if storage is None:
+        return file if isinstance(file, LocalMediaFile) else LocalMediaFile(file.name, file.storage.path(file.name))
+
+    extension = os.path.splitext(file.name)[1]
+    cached = media_cache.get(file.name, extension)
+    if cached is None:
+        if hasattr(storage, 'download'):
+            cached = media_cache.put(file.name, lambda f: storage.download(file.name, f), extension)
+        else:
+            def copy(f):
+                with storage.open(file.name, 'rb') as source:
+                    shutil.copyfileobj(source, f, MEDIA_COPY_CHUNK_SIZE)
+            cached = media_cache.put(file.name, copy, extension)
+    return cached
+
+
+def media_stat(file):
+    """
+    Returns the size and the modification timestamp of a stored file. Raises FileNotFoundError if
+    it does not exist.
+    """
+    storage = _remote_storage(file)
+    if storage is None:
+        stat = os.stat(file.path)
+        return stat.st_size, stat.st_mtime
+    if hasattr(storage, 'stat'):
+        return storage.stat(file.name)
+    return storage.size(file.name), storage.get_modified_time(file.name).timestamp()
+
+
+def open_media(file, start=0, end=None):
+    """
+    Opens a stored file for binary reading, positioned at byte start. Remote files are only
+    transferred up to byte end (inclusive) if given. Raises FileNotFoundError if it does not exist.
+    """
+    storage = _remote_storage(file)
+    if storage is None:
+        f = File(open(file.path, 'rb'), file.name)
+    elif hasattr(storage, 'open_range'):
+        return storage.open_range(file.name, start, end)
+    else:
+        f = storage.open(file.name, 'rb')
+    f.seek(start)
+    return f
+
+
+class MediaSweeper:
+    """
+    Deletes media files in a background thread, so requests removing many files return right away.
+    Files are only handed over once the transaction deleting their database rows has been committed,
+    a rolled back deletion therefore never removes any file.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, storage, names):
+        """
+        Schedules removal of the files with given storage names once the current transaction has
+        been committed.
+        """
+        names = [name for name in names if name]
+        if names:
+            transaction.on_commit(lambda: self.call(storage.delete, names))
+
+    def discard(self, storage, names):
+        """
+        Removes the blobs with given storage names in the background right away, unless they are
+        referenced, see ContentAddressedStorage.discard_unreferenced().
+        """
+        self.call(storage.discard_unreferenced, names)
+
+    def call(self, delete, names):
+        """
+        Calls delete(name) for each of the names in the background right away.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='media-sweeper', daemon=True)
+                self._thread.start()
+        self._queue.put((delete, names))
+
+    def _run(self):
+        while True:
+            delete, names = self._queue.get()
+            try:
+                for name in names:
+                    try:
+                        delete(name)
+                    except Exception:
+                        logger.exception(f"Failed to delete media file '{name}'.")
+            finally:
+                # this is not a request thread, so django will not clean up the connection for us
+                connection.close()
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Blocks until all scheduled files have been removed.
+        """
+        self._queue.join()
+
+
+media_sweeper = MediaSweeper()
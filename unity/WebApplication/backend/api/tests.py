@@ -1,3 +1,1511 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
-# Create your tests here.
+from io import BytesIO, StringIO
+from urllib.parse import parse_qs, urlsplit
+from unittest import mock, skipIf
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.db import models, transaction
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+
+import numpy as np
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+from PIL import Image
+
+from . import events, imaging, orphans, pipeline, similarity, tiering
+from .asgi import EventStreamMiddleware
+from .cache import DiskLRUCache, LocalMediaFile
+from .models import snapshots as snapshotModels
+from .models.events import CamerafyEvent
+from .models.storage import MediaBlob
+from .probing import ImageProbeError, validate_image
+from .serializers import camfymodels as camfymodelSerializers
+from .serializers import environments as environmentSerializers
+from .serializers import snapshots as snapshotSerializers
+from .signing import InvalidSignature, expiry, media_signature, signed_media_url, stream_token, verify_media_url, verify_stream_token
+from .storage import ContentAddressedStorage, S3Storage, StoredFile, local_file, media_cache, media_stat, media_sweeper, open_media
+from .thumbnails import ThumbnailWorkerPool, store_snapshot_thumbnails, thumbnail_pool
+from .uploads import upload_writer
+from .views import snapshots as snapshotViews
+from .views import uploads as uploadViews
+from .views.media import media_response, parse_range_header
+
+
+class TempMediaMixin:
+    """
+    Provides a temporary directory removed after each test, which is used as media directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.directory, CAMERAFY_UPLOAD_DIR=os.path.join(self.directory, 'uploads'))
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def _fixture_teardown(self):
+        # the blobs stored by a TestCase are discarded by the media sweeper once its transaction is
+        # rolled back, they are removed with the temporary directory instead of writing to the
+        # database from the sweeper thread while the test class' transaction is still open
+        with mock.patch.object(media_sweeper, 'call'):
+            super()._fixture_teardown()
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return LocalMediaFile(name, path)
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+
+    def test_missing_header(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('', 100))
+
+    def test_range(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range_header('bytes=10-10', 100), (10, 10))
+
+    def test_end_is_clamped_to_size(self):
+        self.assertEqual(parse_range_header('bytes=90-200', 100), (90, 99))
+
+    def test_open_ended_range(self):
+        self.assertEqual(parse_range_header('bytes=40-', 100), (40, 99))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range_header('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=-500', 100), (0, 99))
+
+    def test_unsupported_ranges_send_whole_file(self):
+        self.assertIsNone(parse_range_header('bytes=0-9,20-29', 100))
+        self.assertIsNone(parse_range_header('bytes=-', 100))
+        self.assertIsNone(parse_range_header('items=0-9', 100))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=100-', 'bytes=100-200', 'bytes=20-10', 'bytes=-0'):
+            with self.subTest(header=header):
+                with self.assertRaises(ValueError):
+                    parse_range_header(header, 100)
+
+
+@override_settings(CAMERAFY_MEDIA_SENDFILE=None)
+class MediaResponseTests(TempMediaMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 4
+        self.file = self.write_file('snapshot.png', self.content)
+
+    def get(self, **headers):
+        return media_response(RequestFactory().get('/', **headers), self.file, 'image/png')
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_partial_content(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], f"bytes 10-19/{len(self.content)}")
+        self.assertEqual(response['Content-Length'], '10')
+
+    def test_suffix_partial_content(self):
+        response = self.get(HTTP_RANGE='bytes=-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[-4:])
+
+    def test_open_ended_partial_content(self):
+        response = self.get(HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[1000:])
+
+    def test_multiple_ranges_send_whole_file(self):
+        response = self.get(HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE=f"bytes={len(self.content)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f"bytes */{len(self.content)}")
+
+    def test_not_modified(self):
+        last_modified = self.get()['Last-Modified']
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+
+class ThumbnailTests(TempMediaMixin, SimpleTestCase):
+
+    def test_thumbnail_pyramid(self):
+        path = os.path.join(self.directory, 'snapshot.png')
+        Image.new('RGB', (1000, 500), (200, 10, 10)).save(path)
+
+        thumbnails = imaging.create_thumbnails(path, [160, 320, 640], 'PNG', 'PNG')
+        self.assertEqual([(width, height) for width, height, _ in thumbnails], [(160, 80), (320, 160), (640, 320)])
+        for width, height, data in thumbnails:
+            with Image.open(BytesIO(data)) as image:
+                self.assertEqual(image.size, (width, height))
+                self.assertEqual(image.getpixel((0, 0)), (200, 10, 10))
+
+    def test_thumbnails_are_never_enlarged(self):
+        path = os.path.join(self.directory, 'snapshot.jpg')
+        Image.new('RGB', (100, 50)).save(path)
+
+        thumbnails = imaging.create_thumbnails(path, [160, 320], 'JPG', 'JPG')
+        self.assertEqual([(width, height) for width, height, _ in thumbnails], [(100, 50)])
+
+    def test_image_hash(self):
+        path = os.path.join(self.directory, 'gradient.jpg')
+        # brightens from left to right
+        gradient = Image.linear_gradient('L').rotate(90).resize((1200, 900))
+        gradient.save(path)
+        self.assertEqual(imaging.image_hash(path, 'JPG'), 0)
+        gradient.transpose(Image.FLIP_LEFT_RIGHT).save(path)
+        self.assertEqual(imaging.image_hash(path, 'JPG'), 2 ** 64 - 1)
+
+
+def png_bytes(size, color):
+    data = BytesIO()
+    Image.new('RGB', size, color).save(data, 'PNG')
+    return data.getvalue()
+
+
+class ValidateImageTests(SimpleTestCase):
+
+    def upload(self, size=(401, 300)):
+        return SimpleUploadedFile('snapshot.png', png_bytes(size, (0, 0, 0)), 'image/png')
+
+    def test_matching_dimensions(self):
+        info = validate_image(self.upload(), 'png', '401', 300)
+        self.assertEqual((info.format, info.width, info.height), ('PNG', 401, 300))
+        self.assertEqual(validate_image(self.upload(), width=401).width, 401)
+
+    def test_mismatching_dimensions(self):
+        for width, height, message in [
+                (400, 300, "Image is 401x300, not 400x300."),
+                (400, None, "Image is 401x300, not 400 pixels wide."),
+                (None, 200, "Image is 401x300, not 200 pixels high.")]:
+            with self.subTest(width=width, height=height):
+                with self.assertRaisesMessage(ImageProbeError, message):
+                    validate_image(self.upload(), width=width, height=height)
+
+    def test_format_mismatch(self):
+        with self.assertRaisesMessage(ImageProbeError, "File is a PNG image, not JPG."):
+            validate_image(self.upload(), 'JPG')
+
+    def test_truncated_jpeg(self):
+        for data, message in [
+                (b'\xff\xd8\xff\xff\xff', "Truncated JPEG header."),
+                (b'\xff\xd8\xff\xe0\x00', "Truncated JPEG header."),
+                (b'\xff\xd8\xff\xe0\x00\x00', "Invalid JPEG segment length."),
+                (b'\xff\xd8\xff\xc0\x00\x11\x08\x00\x28', "Truncated JPEG header."),
+                (b'\xff\xd8\xff\xe0\x00\x04JF', "JPEG file has no frame header.")]:
+            with self.subTest(data=data):
+                with self.assertRaisesMessage(ImageProbeError, message):
+                    validate_image(SimpleUploadedFile('snapshot.jpg', data, 'image/jpeg'))
+
+    def test_tga_is_detected_by_its_footer(self):
+        data = BytesIO()
+        Image.new('RGB', (40, 30)).save(data, 'TGA')
+        info = validate_image(SimpleUploadedFile('snapshot.tga', data.getvalue()))
+        self.assertEqual((info.format, info.width, info.height, info.bit_depth), ('TGA', 40, 30, 24))
+
+        # TGA 1.0 files have no footer
+        tga_1 = data.getvalue()[:-26]
+        with self.assertRaisesMessage(ImageProbeError, "TGA images without TGA 2.0 footer require 'format'."):
+            validate_image(SimpleUploadedFile('snapshot.tga', tga_1))
+        self.assertEqual(validate_image(SimpleUploadedFile('snapshot.tga', tga_1), 'tga').format, 'TGA')
+
+
+def create_session_user(username='session'):
+    user = User.objects.create_user(username, password='password')
+    user.groups.add(Group.objects.get_or_create(name='CamerafySession')[0])
+    return user
+
+
+class ChunkedUploadTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_session_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = os.urandom(1000)
+
+        response = self.client.post('/api/snapshot-uploads/', {'userid': self.user.id, 'size': len(self.data)})
+        self.assertEqual(response.status_code, 201)
+        self.upload_id = response.data['result']['id']
+
+    def put(self, start, end):
+        return self.client.put(
+            f"/api/snapshot-uploads/{self.upload_id}/", self.data[start:end + 1], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end}/{len(self.data)}")
+
+    def partial_data(self):
+        upload = snapshotModels.CamerafySnapshotUpload.objects.get(id=self.upload_id)
+        with open(upload_writer.path(upload), 'rb') as f:
+            return f.read()
+
+    def test_chunks_are_appended(self):
+        self.assertEqual(self.put(0, 399).data['result']['offset'], 400)
+        self.assertEqual(self.put(400, 999).data['result']['offset'], 1000)
+        self.assertEqual(self.client.get(f"/api/snapshot-uploads/{self.upload_id}/").data['result']['offset'], 1000)
+        self.assertEqual(self.partial_data(), self.data)
+
+    def test_chunk_at_wrong_offset_is_rejected(self):
+        self.put(0, 399)
+        response = self.put(0, 399)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '400')
+        self.assertEqual(self.partial_data(), self.data[:400])
+
+    def test_concurrent_chunk_is_not_written(self):
+        receive = upload_writer.receive
+
+        def receive_while_another_request_appends(upload, stream, length=None):
+            # another request for the same offset wins while this chunk is being received
+            path = receive(upload, stream, length)
+            snapshotModels.CamerafySnapshotUpload.objects.filter(id=upload.id).update(offset=400)
+            return path
+
+        with mock.patch.object(upload_writer, 'receive', side_effect=receive_while_another_request_appends):
+            response = self.put(0, 399)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.partial_data(), b'')
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'uploads')), [f"{self.upload_id}.part"])
+
+    def test_expired_uploads_are_removed(self):
+        fresh_id = self.client.post('/api/snapshot-uploads/', {'userid': self.user.id}).data['result']['id']
+        self.put(0, 399)
+        snapshotModels.CamerafySnapshotUpload.objects.filter(id=self.upload_id).update(
+            updated=timezone.now() - datetime.timedelta(days=2))
+        stale_chunk = os.path.join(self.directory, 'uploads', 'crashed.chunk')
+        open(stale_chunk, 'wb').close()
+        os.utime(stale_chunk, (0, 0))
+
+        stdout = StringIO()
+        call_command('expire_snapshot_uploads', expiry=24 * 60 * 60, stdout=stdout)
+
+        self.assertIn('Removed 1 expired uploads and 1 stale upload files.', stdout.getvalue())
+        self.assertEqual(list(snapshotModels.CamerafySnapshotUpload.objects.values_list('id', flat=True)), [fresh_id])
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'uploads')), [f"{fresh_id}.part"])
+
+
+    def upload_image(self):
+        """
+        Sends a complete PNG image to a new upload.
+        """
+        self.data = png_bytes((80, 40), (200, 10, 10))
+        self.upload_id = self.client.post('/api/snapshot-uploads/', {'userid': self.user.id, 'size': len(self.data)}).data['result']['id']
+        self.assertEqual(self.put(0, len(self.data) - 1).status_code, 200)
+
+    def finalize(self, data=None):
+        return self.client.post(f"/api/snapshot-uploads/{self.upload_id}/finalize/", data or {}, format='json')
+
+    def test_finalize(self):
+        self.upload_image()
+        response = self.finalize({'sha256': hashlib.sha256(self.data).hexdigest().upper()})
+
+        self.assertEqual(response.status_code, 200)
+        snapshot = snapshotModels.CamerafySnapshot.objects.get(id=response.data['result']['id'])
+        self.assertEqual((snapshot.format, snapshot.width, snapshot.height, snapshot.size), ('PNG', 80, 40, len(self.data)))
+        self.assertFalse(snapshotModels.CamerafySnapshotUpload.objects.filter(id=self.upload_id).exists())
+        self.assertNotIn(f"{self.upload_id}.part", os.listdir(os.path.join(self.directory, 'uploads')))
+
+    def test_concurrent_finalize_is_rejected(self):
+        get_object = uploadViews.snapshot_uploads.get_object
+
+        for name, change in [
+                ('finalized', lambda uploads: uploads.delete()),
+                ('chunk appended', lambda uploads: uploads.update(offset=models.F('offset') + 1))]:
+            with self.subTest(name):
+                self.upload_image()
+
+                def get_object_changed_concurrently(view):
+                    upload = get_object(view)
+                    change(snapshotModels.CamerafySnapshotUpload.objects.filter(id=upload.id))
+                    return upload
+
+                with mock.patch.object(uploadViews.snapshot_uploads, 'get_object', get_object_changed_concurrently):
+                    response = self.finalize()
+
+                self.assertEqual(response.status_code, 409)
+                self.assertFalse(snapshotModels.CamerafySnapshot.objects.exists())
+
+    def test_invalid_checksum_is_rejected(self):
+        self.upload_image()
+
+        for sha256 in [123, ['0' * 64], 'abc', 'g' * 64]:
+            with self.subTest(sha256=sha256):
+                response = self.finalize({'sha256': sha256})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data['error'], "'sha256' must be a hex encoded SHA-256 digest.")
+
+        # the upload is still complete
+        self.assertEqual(self.partial_data(), self.data)
+
+    def test_checksum_mismatch_removes_upload(self):
+        self.upload_image()
+        response = self.finalize({'sha256': '0' * 64})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("The upload has been removed.", response.data['error'])
+        self.assertFalse(snapshotModels.CamerafySnapshot.objects.exists())
+        self.assertFalse(snapshotModels.CamerafySnapshotUpload.objects.filter(id=self.upload_id).exists())
+        self.assertNotIn(f"{self.upload_id}.part", os.listdir(os.path.join(self.directory, 'uploads')))
+
+
+def create_snapshot(author, title, size=(80, 40), color=(200, 10, 10)):
+    """
+    Creates a PNG snapshot with a thumbnail of the same image.
+    """
+    data = png_bytes(size, color)
+    thumbnail = snapshotModels.CamerafySnapshotThumbnail.objects.create(
+        author=author, format='PNG', width=size[0], height=size[1], size=len(data),
+        image=ContentFile(data, name=f"{title}.png"))
+    return snapshotModels.CamerafySnapshot.objects.create(
+        author=author, title=title, description='', thumbnail=thumbnail, format='PNG',
+        width=size[0], height=size[1], size=len(data), image=ContentFile(data, name=f"{title}.png"), seen=False)
+
+
+class AtlasTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.atlas_directory = os.path.join(self.directory, 'cache', 'atlas')
+        for name, value in [('directory', self.atlas_directory), ('media_root', self.directory)]:
+            patcher = mock.patch.object(snapshotViews.atlas_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user('user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.snapshots = [create_snapshot(self.user, 'first'), create_snapshot(self.user, 'second', color=(10, 200, 10))]
+
+    def test_atlas_is_cached_on_disk(self):
+        index = self.client.get('/api/snapshots/atlas/').data['result']
+        self.assertEqual(index['width'], 160)
+        self.assertEqual(sorted(entry['id'] for entry in index['entries']), sorted(s.id for s in self.snapshots))
+        self.assertEqual(len([f for _, _, files in os.walk(self.atlas_directory) for f in files]), 2)
+
+        with mock.patch.object(imaging, 'create_atlas') as create_atlas:
+            response = self.client.get('/api/snapshots/atlas/image/')
+            create_atlas.assert_not_called()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f"\"{index['key']}\"")
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (index['width'], index['height']))
+
+    def test_atlas_is_rebuilt_after_eviction(self):
+        key = self.client.get('/api/snapshots/atlas/').data['result']['key']
+        shutil.rmtree(self.atlas_directory)
+
+        response = self.client.get('/api/snapshots/atlas/image/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{key}"')
+        self.assertEqual(self.client.get('/api/snapshots/atlas/image/', HTTP_IF_NONE_MATCH=f'"{key}"').status_code, 304)
+
+    def test_atlas_evicted_while_responding_is_rebuilt(self):
+        media_response = snapshotViews.media_response
+        evicted = []
+
+        def media_response_after_eviction(request, file, *args, **kwargs):
+            # a concurrent request's put evicts the atlas right before it is sent
+            if not evicted:
+                evicted.append(file.path)
+                shutil.rmtree(self.atlas_directory)
+            return media_response(request, file, *args, **kwargs)
+
+        with mock.patch.object(snapshotViews, 'media_response', side_effect=media_response_after_eviction):
+            response = self.client.get('/api/snapshots/atlas/image/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(os.path.exists(evicted[0]))
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.width, 160)
+
+
+class DiskLRUCacheTests(TempMediaMixin, SimpleTestCase):
+
+    def put(self, cache, key):
+        return cache.put(key, lambda f: f.write(b'x' * 100))
+
+    def test_least_recently_used_entries_are_evicted_to_the_low_water_mark(self):
+        cache = DiskLRUCache(self.directory, 450, low_water_ratio=0.5)
+        for index, key in enumerate(['a', 'b', 'c', 'd']):
+            os.utime(self.put(cache, key).path, (index, index))
+        # 'a' has been used most recently
+        cache.get('a')
+
+        with mock.patch.object(cache, '_scan', wraps=cache._scan) as scan:
+            self.put(cache, 'e')
+            self.assertEqual(scan.call_count, 1)
+            # there is room for the next entries without scanning again
+            self.put(cache, 'f')
+            self.put(cache, 'g')
+            self.assertEqual(scan.call_count, 1)
+
+        self.assertEqual([key for key in 'abcdefg' if cache.get(key) is not None], ['a', 'e', 'f', 'g'])
+
+    def test_entry_being_sent_survives_eviction(self):
+        cache = DiskLRUCache(self.directory, 150)
+        entry = self.put(cache, 'a')
+
+        response = media_response(RequestFactory().get('/'), entry, 'application/octet-stream')
+        self.put(cache, 'b')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(b''.join(response.streaming_content), b'x' * 100)
+
+
+class EmbeddedThumbnailTests(SimpleTestCase):
+
+    def fields(self, serializer_class, path='/'):
+        return serializer_class(context={'request': Request(RequestFactory().get(path))}).fields
+
+    def test_snapshot_thumbnail_is_opt_in(self):
+        self.assertNotIn('thumbnail', self.fields(snapshotSerializers.CamerafySnapshotSerializer))
+        self.assertIn('thumbnail', self.fields(snapshotSerializers.CamerafySnapshotSerializer, '/?embed=thumbnail'))
+
+    def test_environment_and_model_thumbnails_are_included(self):
+        self.assertIn('thumbnail', self.fields(environmentSerializers.EnvironmentSerializer))
+        self.assertIn('thumbnail', self.fields(camfymodelSerializers.CamfyModelSerializer))
+
+
+class BulkSnapshotTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.snapshots = [create_snapshot(self.user, 'first'), create_snapshot(self.user, 'second')]
+
+    def test_bulk_delete(self):
+        response = self.client.post('/api/snapshots/bulk_delete/', {'ids': [self.snapshots[0].id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['result']['deleted'], 1)
+        self.assertEqual(list(snapshotModels.CamerafySnapshot.objects.values_list('id', flat=True)), [self.snapshots[1].id])
+
+    def test_bulk_delete_form_ids(self):
+        response = self.client.post('/api/snapshots/bulk_delete/', {'ids': [s.id for s in self.snapshots]})
+        self.assertEqual(response.data['result']['deleted'], 2)
+
+    def test_bulk_delete_rejects_invalid_ids(self):
+        for ids in (['first'], 'first', [1.5], [None], [-1]):
+            with self.subTest(ids=ids):
+                response = self.client.post('/api/snapshots/bulk_delete/', {'ids': ids}, format='json')
+                self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/snapshots/bulk_delete/', {'ids': ['first']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(snapshotModels.CamerafySnapshot.objects.count(), 2)
+
+    def test_mark_seen(self):
+        response = self.client.post('/api/snapshots/mark_seen/', {'ids': [self.snapshots[0].id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['result']['updated'], 1)
+        self.assertEqual(list(snapshotModels.CamerafySnapshot.objects.filter(seen=True).values_list('id', flat=True)), [self.snapshots[0].id])
+
+    def test_mark_seen_rejects_invalid_ids(self):
+        for ids in (['first'], 'first', [None]):
+            with self.subTest(ids=ids):
+                response = self.client.post('/api/snapshots/mark_seen/', {'ids': ids}, format='json')
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(snapshotModels.CamerafySnapshot.objects.filter(seen=True).exists())
+
+
+class BatchUploadTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_session_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload_batch(self, files, **data):
+        return self.client.post('/api/snapshots/upload_batch/', {'userid': self.user.id, 'file': files, **data})
+
+    def image(self, width, name='snapshot.png'):
+        return SimpleUploadedFile(name, png_bytes((width, 40), (200, 10, 10)), 'image/png')
+
+    def assertNothingStored(self):
+        self.assertFalse(snapshotModels.CamerafySnapshot.objects.exists())
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertEqual(snapshotModels.CamerafySnapshotUserStats.objects.usage(self.user.id)['bytes_used'], 0)
+
+    def test_ids_are_returned_in_order(self):
+        response = self.upload_batch([self.image(width) for width in (30, 10, 20)], description=['a', 'b', 'c'])
+
+        self.assertEqual(response.status_code, 200)
+        snapshots = snapshotModels.CamerafySnapshot.objects.in_bulk([r['id'] for r in response.data['result']])
+        self.assertEqual([(snapshots[r['id']].width, snapshots[r['id']].description) for r in response.data['result']],
+            [(30, 'a'), (10, 'b'), (20, 'c')])
+        self.assertEqual([r['title'] for r in response.data['result']], [snapshots[r['id']].title for r in response.data['result']])
+
+    def test_quota_applies_to_the_whole_batch(self):
+        images = [self.image(width) for width in (30, 10)]
+        with override_settings(CAMERAFY_DEFAULT_QUOTA=max(image.size for image in images)):
+            response = self.upload_batch(images)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertNothingStored()
+
+    def test_invalid_image_rolls_back_the_batch(self):
+        invalid = SimpleUploadedFile('invalid.png', b'not an image', 'image/png')
+        response = self.upload_batch([self.image(30), invalid, self.image(20)])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertNothingStored()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'blobs')))
+
+    def test_dedupe_is_rejected(self):
+        response = self.upload_batch([self.image(30)], dedupe='true')
+        self.assertEqual(response.status_code, 400)
+        self.assertNothingStored()
+
+
+class SnapshotStatsTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_session_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, width=80):
+        image = SimpleUploadedFile('snapshot.png', png_bytes((width, 40), (200, 10, 10)), 'image/png')
+        return self.client.post('/api/snapshots/upload/', {'userid': self.user.id, 'file': image})
+
+    def stats(self):
+        stats = snapshotModels.CamerafySnapshotUserStats.objects.filter(user=self.user).first()
+        return (stats.unseen, stats.snapshot_count, stats.bytes_used) if stats is not None else None
+
+    def test_quota_is_enforced(self):
+        size = len(png_bytes((80, 40), (200, 10, 10)))
+        snapshotModels.CamerafySnapshotUserStats.objects.create(user=self.user, quota=size)
+
+        self.assertEqual(self.upload().status_code, 200)
+        response = self.upload()
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.data['error'], f"Storing {size} more bytes would exceed the storage quota of {size} bytes.")
+        self.assertEqual(snapshotModels.CamerafySnapshot.objects.count(), 1)
+        self.assertEqual(self.stats(), (1, 1, size))
+
+    def test_default_quota_is_enforced_for_new_users(self):
+        with override_settings(CAMERAFY_DEFAULT_QUOTA=100):
+            with self.assertRaises(snapshotModels.QuotaExceeded):
+                with transaction.atomic():
+                    snapshotModels.CamerafySnapshotUserStats.objects.add(self.user.id, snapshots=1, bytes=101, enforce_quota=True)
+            self.assertIsNone(self.stats())
+
+            self.assertEqual(self.upload().status_code, 413)
+            self.assertIsNone(self.stats())
+
+    def test_counters_follow_creates_and_deletes(self):
+        ids = [self.upload(width).data['result']['id'] for width in (80, 90, 100)]
+        sizes = dict(snapshotModels.CamerafySnapshot.objects.values_list('id', 'size'))
+        self.assertEqual(self.stats(), (3, 3, sum(sizes.values())))
+
+        self.assertEqual(self.client.delete(f"/api/snapshots/{ids[0]}/").status_code, 204)
+        self.assertEqual(self.stats(), (2, 2, sizes[ids[1]] + sizes[ids[2]]))
+
+        self.client.post('/api/snapshots/mark_seen/', {'ids': [ids[1]]}, format='json')
+        self.assertEqual(self.stats(), (1, 2, sizes[ids[1]] + sizes[ids[2]]))
+
+        response = self.client.post('/api/snapshots/bulk_delete/', {'ids': ids[1:]}, format='json')
+        self.assertEqual(response.data['result']['deleted'], 2)
+        self.assertEqual(self.stats(), (0, 0, 0))
+
+    def test_reconcile_corrects_drift(self):
+        # created without going through the manager, so the statistics are not updated
+        snapshots = [create_snapshot(self.user, 'first'), create_snapshot(self.user, 'second')]
+        snapshotModels.CamerafySnapshot.objects.filter(id=snapshots[0].id).update(seen=True)
+        other = User.objects.create_user('other')
+        snapshotModels.CamerafySnapshotUserStats.objects.create(user=other, unseen=4, snapshot_count=4, bytes_used=400)
+
+        stdout = StringIO()
+        call_command('reconcile_snapshot_stats', stdout=stdout)
+
+        # snapshot and thumbnail files
+        bytes_used = 2 * snapshots[0].size + 2 * snapshots[0].thumbnail.size
+        self.assertIn(f"User {self.user.id}: unseen 0 -> 1, snapshot_count 0 -> 2, bytes_used 0 -> {bytes_used}", stdout.getvalue())
+        self.assertIn(f"User {other.id}: unseen 4 -> 0, snapshot_count 4 -> 0, bytes_used 400 -> 0", stdout.getvalue())
+        self.assertIn("Reconciled 2 users, corrected 2.", stdout.getvalue())
+        self.assertEqual(self.stats(), (1, 2, bytes_used))
+
+        stdout = StringIO()
+        call_command('reconcile_snapshot_stats', stdout=stdout)
+        self.assertIn("Reconciled 2 users, corrected 0.", stdout.getvalue())
+
+
+def png16_bytes(pixels):
+    """
+    Encodes a (height, width, 3) array as 16-bit RGB PNG, which Pillow cannot write.
+    """
+    def chunk(type, data):
+        return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+    height, width, _ = pixels.shape
+    rows = b''.join(b'\0' + row.astype('>u2').tobytes() for row in pixels)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 16, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def read_png16(data):
+    """
+    Decodes a 16-bit RGB PNG with unfiltered rows as written by png16_bytes().
+    """
+    width, height, depth, color_type = struct.unpack('>IIBB', data[16:26])
+    assert (depth, color_type) == (16, 2)
+    position, idat = 8, b''
+    while position < len(data):
+        length, type = struct.unpack('>I4s', data[position:position + 8])
+        if type == b'IDAT':
+            idat += data[position + 8:position + 8 + length]
+        position += length + 12
+    rows = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, width * 6 + 1)
+    assert not rows[:, 0].any()
+    return np.frombuffer(rows[:, 1:].tobytes(), dtype='>u2').reshape(height, width, 3)
+
+
+class TieringTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in [('directory', os.path.join(self.directory, 'cache', 'hot')), ('media_root', self.directory)]:
+            patcher = mock.patch.object(tiering.hot_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_16_bit_png_keeps_its_samples(self):
+        user = User.objects.create_user('user', password='password')
+        pixels = np.random.default_rng(0).integers(0, 65536, (40, 60, 3), dtype=np.uint16)
+        data = png16_bytes(pixels)
+
+        for codec in tiering.available_codecs():
+            with self.subTest(codec=codec):
+                snapshot = create_snapshot(user, f"snapshot-{codec}")
+                snapshot.image.save(f"{codec}.png", ContentFile(data))
+
+                tiering.tier_snapshot(snapshot, codec)
+                snapshot.refresh_from_db()
+                if snapshot.tier == snapshotModels.CamerafySnapshot.TIER_COLD:
+                    self.assertEqual(tiering.stored_codec(snapshot.image.name), 'zstd')
+
+                with open(local_file(tiering.open_image(snapshot)).path, 'rb') as f:
+                    np.testing.assert_array_equal(read_png16(f.read()), pixels)
+
+    def test_8_bit_png_is_recompressed(self):
+        user = User.objects.create_user('user', password='password')
+        snapshot = create_snapshot(user, 'snapshot', size=(200, 100))
+        original = Image.new('RGB', (200, 100))
+        original.putdata([(x % 256, y, 7) for y in range(100) for x in range(200)])
+        data = BytesIO()
+        original.save(data, 'PNG', compress_level=0)
+        snapshot.image.save('snapshot.png', ContentFile(data.getvalue()))
+
+        self.assertIsNotNone(tiering.tier_snapshot(snapshot, 'webp'))
+        snapshot.refresh_from_db()
+        self.assertEqual(tiering.stored_codec(snapshot.image.name), 'webp')
+        with Image.open(local_file(tiering.open_image(snapshot)).path) as image:
+            self.assertEqual(list(image.getdata()), list(original.getdata()))
+
+
+def signed_url_params(url):
+    query = parse_qs(urlsplit(url).query)
+    return {key: values[0] for key, values in query.items()}
+
+
+@override_settings(CAMERAFY_MEDIA_SIGNING_KEY='key', CAMERAFY_SIGNED_URL_TTL=900, CAMERAFY_SIGNED_URL_GRANULARITY=300)
+class SigningTests(SimpleTestCase):
+
+    def test_expiry_is_rounded_up(self):
+        self.assertEqual(expiry(now=1000), 2100)
+        self.assertEqual(expiry(now=1200), 2100)
+        self.assertEqual(expiry(now=1201), 2400)
+
+    def test_signed_url(self):
+        url = signed_media_url('blobs/ab/cd/abcd.png', 7, 'TGA')
+        self.assertTrue(url.startswith('/api/media/blobs/ab/cd/abcd.png?'))
+        params = signed_url_params(url)
+        self.assertEqual(params['user'], '7')
+        self.assertEqual(params['signature'], media_signature('blobs/ab/cd/abcd.png', 'TGA', 7, params['expires']))
+        self.assertEqual(verify_media_url('blobs/ab/cd/abcd.png', params), ('TGA', int(params['expires'])))
+
+    def test_signature_depends_on_key(self):
+        signature = media_signature('a.png', None, 1, 2100)
+        self.assertEqual(signature, media_signature('a.png', '', 1, 2100))
+        with self.settings(CAMERAFY_MEDIA_SIGNING_KEY='other'):
+            self.assertNotEqual(media_signature('a.png', None, 1, 2100), signature)
+
+    def test_expired_url(self):
+        params = signed_url_params(signed_media_url('a.png', 1))
+        with self.assertRaisesMessage(InvalidSignature, 'expired'):
+            verify_media_url('a.png', params, now=int(params['expires']) + 1)
+
+    def test_tampered_url(self):
+        params = signed_url_params(signed_media_url('a.png', 1, 'TGA'))
+        for name, changes in [
+                ('a.png', {'signature': params['signature'][:-1] + ('A' if params['signature'][-1] != 'A' else 'B')}),
+                ('a.png', {'user': '2'}),
+                ('a.png', {'format': 'PNG'}),
+                ('a.png', {'format': ''}),
+                ('a.png', {'expires': str(int(params['expires']) + 300)}),
+                ('b.png', {})]:
+            with self.subTest(name=name, changes=changes):
+                with self.assertRaisesMessage(InvalidSignature, 'Invalid signature.'):
+                    verify_media_url(name, {**params, **changes})
+
+    def test_incomplete_url(self):
+        params = signed_url_params(signed_media_url('a.png', 1))
+        for missing in ('user', 'expires', 'signature'):
+            with self.subTest(missing=missing):
+                with self.assertRaisesMessage(InvalidSignature, 'Incomplete signed URL.'):
+                    verify_media_url('a.png', {key: value for key, value in params.items() if key != missing})
+        with self.assertRaises(InvalidSignature):
+            verify_media_url('a.png', {**params, 'expires': 'never'})
+
+    @override_settings(CAMERAFY_STREAM_TOKEN_TTL=60)
+    def test_stream_token(self):
+        token, expires = stream_token(7, now=1000)
+        self.assertEqual(expires, 1060)
+        self.assertEqual(verify_stream_token(token, now=1060), 7)
+        with self.assertRaisesMessage(InvalidSignature, 'Stream token has expired.'):
+            verify_stream_token(token, now=1061)
+
+    def test_tampered_stream_token(self):
+        token, expires = stream_token(7)
+        user_id, expires, signature = token.split('.')
+        for tampered in [f"8.{expires}.{signature}", f"7.{int(expires) + 60}.{signature}", f"7.{expires}.{media_signature('a.png', None, 7, expires)}"]:
+            with self.subTest(token=tampered):
+                with self.assertRaisesMessage(InvalidSignature, 'Invalid signature.'):
+                    verify_stream_token(tampered)
+        for malformed in ['', 'token', f"7.{expires}", f"seven.{expires}.{signature}"]:
+            with self.subTest(token=malformed):
+                with self.assertRaisesMessage(InvalidSignature, 'Malformed stream token.'):
+                    verify_stream_token(malformed)
+
+
+@override_settings(CAMERAFY_MEDIA_SIGNING_KEY='key', CAMERAFY_MEDIA_SENDFILE=None)
+class SignedMediaTests(TempMediaMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.content = png_bytes((4, 4), (1, 2, 3))
+        self.write_file('blobs/ab/snapshot.png', self.content)
+
+    def test_signed_media(self):
+        response = self.client.get(signed_media_url('blobs/ab/snapshot.png', 1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_tampered_signature_is_forbidden(self):
+        url = signed_media_url('blobs/ab/snapshot.png', 1)
+        self.assertEqual(self.client.get(url.replace('user=1', 'user=2')).status_code, 403)
+        self.assertEqual(self.client.get(url.replace('snapshot.png', 'other.png', 1)).status_code, 403)
+        self.assertEqual(self.client.get('/api/media/blobs/ab/snapshot.png').status_code, 403)
+
+    def test_expired_url_is_forbidden(self):
+        url = signed_media_url('blobs/ab/snapshot.png', 1)
+        with mock.patch.object(time, 'time', return_value=time.time() + 3600):
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_missing_file(self):
+        self.assertEqual(self.client.get(signed_media_url('blobs/ab/missing.png', 1)).status_code, 404)
+        self.assertEqual(self.client.get(signed_media_url('../settings.py', 1)).status_code, 404)
+
+
+@skipIf(mock_aws is None, 'The S3 storage tests require boto3 and moto.')
+class S3StorageTests(TempMediaMixin, TestCase):
+    """
+    Runs the S3 storage against the object store emulated by moto.
+    """
+
+    def setUp(self):
+        super().setUp()
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='camerafy-test')
+
+        for name, value in [('directory', os.path.join(self.directory, 'cache', 'media')), ('media_root', self.directory)]:
+            patcher = mock.patch.object(media_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.storage = S3Storage(
+            bucket='camerafy-test', location='media', region_name='us-east-1', access_key='test', secret_key='test',
+            multipart_threshold=6 * 1024 * 1024)
+
+    def test_save_and_open(self):
+        name = self.storage.save('snapshots/a.png', ContentFile(b'content'))
+        self.assertEqual(name, 'snapshots/a.png')
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), 7)
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'content')
+
+        head = boto3.client('s3', region_name='us-east-1').head_object(Bucket='camerafy-test', Key='media/snapshots/a.png')
+        self.assertEqual(head['ContentType'], 'image/png')
+
+    def test_existing_names_are_not_overwritten(self):
+        self.storage.save('a.png', ContentFile(b'first'))
+        name = self.storage.save('a.png', ContentFile(b'second'))
+        self.assertNotEqual(name, 'a.png')
+        with self.storage.open('a.png') as f:
+            self.assertEqual(f.read(), b'first')
+
+    def test_multipart_transfer(self):
+        content = os.urandom(7 * 1024 * 1024)
+        name = self.storage.save('large.raw', ContentFile(content))
+        self.assertEqual(self.storage.size(name), len(content))
+        data = BytesIO()
+        self.storage.download(name, data)
+        self.assertEqual(data.getvalue(), content)
+
+    def test_open_range(self):
+        self.storage.save('a.raw', ContentFile(bytes(range(100))))
+        with self.storage.open_range('a.raw', 10, 19) as f:
+            self.assertEqual(f.read(), bytes(range(10, 20)))
+        with self.storage.open_range('a.raw', 90) as f:
+            self.assertEqual(f.read(), bytes(range(90, 100)))
+        with self.assertRaises(ValueError):
+            self.storage.open('a.raw', 'wb')
+
+    def test_missing_file(self):
+        self.assertFalse(self.storage.exists('missing.png'))
+        for call in (self.storage.open, self.storage.size, self.storage.stat, lambda name: self.storage.download(name, BytesIO())):
+            with self.assertRaises(FileNotFoundError):
+                call('missing.png')
+
+    def test_delete(self):
+        self.storage.save('a.png', ContentFile(b'content'))
+        self.storage.delete('a.png')
+        self.assertFalse(self.storage.exists('a.png'))
+        # deleting a missing file is not an error
+        self.storage.delete('a.png')
+
+    def test_stat_and_modified_time(self):
+        before = time.time()
+        self.storage.save('a.png', ContentFile(b'content'))
+        size, mtime = self.storage.stat('a.png')
+        self.assertEqual(size, 7)
+        self.assertAlmostEqual(mtime, before, delta=5)
+        self.assertAlmostEqual(self.storage.get_modified_time('a.png').timestamp(), mtime, delta=1)
+
+    def test_url(self):
+        url = self.storage.url('snapshots/a b.png')
+        self.assertIn('camerafy-test', url)
+        self.assertIn('media/snapshots/a%20b.png', url)
+        self.assertIn('Signature=', url)
+
+    def test_listdir_and_scan(self):
+        for name in ('a.png', 'snapshots/b.png', 'snapshots/thumbnails/c.png'):
+            self.storage.save(name, ContentFile(b'content'))
+        self.assertEqual(self.storage.listdir(''), (['snapshots'], ['a.png']))
+        self.assertEqual(self.storage.listdir('snapshots'), (['thumbnails'], ['b.png']))
+        self.assertEqual(sorted(name for name, _, _ in self.storage.scan('snapshots/')), ['snapshots/b.png', 'snapshots/thumbnails/c.png'])
+
+    def test_media_helpers(self):
+        self.storage.save('a.raw', ContentFile(bytes(range(100))))
+        file = StoredFile('a.raw', self.storage)
+        self.assertEqual(media_stat(file)[0], 100)
+        with open_media(file, 50, 59) as f:
+            self.assertEqual(f.read(), bytes(range(50, 60)))
+        with open(local_file(file).path, 'rb') as f:
+            self.assertEqual(f.read(), bytes(range(100)))
+
+    def test_content_addressed_storage(self):
+        storage = ContentAddressedStorage(backend=self.storage)
+        name = storage.save('snapshot.PNG', ContentFile(b'content'))
+        self.assertRegex(name, r'^blobs/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual(storage.save('copy.png', ContentFile(b'content')), name)
+        self.assertEqual(storage.size(name), 7)
+        self.assertTrue(self.storage.exists(name))
+        # stored blobs are written through to the media cache
+        self.assertIsNotNone(media_cache.get(name, '.png'))
+
+        storage.delete(name)
+        self.assertTrue(storage.exists(name))
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+
+class PipelineTests(SimpleTestCase):
+
+    def test_16_bit_png_is_not_lossless(self):
+        pixels = np.full((4, 6, 3), 0x1234, dtype=np.uint16)
+        image = pipeline.open_strips(BytesIO(png16_bytes(pixels)), 'PNG')
+        self.assertEqual(image.mode, 'RGB')
+        self.assertFalse(image.lossless)
+
+    def test_8_bit_pillow_images_are_lossless(self):
+        # decoded by Pillow, as only palette PNGs with transparency are decoded strip by strip
+        data = BytesIO()
+        Image.new('RGB', (6, 4)).save(data, 'PNG', transparency=(0, 0, 0))
+        image = pipeline.open_strips(data, 'PNG')
+        self.assertEqual(image.mode, 'RGB')
+        self.assertTrue(image.lossless)
+
+        data = BytesIO()
+        Image.new('RGB', (6, 4)).save(data, 'JPEG')
+        self.assertTrue(pipeline.open_strips(data, 'JPG').lossless)
+
+
+class ThumbnailPoolTests(TempMediaMixin, TransactionTestCase):
+    """
+    The thumbnails are stored by the pool's result thread, so the snapshots have to be committed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('user', password='password')
+
+    def upload(self, size=(400, 200)):
+        image = SimpleUploadedFile('snapshot.png', png_bytes(size, (200, 10, 10)), 'image/png')
+        return snapshotModels.CamerafySnapshot.objects.create_snapshot(self.user, image)
+
+    def test_thumbnails_are_created_after_commit(self):
+        snapshot = self.upload()
+        self.assertEqual(snapshot.thumbnail_status, snapshotModels.CamerafySnapshot.THUMBNAIL_PENDING)
+        self.assertTrue(thumbnail_pool.join(30))
+
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.thumbnail_status, snapshotModels.CamerafySnapshot.THUMBNAIL_READY)
+        self.assertIsNotNone(snapshot.phash)
+        self.assertEqual(sorted(snapshot.thumbnails.values_list('width', flat=True)), [160, 320, 400])
+        self.assertEqual(snapshot.thumbnail.width, 160)
+
+    def test_undecodable_image_fails(self):
+        snapshot = create_snapshot(self.user, 'broken')
+        snapshotModels.CamerafySnapshot.objects.filter(id=snapshot.id).update(
+            thumbnail_status=snapshotModels.CamerafySnapshot.THUMBNAIL_PENDING)
+        pool = ThumbnailWorkerPool(1)
+        with open(snapshot.image.path, 'wb') as f:
+            f.write(b'not an image')
+
+        with self.assertLogs('backend.api.thumbnails', 'ERROR'):
+            pool.enqueue(snapshot.id, snapshot.image.path, 'PNG', (80, 40))
+            self.assertTrue(pool.join(30))
+
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.thumbnail_status, snapshotModels.CamerafySnapshot.THUMBNAIL_FAILED)
+        self.assertEqual(pool.stats()['failed'], 1)
+        self.assertEqual(pool.stats()['queue_depth'], 0)
+
+    def test_enqueue_failure_does_not_fail_the_upload(self):
+        with mock.patch.object(thumbnail_pool, 'enqueue', side_effect=RuntimeError('pool is broken')):
+            with self.assertLogs('backend.api.models.snapshots', 'ERROR'):
+                snapshot = self.upload()
+
+        self.assertTrue(snapshotModels.CamerafySnapshot.objects.filter(id=snapshot.id).exists())
+
+        stdout = StringIO()
+        call_command('requeue_pending_thumbnails', workers=1, stdout=stdout)
+        self.assertIn('Created the thumbnails of 1 of 1 snapshots (0 failed).', stdout.getvalue())
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.thumbnail_status, snapshotModels.CamerafySnapshot.THUMBNAIL_READY)
+
+    def test_requeue_failed(self):
+        snapshot = create_snapshot(self.user, 'failed')
+        snapshotModels.CamerafySnapshot.objects.filter(id=snapshot.id).update(
+            thumbnail_status=snapshotModels.CamerafySnapshot.THUMBNAIL_FAILED)
+
+        stdout = StringIO()
+        call_command('requeue_pending_thumbnails', workers=1, stdout=stdout)
+        self.assertIn('of 0 snapshots', stdout.getvalue())
+        call_command('requeue_pending_thumbnails', workers=1, failed=True, stdout=stdout)
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.thumbnail_status, snapshotModels.CamerafySnapshot.THUMBNAIL_READY)
+
+
+class ContentAddressedStorageTests(TempMediaMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.storage = ContentAddressedStorage()
+
+    def test_identical_files_are_stored_once(self):
+        name = self.storage.save('a.png', ContentFile(b'content'))
+        self.assertEqual(self.storage.save('b.png', ContentFile(b'content')), name)
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 2)
+
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_rolled_back_blob_is_removed(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                name = self.storage.save('a.png', ContentFile(b'content'))
+                # readable before the commit
+                with self.storage.open(name) as f:
+                    self.assertEqual(f.read(), b'content')
+                raise RuntimeError()
+
+        media_sweeper.join()
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_committed_blob_is_kept(self):
+        with transaction.atomic():
+            name = self.storage.save('a.png', ContentFile(b'content'))
+
+        media_sweeper.join()
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+
+    def test_rolled_back_reference_keeps_referenced_blob(self):
+        name = self.storage.save('a.png', ContentFile(b'content'))
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.storage.save('b.png', ContentFile(b'content'))
+                raise RuntimeError()
+
+        media_sweeper.join()
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+
+    def test_unreferenced_blob_is_discarded(self):
+        name = self.storage.save('a.png', ContentFile(b'content'))
+        self.assertFalse(self.storage.discard_unreferenced(name))
+        MediaBlob.objects.filter(name=name).delete()
+        self.assertTrue(self.storage.discard_unreferenced(name))
+        self.assertFalse(self.storage.exists(name))
+
+
+class MediaOrphanTests(TempMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # caches inside the scanned directories, so skipping them is not only a matter of location
+        cache_settings = override_settings(
+            CAMERAFY_VARIANT_CACHE_DIR=os.path.join(self.directory, 'snapshots', 'variants'),
+            CAMERAFY_ATLAS_CACHE_DIR=os.path.join(self.directory, 'blobs', 'atlas'))
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+        user = User.objects.create_user('user', password='password')
+        self.snapshot = create_snapshot(user, 'referenced')
+        self.referenced = [self.snapshot.image.name, self.snapshot.thumbnail.image.name]
+
+        self.files = {}
+        for name, age in [
+                ('blobs/aa/bb/orphan.png', 7200),
+                ('snapshots/orphan.png', 7200),
+                ('snapshots/recent.png', 0),
+                ('blobs/staging/crashed', 7200),
+                ('blobs/staging/in-progress', 0),
+                ('snapshots/variants/ab/variant.webp', 7200),
+                ('blobs/atlas/ab/atlas.png', 7200),
+                ('cache/hot/ab/hot.png', 7200),
+                ('uploads/upload.part', 7200)]:
+            self.files[name] = self.write_file(name, b'x' * 10).path
+            os.utime(self.files[name], (time.time() - age, time.time() - age))
+        for name in self.referenced:
+            os.utime(os.path.join(self.directory, name), (0, 0))
+
+    def sweep(self, *args):
+        stdout = StringIO()
+        call_command('sweep_media_orphans', *args, verbosity=2, stdout=stdout)
+        return stdout.getvalue()
+
+    def reported(self, output):
+        return sorted(line.split("'")[1] for line in output.splitlines() if line.startswith('Orphaned file'))
+
+    def existing(self):
+        return sorted(name for name, path in self.files.items() if os.path.exists(path))
+
+    def test_orphans_are_reported(self):
+        output = self.sweep()
+        self.assertEqual(self.reported(output), ['blobs/aa/bb/orphan.png', 'blobs/staging/crashed', 'snapshots/orphan.png'])
+        self.assertIn("3 orphaned files (30 bytes), 0 rows referencing missing files.", output)
+        self.assertEqual(self.existing(), sorted(self.files))
+
+    def test_min_age(self):
+        self.assertEqual(self.reported(self.sweep('--min-age', '0')), [
+            'blobs/aa/bb/orphan.png', 'blobs/staging/crashed', 'blobs/staging/in-progress', 'snapshots/orphan.png', 'snapshots/recent.png'])
+        self.assertEqual(self.reported(self.sweep('--min-age', '3')), [])
+
+        with self.assertRaisesMessage(CommandError, '--min-age must not be negative.'):
+            self.sweep('--min-age', '-1')
+
+    def test_orphans_are_deleted(self):
+        output = self.sweep('--delete')
+
+        self.assertIn("Deleted 3 orphaned files, 30 bytes reclaimed.", output)
+        self.assertEqual(self.existing(), [
+            'blobs/atlas/ab/atlas.png', 'blobs/staging/in-progress', 'cache/hot/ab/hot.png', 'snapshots/recent.png',
+            'snapshots/variants/ab/variant.webp', 'uploads/upload.part'])
+        for name in self.referenced:
+            self.assertTrue(os.path.exists(os.path.join(self.directory, name)))
+        self.assertEqual(MediaBlob.objects.get(name=self.snapshot.image.name).refcount, 2)
+        self.assertFalse(MediaBlob.objects.filter(name='blobs/aa/bb/orphan.png').exists())
+
+    def test_orphan_referenced_in_the_meantime_is_kept(self):
+        find_orphans = orphans.find_orphans
+
+        def find_orphans_then_reference(*args, **kwargs):
+            found = find_orphans(*args, **kwargs)
+            # an upload reusing the blob commits between scanning and deleting
+            MediaBlob.objects.create(name='blobs/aa/bb/orphan.png', size=10, refcount=1)
+            snapshotModels.CamerafySnapshot.objects.filter(id=self.snapshot.id).update(image='blobs/aa/bb/orphan.png')
+            return found
+
+        with mock.patch.object(orphans, 'find_orphans', side_effect=find_orphans_then_reference):
+            output = self.sweep('--delete')
+
+        self.assertIn("Deleted 2 orphaned files, 20 bytes reclaimed.", output)
+        self.assertIn('blobs/aa/bb/orphan.png', self.existing())
+        self.assertEqual(MediaBlob.objects.get(name='blobs/aa/bb/orphan.png').refcount, 1)
+
+    def test_delete_orphan_rechecks_references(self):
+        # the snapshot and its thumbnail share the blob
+        self.assertFalse(orphans.delete_orphan(self.snapshot.image.name))
+        self.assertEqual(MediaBlob.objects.get(name=self.snapshot.image.name).refcount, 2)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, self.snapshot.image.name)))
+
+        self.assertTrue(orphans.delete_orphan('snapshots/orphan.png'))
+        self.assertFalse(os.path.exists(self.files['snapshots/orphan.png']))
+
+
+class SimilarSnapshotTests(TempMediaMixin, TransactionTestCase):
+    """
+    The cached hashes are invalidated once committed, so the changes have to be committed.
+    """
+
+    # far from the hash of the plain colored test images, which is 0
+    HASH = 0x5555555555555555
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.user = User.objects.create_user('user', password='password')
+        self.snapshots = {}
+        for title, phash in [('same', self.HASH), ('close', self.HASH ^ 0b111), ('far', ~self.HASH & 0xFFFFFFFFFFFFFFFF)]:
+            self.snapshots[title] = create_snapshot(self.user, title).id
+            snapshotModels.CamerafySnapshot.objects.filter(id=self.snapshots[title]).update(phash=similarity.to_signed(phash))
+
+    def similar(self, phash=HASH, max_distance=6, exclude_id=None):
+        return snapshotModels.CamerafySnapshot.objects.similar(self.user.id, phash, max_distance, exclude_id)
+
+    def create(self, color):
+        image = SimpleUploadedFile('snapshot.png', png_bytes((80, 40), color), 'image/png')
+        return snapshotModels.CamerafySnapshot.objects.create_snapshot(self.user, image, dedupe=True)
+
+    def test_similar(self):
+        self.assertEqual(self.similar(), [(self.snapshots['same'], 0), (self.snapshots['close'], 3)])
+        self.assertEqual(self.similar(exclude_id=self.snapshots['same']), [(self.snapshots['close'], 3)])
+        self.assertEqual(self.similar(~self.HASH & 0xFFFFFFFFFFFFFFFF, 0), [(self.snapshots['far'], 0)])
+        self.assertEqual(snapshotModels.CamerafySnapshot.objects.similar(0, 0, 64), [])
+
+    def test_hashes_are_cached(self):
+        self.similar()
+        # only the cache is read
+        with self.assertNumQueries(1):
+            self.assertEqual(self.similar(), [(self.snapshots['same'], 0), (self.snapshots['close'], 3)])
+
+    def test_changes_invalidate_the_cache(self):
+        self.similar()
+
+        snapshotModels.CamerafySnapshot.objects.delete_snapshots([self.snapshots['same']])
+        self.assertEqual(self.similar(), [(self.snapshots['close'], 3)])
+
+        thumbnail = png_bytes((80, 40), (200, 10, 10))
+        store_snapshot_thumbnails(self.snapshots['far'], 'PNG', [(80, 40, thumbnail)], phash=self.HASH ^ 0b1)
+        self.assertEqual(self.similar(), [(self.snapshots['far'], 1), (self.snapshots['close'], 3)])
+
+        self.assertEqual(self.similar(0, 0), [])
+        created = self.create((10, 200, 10))
+        self.assertEqual(self.similar(0, 0), [(created.id, 0)])
+
+    def test_deleted_duplicate_is_ignored(self):
+        first = self.create((10, 200, 10))
+        with self.assertRaises(snapshotModels.DuplicateSnapshot) as duplicate:
+            self.create((200, 10, 10))
+        self.assertEqual(duplicate.exception.snapshot.id, first.id)
+
+        # hashes cached by another process right before the snapshot has been deleted
+        key = snapshotModels.hashes_cache_key(self.user.id)
+        stale = caches['default'].get(key)
+        snapshotModels.CamerafySnapshot.objects.delete_snapshots([first.id])
+        caches['default'].set(key, stale)
+        self.assertEqual(self.similar(0, 0), [(first.id, 0)])
+        second = self.create((200, 10, 10))
+        self.assertNotEqual(second.id, first.id)
+
+
+def drain(subscription):
+    received = []
+    event = subscription.get(0)
+    while event is not None:
+        received.append((event.id, event.type, event.data))
+        event = subscription.get(0)
+    return received
+
+
+class InMemoryEventLayerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = events.InMemoryEventLayer()
+
+    def publish(self, layer, user_id, count):
+        for i in range(count):
+            layer._publish(user_id, 'snapshot.created', {'ids': [i]})
+        return [f"{layer.epoch}-{n}" for n, event in layer._recent if event.user_id == user_id][-count:]
+
+    def test_dispatch(self):
+        subscription = self.layer.subscribe(1)
+        other = self.layer.subscribe(2)
+        ids = self.publish(self.layer, 1, 2)
+        self.assertEqual(drain(subscription), [(ids[0], 'snapshot.created', {'ids': [0]}), (ids[1], 'snapshot.created', {'ids': [1]})])
+        self.assertEqual(drain(other), [])
+
+        subscription.close()
+        self.publish(self.layer, 1, 1)
+        self.assertEqual(drain(subscription), [])
+
+    def test_replay_by_last_event_id(self):
+        ids = self.publish(self.layer, 1, 3)
+        self.publish(self.layer, 2, 1)
+        self.assertEqual([id for id, _, _ in drain(self.layer.subscribe(1, ids[0]))], ids[1:])
+        self.assertEqual(drain(self.layer.subscribe(1, ids[-1])), [])
+
+    def test_unknown_last_event_id_resyncs(self):
+        ids = self.publish(self.layer, 1, 3)
+        # the ids of a restarted process reach the same numbers
+        restarted = events.InMemoryEventLayer()
+        self.publish(restarted, 1, 3)
+        for last_event_id in [ids[0], '1', 'invalid', f"{restarted.epoch}-4"]:
+            with self.subTest(last_event_id=last_event_id):
+                self.assertEqual(drain(restarted.subscribe(1, last_event_id)), [(None, events.RESYNC, {})])
+
+    def test_overflow_resyncs(self):
+        subscription = self.layer.subscribe(1)
+        self.publish(self.layer, 1, events.SUBSCRIBER_QUEUE_SIZE + 1)
+        self.assertEqual(drain(subscription), [(None, events.RESYNC, {})])
+
+        ids = self.publish(self.layer, 1, 1)
+        self.assertEqual([id for id, _, _ in drain(subscription)], ids)
+
+
+class DatabaseEventLayerTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.layer = events.DatabaseEventLayer(poll_interval=1, retention=60)
+        # keep the poller from polling, the tests poll themselves
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        self.layer._run = stop.wait
+
+    def publish(self, count, user=None):
+        ids = []
+        for i in range(count):
+            self.layer.publish((user or self.user).id, 'snapshot.created', {'ids': [i]})
+            ids.append(CamerafyEvent.objects.latest('id').id)
+        return ids
+
+    def test_polled_events_are_dispatched_once(self):
+        self.publish(2)
+        subscription = self.layer.subscribe(self.user.id)
+        ids = self.publish(2)
+        self.layer._poll()
+        self.layer._poll()
+        # the events committed before the poller started are not dispatched again
+        self.assertEqual(drain(subscription), [(ids[0], 'snapshot.created', {'ids': [0]}), (ids[1], 'snapshot.created', {'ids': [1]})])
+
+    def test_replay_by_last_event_id(self):
+        other = User.objects.create_user('other', password='password')
+        ids = self.publish(3)
+        self.publish(1, other)
+        self.assertEqual([id for id, _, _ in drain(self.layer.subscribe(self.user.id, str(ids[0])))], ids[1:])
+
+        CamerafyEvent.objects.filter(id__lte=ids[0]).delete()
+        self.assertEqual(drain(self.layer.subscribe(self.user.id, str(ids[0]))), [(None, events.RESYNC, {})])
+        self.assertEqual(drain(self.layer.subscribe(self.user.id, 'invalid')), [(None, events.RESYNC, {})])
+
+    def test_replayed_events_are_not_dispatched_again(self):
+        ids = self.publish(1)
+        listening = self.layer.subscribe(self.user.id)
+        # committed after the poller started but before the client reconnected, so it is both
+        # replayed and polled
+        ids += self.publish(2)
+        reconnected = self.layer.subscribe(self.user.id, str(ids[0]))
+        ids += self.publish(1)
+        self.layer._poll()
+
+        self.assertEqual([id for id, _, _ in drain(listening)], ids[1:])
+        self.assertEqual([id for id, _, _ in drain(reconnected)], ids[1:])
+
+    def test_overflow_resyncs(self):
+        subscription = self.layer.subscribe(self.user.id)
+        CamerafyEvent.objects.bulk_create([
+            CamerafyEvent(user_id=self.user.id, type='snapshot.created', data='{}') for _ in range(events.SUBSCRIBER_QUEUE_SIZE + 1)
+        ])
+        self.layer._poll()
+        self.assertEqual(drain(subscription), [(None, events.RESYNC, {})])
+
+
+class EventStreamTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.layer = events.InMemoryEventLayer()
+        layer_patch = mock.patch.object(events, 'event_layer', self.layer)
+        layer_patch.start()
+        self.addCleanup(layer_patch.stop)
+
+    def stream(self, query='', headers=(), publish=0, count=0):
+        """
+        Requests the event stream from the ASGI middleware, publishes events once it has been
+        opened and returns the response status and the first count body messages.
+        """
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+
+        async def run():
+            messages = asyncio.Queue()
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            scope = {
+                'type': 'http',
+                'method': 'GET',
+                'path': reverse('camerafysnapshot-events'),
+                'query_string': query.encode(),
+                'headers': [(name.encode(), value.encode()) for name, value in headers],
+            }
+            task = asyncio.ensure_future(EventStreamMiddleware(app)(scope, receive, messages.put))
+            start = await asyncio.wait_for(messages.get(), 5)
+            for i in range(publish):
+                self.layer._publish(self.user.id, 'snapshot.created', {'ids': [i]})
+            bodies = [(await asyncio.wait_for(messages.get(), 5))['body'] for _ in range(count)]
+            disconnected.set()
+            await asyncio.wait_for(task, 5)
+            return start['status'], bodies
+
+        return async_to_sync(run)()
+
+    def test_stream_token(self):
+        token, _ = stream_token(self.user.id)
+        status, bodies = self.stream(f"token={token}", publish=1, count=1)
+        self.assertEqual(status, 200)
+        self.assertEqual(bodies, [f"id: {self.layer.epoch}-1\nevent: snapshot.created\ndata: {{\"ids\": [0]}}\n\n".encode()])
+        self.assertNotIn(self.user.id, self.layer._subscribers)
+
+    def test_api_token_only_in_header(self):
+        self.assertEqual(self.stream(headers=[('authorization', f"Token {self.token.key}")])[0], 200)
+        self.assertEqual(self.stream(f"token={self.token.key}")[0], 401)
+
+        token, _ = stream_token(self.user.id, now=time.time() - 3600)
+        self.assertEqual(self.stream(f"token={token}")[0], 401)
+
+        token, _ = stream_token(self.user.id)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.stream(f"token={token}")[0], 401)
+
+    def test_replay_by_last_event_id(self):
+        for i in range(3):
+            self.layer._publish(self.user.id, 'snapshot.created', {'ids': [i]})
+        token, _ = stream_token(self.user.id)
+        last_event_id = f"{self.layer.epoch}-1"
+
+        for query, headers in [(f"token={token}", [('last-event-id', last_event_id)]), (f"token={token}&last_event_id={last_event_id}", [])]:
+            with self.subTest(query=query, headers=headers):
+                status, bodies = self.stream(query, headers, count=2)
+                self.assertEqual(status, 200)
+                self.assertEqual([body.split(b'\n')[0] for body in bodies], [f"id: {self.layer.epoch}-{n}".encode() for n in (2, 3)])
+
+        # ids of a restarted process
+        status, bodies = self.stream(f"token={token}&last_event_id=1", count=1)
+        self.assertEqual(bodies, [b'event: resync\ndata: {}\n\n'])
+
+    def test_passes_other_requests(self):
+        async def run(path):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+            await EventStreamMiddleware(lambda scope, receive, send: send({'type': 'http.response.start', 'status': 204}))(scope, None, send)
+            return messages[0]['status']
+
+        self.assertEqual(async_to_sync(run)('/api/snapshots/'), 204)
+
+
+class EventViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.layer = events.InMemoryEventLayer()
+        layer_patch = mock.patch.object(events, 'event_layer', self.layer)
+        layer_patch.start()
+        self.addCleanup(layer_patch.stop)
+
+    def test_stream_token(self):
+        self.assertEqual(self.client.post('/api/snapshots/stream_token/').status_code, 403)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        response = self.client.post('/api/snapshots/stream_token/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(verify_stream_token(response.data['result']['token']), self.user.id)
+
+        self.client.credentials()
+        response = self.client.get('/api/snapshots/events/', {'token': response.data['result']['token']})
+        self.assertEqual(response.status_code, 200)
+        self.layer._publish(self.user.id, 'snapshot.created', {'ids': [1]})
+        self.assertEqual(next(response.streaming_content), f"id: {self.layer.epoch}-1\nevent: snapshot.created\ndata: {{\"ids\": [1]}}\n\n".encode())
+        response.close()
+        self.assertNotIn(self.user.id, self.layer._subscribers)
+
+    def test_api_token_not_accepted_as_parameter(self):
+        response = self.client.get('/api/snapshots/events/', {'token': self.token.key})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['detail'], 'Malformed stream token.')
+        self.assertEqual(self.layer._subscribers, {})
@@ -0,0 +1,216 @@
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, models, transaction
+
+from . import events, imaging, similarity
+from .models import snapshots as snapshotModels
+from .storage import media_sweeper, snapshot_storage
+
+logger = logging.getLogger(__name__)
+
+
+def store_snapshot_thumbnails(snapshot_id, format, thumbnails, phash=None):
+    """
+    Stores the thumbnails created for a snapshot in given format, a list of (width, height, data)
+    tuples ordered by width, replacing any thumbnails the snapshot already has. Files of replaced
+    thumbnails are removed once committed. The snapshot's perceptual hash is updated if given.
+    Returns False if the snapshot has been deleted.
+    """
+    format = imaging.thumbnail_format(format)
+    with transaction.atomic():
+        # write before reading, so sqlite takes the write lock right away instead of failing to 
+        # upgrade a read lock held by a concurrent transaction
+        if not snapshotModels.CamerafySnapshot.objects.filter(id=snapshot_id).update(
+            thumbnail_status=snapshotModels.CamerafySnapshot.THUMBNAIL_READY,
+            **({'phash': similarity.to_signed(phash)} if phash is not None else {})):
+            # snapshot has been deleted in the meantime
+            return False
+
+        snapshot = snapshotModels.CamerafySnapshot.objects.get(id=snapshot_id)
+        if phash is not None:
+            snapshotModels.CamerafySnapshot.objects.invalidate_hashes([snapshot.author_id])
+
+        replaced = list(snapshotModels.CamerafySnapshotThumbnail.objects.filter(
+            models.Q(snapshot=snapshot) | models.Q(id=snapshot.thumbnail_id)).values_list('id', 'image', 'size'))
+
+        created = [
+            snapshotModels.CamerafySnapshotThumbnail.objects.create(
+                author_id=snapshot.author_id,
+                snapshot=snapshot,
+                format=format,
+                width=width,
+                height=height,
+                size=len(data),
+                image=ContentFile(data, f"{snapshot.title}-{width}.{format}")
+            ) for width, height, data in thumbnails
+        ]
+
+        # the smallest thumbnail is the snapshot's default thumbnail
+        snapshot.thumbnail = created[0]
+        snapshot.save(update_fields=['thumbnail'])
+
+        # the snapshot no longer references the replaced thumbnails, so deleting them does not cascade
+        snapshotModels.CamerafySnapshotThumbnail.objects.filter(id__in=[id for id, _, _ in replaced]).delete()
+        media_sweeper.schedule(snapshot_storage, [name for _, name, _ in replaced])
+
+        snapshotModels.CamerafySnapshotUserStats.objects.add(
+            snapshot.author_id, bytes=sum(t.size for t in created) - sum(size for _, _, size in replaced))
+
+        events.publish(snapshot.author_id, 'snapshot.updated', {'ids': [snapshot.id]})
+
+    return True
+
+
+def replace_thumbnail(thumbnail, owner_model, format, width, height, data):
+    """
+    Replaces a stand-alone thumbnail (e.g. an EnvironmentThumbnail) by a new one with given image
+    data, all owner_model rows referencing it are pointed to the new thumbnail. The replaced file
+    is removed once committed. Returns the new thumbnail, or None if the thumbnail has been deleted.
+    """
+    thumbnail_model = type(thumbnail)
+    with transaction.atomic():
+        # write before reading, see store_snapshot_thumbnails()
+        if not thumbnail_model.objects.filter(id=thumbnail.id).update(size=models.F('size')):
+            return None
+
+        name = os.path.splitext(os.path.basename(thumbnail.image.name))[0]
+        created = thumbnail_model.objects.create(
+            format=format,
+            width=width,
+            height=height,
+            size=len(data),
+            image=ContentFile(data, f"{name}.{format}")
+        )
+
+        owner_model.objects.filter(thumbnail_id=thumbnail.id).update(thumbnail=created)
+        thumbnail_model.objects.filter(id=thumbnail.id).delete()
+        media_sweeper.schedule(thumbnail.image.storage, [thumbnail.image.name])
+
+    return created
+
+
+class ThumbnailWorkerPool:
+    """
+    Generates snapshot thumbnails off-request in a bounded pool of worker processes. The image
+    decoding and resizing happens in the worker processes, storing the resulting thumbnail is done
+    by the pool's result handling thread.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        # notified whenever the last pending job is done
+        self._idle = threading.Condition(self._lock)
+        # statistics
+        self._pending = 0
+        self._processed = 0
+        self._failed = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._last_latency = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _submit(self, fn, *args):
+        try:
+            return self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            # a worker died unexpectedly, start over with a fresh pool
+            self._reset_executor()
+            return self._get_executor().submit(fn, *args)
+
+    def enqueue(self, snapshot_id, path, format, size=None):
+        """
+        Schedules thumbnail generation for a snapshot whose image is stored at path. The image size
+        is required for raw images. Should be called once the transaction creating the snapshot has
+        been committed.
+        """
+        with self._lock:
+            self._pending += 1
+
+        enqueued = time.monotonic()
+        try:
+            future = self._submit(
+                imaging.create_snapshot_thumbnails,
+                path,
+                settings.CAMERAFY_THUMBNAIL_WIDTHS,
+                imaging.thumbnail_format(format),
+                format,
+                size,
+                settings.CAMERAFY_HDR_TONE_MAP)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                self._idle.notify_all()
+            raise
+
+        future.add_done_callback(lambda f: self._on_done(snapshot_id, format, f, enqueued))
+
+    def _on_done(self, snapshot_id, format, future, enqueued):
+        failed = False
+        try:
+            store_snapshot_thumbnails(snapshot_id, format, *future.result())
+        except Exception:
+            failed = True
+            logger.exception(f"Failed to create thumbnail for snapshot {snapshot_id}.")
+            snapshotModels.CamerafySnapshot.objects.filter(id=snapshot_id).update(
+                thumbnail_status=snapshotModels.CamerafySnapshot.THUMBNAIL_FAILED)
+        finally:
+            # this is not a request thread, so django will not clean up the connection for us
+            connection.close()
+
+        latency = time.monotonic() - enqueued
+        with self._lock:
+            self._pending -= 1
+            self._processed += 1
+            self._failed += 1 if failed else 0
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+            self._last_latency = latency
+            self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Waits until all enqueued jobs are done, returns False if the timeout expired before.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self):
+        """
+        Returns the current queue depth and processing latency statistics (in milliseconds).
+        """
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'queue_depth': self._pending,
+                'processed': self._processed,
+                'failed': self._failed,
+                'latency_ms': {
+                    'last': round(self._last_latency * 1000.0, 2),
+                    'avg': round(self._total_latency * 1000.0 / self._processed, 2) if self._processed else 0.0,
+                    'max': round(self._max_latency * 1000.0, 2),
+                }
+            }
+
+
+thumbnail_pool = ThumbnailWorkerPool(settings.CAMERAFY_THUMBNAIL_WORKERS)
@@ -0,0 +1,191 @@
+"""
+Cold storage tier of snapshot images. Old snapshots are recompressed losslessly into a smaller
+file, either as optimized PNG, lossless WebP or zstd compressed original file. Cold snapshots are
+restored to their upload format on access and kept in a size bounded hot cache, so repeated
+downloads do not decompress them again.
+"""
+import os
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import transaction
+from PIL import Image
+
+from . import imaging, pipeline
+from .cache import DiskLRUCache
+from .models import snapshots as snapshotModels
+from .storage import StoredFile, local_file, media_sweeper
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file extension of the files of each cold storage codec
+CODEC_EXTENSIONS = {
+    'png': '.png',
+    'webp': '.webp',
+    'zstd': '.zst',
+}
+
+# formats the image codecs can store without loss, anything else can only be compressed with zstd
+LOSSLESS_IMAGE_FORMATS = ('PNG', 'TGA')
+
+ZSTD_LEVEL = 19
+
+# size of the chunks files are (de)compressed with
+TIER_CHUNK_SIZE = 1024 * 1024
+
+hot_cache = DiskLRUCache(settings.CAMERAFY_HOT_CACHE_DIR, settings.CAMERAFY_HOT_CACHE_BYTES, media_root=settings.MEDIA_ROOT)
+
+
+def available_codecs():
+    """
+    Returns the codecs supported by the installed packages.
+    """
+    return [codec for codec in CODEC_EXTENSIONS if codec != 'zstd' or zstandard is not None]
+
+
+def codec_for(format, codec):
+    """
+    Returns the codec an image in given camerafy image format is compressed with if codec is
+    requested, or None if it cannot be compressed losslessly.
+    """
+    if codec in ('png', 'webp') and format in LOSSLESS_IMAGE_FORMATS:
+        return codec
+    return 'zstd' if zstandard is not None else None
+
+
+def stored_codec(name):
+    """
+    Returns the codec of a cold snapshot file with given storage name.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    return next(codec for codec, e in CODEC_EXTENSIONS.items() if e == extension)
+
+
+def _sample_layout(path):
+    # mode and bits per sample of an image file, palette and bilevel images count as expanded as
+    # they are converted without loss; Pillow opens 16-bit RGB PNGs as 8-bit 'RGB' images
+    with open(path, 'rb') as f:
+        depth = pipeline.png_bit_depth(f)
+        f.seek(0)
+        with Image.open(f) as image:
+            mode = image.mode
+            if mode == 'P':
+                mode = 'RGBA' if image.has_transparency_data else 'RGB'
+            elif mode == '1':
+                mode = 'L'
+    return mode, max(depth or 8, 8)
+
+
+def compress(path, format, codec):
+    """
+    Compresses the image file at path in given camerafy image format with given codec into a
+    temporary file, which is returned. PNGs are written strip by strip. If the image codec cannot
+    keep the image's mode and bit depth, e.g. of 16-bit PNGs, the file is compressed with zstd
+    instead, or None is returned if zstd is not available.
+    """
+    compressed = TemporaryUploadedFile(f"compressed{CODEC_EXTENSIONS[codec]}", 'application/octet-stream', 0, None)
+
+    if codec == 'zstd':
+        with open(path, 'rb') as f:
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(f, compressed.file, read_size=TIER_CHUNK_SIZE)
+    else:
+        image = pipeline.open_strips(path, format) if codec == 'png' else None
+        if image is not None and image.lossless:
+            image.save(compressed.file, 'PNG', compress_level=9)
+        else:
+            # the WebP encoder needs the whole image, so do PNGs with more than 8 bits per sample
+            with Image.open(path) as image:
+                if codec == 'png':
+                    image.save(compressed.file, 'PNG', optimize=True)
+                else:
+                    image.save(compressed.file, 'WEBP', lossless=True, quality=100, method=6)
+
+    compressed.file.flush()
+    # the original file is swept once the snapshot is tiered, so it has to be restorable
+    if codec != 'zstd' and _sample_layout(compressed.temporary_file_path()) != _sample_layout(path):
+        compressed.close()
+        return compress(path, format, 'zstd') if zstandard is not None else None
+
+    compressed.size = compressed.file.tell()
+    return compressed
+
+
+def tier_snapshot(snapshot, codec, dry_run=False):
+    """
+    Moves a hot snapshot into the cold tier. Returns the file sizes before and after compression,
+    or None if the snapshot was left in the hot tier because the codec does not apply to its format,
+    would lose samples or would not make it smaller.
+    """
+    codec = codec_for(snapshot.format, codec)
+    if codec is None:
+        return None
+
+    old_name = snapshot.image.name
+    old_size = snapshot.image.size
+
+    compressed = compress(local_file(snapshot.image).path, snapshot.format, codec)
+    if compressed is None:
+        return None
+    try:
+        new_size = compressed.size
+        if new_size >= old_size:
+            return None
+        if dry_run:
+            return old_size, new_size
+
+        new_name = snapshot.image.storage.save(snapshot.image.field.generate_filename(snapshot, compressed.name), compressed)
+    finally:
+        compressed.close()
+
+    with transaction.atomic():
+        updated = snapshotModels.CamerafySnapshot.objects.filter(
+            id=snapshot.id, image=old_name, tier=snapshotModels.CamerafySnapshot.TIER_HOT
+        ).update(image=new_name, tier=snapshotModels.CamerafySnapshot.TIER_COLD)
+
+        # the snapshot has been deleted or tiered concurrently, give up the compressed file
+        media_sweeper.schedule(snapshot.image.storage, [old_name if updated else new_name])
+
+    if not updated:
+        return None
+
+    snapshot.image.name = new_name
+    snapshot.tier = snapshotModels.CamerafySnapshot.TIER_COLD
+    return old_size, new_size
+
+
+def _restore(path, format, codec, f):
+    if codec == 'zstd':
+        with open(path, 'rb') as source:
+            zstandard.ZstdDecompressor().copy_stream(source, f, write_size=TIER_CHUNK_SIZE)
+    else:
+        pipeline.open_strips(path).save(f, imaging.PIL_FORMATS[format])
+
+
+def open_cold_image(name, format):
+    """
+    Returns the cold snapshot file with given storage name in its upload format, restored into the
+    hot cache first. Only needs the name and format, so it works without a database lookup.
+    """
+    codec = stored_codec(name)
+    if codec == 'png' and format == 'PNG':
+        # an optimized PNG is still a PNG
+        return StoredFile(name)
+
+    extension = f".{format.lower()}"
+    image = hot_cache.get(name, extension)
+    if image is None:
+        image = hot_cache.put(name, lambda f: _restore(local_file(StoredFile(name)).path, format, codec, f), extension)
+    return image
+
+
+def open_image(snapshot):
+    """
+    Returns the image file of a snapshot in its upload format. Hot snapshots are returned as
+    stored, cold snapshots are restored into the hot cache first.
+    """
+    if snapshot.tier == snapshotModels.CamerafySnapshot.TIER_HOT:
+        return snapshot.image
+    return open_cold_image(snapshot.image.name, snapshot.format)
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.files import File
+
+# size of the chunks request bodies are read and hashed with
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class ChunkedUploadFile(File):
+    """
+    A completely received chunked upload. Storages can move the file into place instead of copying
+    it and reuse the hash computed while receiving it.
+    """
+
+    def __init__(self, path, content_hash):
+        # the file is not opened, so storages can move it on every platform
+        super().__init__(None, name=os.path.basename(path))
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.content_hash = content_hash
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class ChunkedUploadWriter:
+    """
+    Writes chunks of resumable uploads straight to disk while keeping the SHA-256 of the data
+    received so far. Hash states are kept in memory; if a state is unknown (e.g. the upload is
+    resumed on another process or after a restart) it is rebuilt from the partial file.
+
+    A chunk is received into a staging file of its own first and only appended to the partial file
+    by the request which advanced the upload's offset, so concurrent requests sending data for the
+    same offset never interleave their writes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = {}
+
+    def path(self, upload):
+        return os.path.join(settings.CAMERAFY_UPLOAD_DIR, f"{upload.id}.part")
+
+    def _hash_state(self, upload, path):
+        with self._lock:
+            state = self._hashes.pop(upload.id, None)
+
+        if state is not None and state[0] == upload.offset:
+            return state[1]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            remaining = upload.offset
+            while remaining > 0:
+                chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                digest.update(chunk)
+        return digest
+
+    def create(self, upload):
+        os.makedirs(settings.CAMERAFY_UPLOAD_DIR, exist_ok=True)
+        open(self.path(upload), 'wb').close()
+        with self._lock:
+            self._hashes[upload.id] = (0, hashlib.sha256())
+
+    def receive(self, upload, stream, length=None):
+        """
+        Reads a chunk of the upload from stream into a new staging file and returns its path, which
+        has to be passed to append() or removed by the caller. Data received before the client
+        connection dropped is kept, so the client can resume right after it.
+        """
+        fd, path = tempfile.mkstemp(prefix=f"{upload.id}.", suffix='.chunk', dir=settings.CAMERAFY_UPLOAD_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            remaining = length
+            while remaining is None or remaining > 0:
+                try:
+                    chunk = stream.read(UPLOAD_CHUNK_SIZE if remaining is None else min(UPLOAD_CHUNK_SIZE, remaining))
+                except OSError:
+                    # client connection dropped, keep what has been received so far
+                    break
+                if not chunk:
+                    break
+                f.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+        return path
+
+    def append(self, upload, chunk_path):
+        """
+        Appends a received chunk to the upload's partial file at upload.offset and returns the new
+        offset. Must only be called by the request whose transaction advanced the upload's offset
+        from upload.offset, which keeps the upload row locked until it is committed.
+        """
+        path = self.path(upload)
+        digest = self._hash_state(upload, path)
+        offset = upload.offset
+
+        with open(path, 'r+b') as f, open(chunk_path, 'rb') as chunk_file:
+            # drop anything written after the last acknowledged offset
+            f.truncate(offset)
+            f.seek(offset)
+            while True:
+                chunk = chunk_file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                offset += len(chunk)
+
+        # if writing failed, the hash state is rebuilt from the partial file next time
+        with self._lock:
+            self._hashes[upload.id] = (offset, digest)
+
+        return offset
+
+    def finalize(self, upload):
+        """
+        Returns the completely received upload as file, ready to be passed to a storage.
+        """
+        path = self.path(upload)
+        digest = self._hash_state(upload, path)
+        with open(path, 'r+b') as f:
+            f.truncate(upload.offset)
+        return ChunkedUploadFile(path, digest.hexdigest())
+
+    def discard(self, upload_id):
+        """
+        Removes the partial file and hash state of the upload with given id.
+        """
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+
+        path = os.path.join(settings.CAMERAFY_UPLOAD_DIR, f"{upload_id}.part")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+upload_writer = ChunkedUploadWriter()
@@ -5,18 +5,22 @@ from rest_framework.routers import DefaultRouter
 
 from .views.auth import userauth
 from .views.snapshots import snapshots
+from .views.uploads import snapshot_uploads
 from .views.environments import environments
 from .views.camfymodels import camfymodels
 from .views.touchpoints import touchpoints
+from .views.media import signed_media
 
 # Create a router and register our viewsets with it.
 router = DefaultRouter()
 router.register('snapshots', snapshots)
+router.register('snapshot-uploads', snapshot_uploads)
 router.register('environments', environments)
 router.register('models', camfymodels)
 router.register('touchpoints', touchpoints)
 
 urlpatterns = router.urls
 urlpatterns += [
-    url(r'^user-auth/', userauth.as_view())
+    url(r'^user-auth/', userauth.as_view()),
+    path('media/<path:name>', signed_media, name='signed-media')
 ]
\ No newline at end of file
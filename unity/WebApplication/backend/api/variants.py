@@ -0,0 +1,110 @@
+"""
+Transcoded variants of snapshot images for clients which cannot display the upload format, e.g.
+browsers and TGA or EXR. The variant format is negotiated from the 'Accept' request header or
+given explicitly with '?format='. Variants are encoded once and kept in a size bounded on-disk cache.
+"""
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+
+from . import imaging
+from .cache import DiskLRUCache
+from .models.common import IMAGE_FORMAT_MIME_TYPES
+
+# formats snapshots can be transcoded to and their mime types, in order of preference
+VARIANT_FORMATS = {
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+    'JPG': 'image/jpeg',
+}
+
+# formats every browser can display as is
+WEB_FORMATS = ('PNG', 'JPG')
+
+# accepted values of the '?format=' query parameter
+FORMAT_PARAM_VALUES = {
+    'original': None,
+    'webp': 'WEBP',
+    'png': 'PNG',
+    'jpg': 'JPG',
+    'jpeg': 'JPG',
+}
+
+variant_cache = DiskLRUCache(settings.CAMERAFY_VARIANT_CACHE_DIR, settings.CAMERAFY_VARIANT_CACHE_BYTES, media_root=settings.MEDIA_ROOT)
+
+
+def parse_accept_header(header):
+    """
+    Returns a dict mapping the media ranges of an 'Accept' header to their quality.
+    """
+    accepted = {}
+    for entry in (header or '').split(','):
+        media_range, *params = [part.strip() for part in entry.split(';')]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_range.lower()] = max(quality, accepted.get(media_range.lower(), 0.0))
+    return accepted
+
+
+def negotiate_format(request, format, use_accept=True):
+    """
+    Returns the format an image in given camerafy image format is served in, or None to serve it
+    as is. Raises ParseError for an unknown '?format=' value.
+    """
+    if 'format' in request.query_params:
+        value = request.query_params['format'].lower()
+        if value not in FORMAT_PARAM_VALUES:
+            raise ParseError({'error': f"'format' must be one of {', '.join(FORMAT_PARAM_VALUES)}."})
+        target = FORMAT_PARAM_VALUES[value]
+        if target is None or target == format:
+            return None
+        if not imaging.can_decode(format):
+            raise ParseError({'error': f"{format} images cannot be transcoded."})
+        return target
+
+    if not use_accept or not imaging.can_decode(format):
+        return None
+
+    # clients not asking for any image type in particular get the upload format
+    accepted = parse_accept_header(request.META.get('HTTP_ACCEPT'))
+    if not any(media_range.startswith('image/') for media_range in accepted):
+        return None
+
+    def quality(mime_type, explicit=False):
+        if mime_type in accepted or explicit:
+            return accepted.get(mime_type, 0.0)
+        return accepted.get(f"{mime_type.split('/')[0]}/*", accepted.get('*/*', 0.0))
+
+    # keep the upload format if the client accepts it, wildcards only count for formats browsers display
+    if quality(IMAGE_FORMAT_MIME_TYPES[format], explicit=format not in WEB_FORMATS) > 0:
+        return None
+
+    candidates = [(quality(mime_type), -index, target) for index, (target, mime_type) in enumerate(VARIANT_FORMATS.items())]
+    best_quality, _, target = max(candidates)
+    return target if best_quality > 0 else None
+
+
+def get_variant(key, path, format, source_format=None, source_size=None):
+    """
+    Returns the cached variant of the image at path in given variant format. The variant is encoded
+    on the first request; key identifies the source image, i.e. snapshot and size, and has to change
+    whenever its content changes. HDR images are tone-mapped, raw images require source_size.
+    """
+    extension = f".{format.lower()}"
+    key = f"{key}|{format}"
+
+    variant = variant_cache.get(key, extension)
+    if variant is None:
+        variant = variant_cache.put(
+            key,
+            lambda f: imaging.transcode_image(
+                path, f, format, settings.CAMERAFY_VARIANT_QUALITY, source_format, source_size, settings.CAMERAFY_HDR_TONE_MAP),
+            extension)
+    return variant
@@ -1,3 +1,7 @@
+from types import SimpleNamespace
+
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
 
 def verify_request_data(request_data, required_data = []):
     """
@@ -9,4 +13,18 @@ def verify_request_data(request_data, required_data = []):
         if r not in data_fields:
             missing.append(r)
 
-    return missing
\ No newline at end of file
+    return missing
+
+class FormatParamContentNegotiation(DefaultContentNegotiation):
+    """
+    Content negotiation not treating the '?format=' query parameter as renderer override, for 
+    endpoints using it as image format parameter. Requests only accepting image types are not
+    rejected, as image responses bypass the renderers; errors are rendered by the default renderer.
+    """
+    settings = SimpleNamespace(URL_FORMAT_OVERRIDE=None)
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return renderers[0], renderers[0].media_type
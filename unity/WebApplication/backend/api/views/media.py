@@ -0,0 +1,142 @@
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from .. import tiering
+from ..models.common import IMAGE_FORMAT_MIME_TYPES
+from ..signing import InvalidSignature, verify_media_url
+from ..storage import StoredFile, is_local, media_stat, open_media
+
+# size of the chunks a media file is streamed with
+MEDIA_STREAM_CHUNK_SIZE = 64 * 1024
+
+RANGE_HEADER_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range_header(header, size):
+    """
+    Parses a single 'bytes=<start>-<end>' range header and returns the inclusive (start, end)
+    byte positions. Returns None if the header is missing or not supported (e.g. multiple ranges),
+    in which case the whole file should be sent. Raises ValueError if the range is unsatisfiable.
+    """
+    if not header:
+        return None
+
+    match = RANGE_HEADER_RE.match(header.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+
+    if start == '':
+        # suffix range, e.g. 'bytes=-500' for the last 500 bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end != '' else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+
+    return start, end
+
+
+def stream_file(f, start, end, chunk_size=MEDIA_STREAM_CHUNK_SIZE):
+    """
+    Yields the inclusive byte range [start, end] of a media file opened at start in chunks and
+    closes the file.
+    """
+    with f:
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def media_response(request, file, content_type, filename=None):
+    """
+    Returns a binary response for a stored media file. The file is streamed in chunks and the
+    'Range' and 'If-Modified-Since' request headers are honored. If 'CAMERAFY_MEDIA_SENDFILE' is
+    configured the actual transfer is handed over to the front web server, so this must only be
+    called after all permission checks passed. Raises FileNotFoundError if the file is missing.
+    """
+    size, mtime = media_stat(file)
+
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime, size):
+        return HttpResponseNotModified()
+
+    sendfile = getattr(settings, 'CAMERAFY_MEDIA_SENDFILE', None)
+    if sendfile == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = f"{settings.CAMERAFY_MEDIA_ACCEL_PREFIX.rstrip('/')}/{file.name}"
+    elif sendfile == 'x-sendfile' and (not hasattr(file, 'storage') or is_local(file.storage)):
+        # only files on the local file system can be sent by path
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = file.path
+    else:
+        try:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{size}"
+            return response
+
+        start, end = byte_range if byte_range is not None else (0, size - 1)
+        # opened right away, so a cache entry evicted while it is being sent is still sent whole
+        f = open_media(file, start, end)
+        if byte_range is None:
+            response = StreamingHttpResponse(stream_file(f, start, end), content_type=content_type)
+        else:
+            response = StreamingHttpResponse(stream_file(f, start, end), content_type=content_type, status=206)
+            response['Content-Range'] = f"bytes {start}-{end}/{size}"
+
+        response['Content-Length'] = str(end - start + 1) if size else '0'
+        response['Accept-Ranges'] = 'bytes'
+
+    response['Last-Modified'] = http_date(mtime)
+    if filename is not None:
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+
+    return response
+
+
+def signed_media(request, name):
+    """
+    Serves the media file with given storage name to the holder of a valid signed URL, see
+    backend.api.signing. Neither the user nor any other database row is loaded. Responses may be
+    cached publicly until the URL expires.
+    """
+    try:
+        format, expires = verify_media_url(name, request.GET)
+    except InvalidSignature as e:
+        return HttpResponseForbidden(str(e))
+
+    if name.startswith('/') or '..' in name.replace('\\', '/').split('/'):
+        raise Http404(name)
+
+    extension = os.path.splitext(name)[1][1:].upper()
+    content_type = IMAGE_FORMAT_MIME_TYPES.get(format or extension, 'application/octet-stream')
+
+    try:
+        file = tiering.open_cold_image(name, format) if format is not None else StoredFile(name)
+        response = media_response(request, file, content_type)
+    except (SuspiciousFileOperation, FileNotFoundError, StopIteration):
+        # outside of the media storage, missing, or not a cold snapshot file
+        raise Http404(name)
+
+    patch_cache_control(response, public=True, max_age=max(0, expires - int(time.time())))
+    return response
@@ -1,26 +1,49 @@
 import requests
 import json
-import time
 import base64
-import os
+import datetime
+import hashlib
 
 from django.conf import settings
 from django.shortcuts import render
-from django.db import transaction
 from django.contrib.auth.models import User
-from django.core.files import File
+from django.http import HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from rest_framework import viewsets, mixins, permissions, authentication
 from rest_framework.response import Response
 from rest_framework.decorators import action, permission_classes
+from rest_framework.exceptions import ParseError
+from rest_framework.settings import api_settings
 
-from PIL import Image  
-from io import BytesIO
-
-from .common import verify_request_data
+from .common import verify_request_data, FormatParamContentNegotiation
+from .media import media_response
 
+from .. import events, export, imaging, signing, similarity, tiering, variants
+from ..authentication import StreamTokenAuthentication
+from ..cache import DiskLRUCache
 from ..models import snapshots as snapshotModels
+from ..pagination import SnapshotCursorPagination
 from ..serializers import snapshots as snapshotSerializers
-from ..permissions import IsCamerafySession
+from ..serializers.common import thumbnail_cache
+from ..signing import signed_media_url
+from ..storage import local_file, open_media
+from ..permissions import IsCamerafyEditor, IsCamerafySession
+from ..thumbnails import thumbnail_pool
+
+# atlas images and their indexes, keyed by the atlas key
+atlas_cache = DiskLRUCache(settings.CAMERAFY_ATLAS_CACHE_DIR, settings.CAMERAFY_ATLAS_CACHE_BYTES, media_root=settings.MEDIA_ROOT)
+
+
+def retry_evicted(respond):
+    """
+    Returns respond(), which is called once more if it raised FileNotFoundError, e.g. because a 
+    concurrent request evicted the cache entry it was about to send. The retry finds the entry 
+    missing and rebuilds it.
+    """
+    try:
+        return respond()
+    except FileNotFoundError:
+        return respond()
 
 class snapshots(
     mixins.RetrieveModelMixin,
@@ -32,62 +55,415 @@ class snapshots(
 
     queryset = snapshotModels.CamerafySnapshot.objects.all()
     serializer_class = snapshotSerializers.CamerafySnapshotSerializer
+    pagination_class = SnapshotCursorPagination
+    content_negotiation_class = FormatParamContentNegotiation
+
+    def get_user_snapshots(self, request):
+        """
+        Returns the snapshots of the requesting user, filtered by the optional query parameters
+        'created_after', 'created_before' (ISO dates, inclusive), 'seen' and 'format'.
+        """
+        if not request.user.is_authenticated:
+            return snapshotModels.CamerafySnapshot.objects.none()
+
+        queryset = snapshotModels.CamerafySnapshot.objects.filter(author=request.user)
+        params = request.query_params
+
+        try:
+            if 'created_after' in params:
+                queryset = queryset.filter(created__gte=datetime.date.fromisoformat(params['created_after']))
+            if 'created_before' in params:
+                queryset = queryset.filter(created__lte=datetime.date.fromisoformat(params['created_before']))
+        except ValueError:
+            raise ParseError({'error': "'created_after' and 'created_before' must be ISO dates (YYYY-MM-DD)."})
+
+        if 'seen' in params:
+            if params['seen'].lower() not in ('true', 'false', '1', '0'):
+                raise ParseError({'error': "'seen' must be 'true' or 'false'."})
+            queryset = queryset.filter(seen=params['seen'].lower() in ('true', '1'))
+
+        if 'format' in params:
+            queryset = queryset.filter(format__in=params['format'].upper().split(','))
+
+        return queryset
 
     def list(self, request, *args, **kwargs):
-        queryset = snapshotModels.CamerafySnapshot.objects.filter(author=request.user) if request.user.is_authenticated else []
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = self.get_user_snapshots(request).select_related('thumbnail')
+        if 'thumbnail_width' in request.query_params:
+            queryset = queryset.prefetch_related('thumbnails')
+
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     def perform_destroy(self, instance):
         """
-        Delete media files before removing instance.
+        Removes the instance, its media files are deleted in the background.
         """
-        # delete thumbnail
-        os.remove(snapshotModels.CamerafySnapshotThumbnail.objects.get(id=instance.thumbnail.id).image.path)
-        # deleta snapshot
-        os.remove(instance.image.path)
-        
-        # remove entity from database
-        instance.delete()
+        snapshotModels.CamerafySnapshot.objects.delete_snapshots([instance.id])
+
+    def get_requested_ids(self, request):
+        """
+        Returns the snapshot ids listed in 'ids' of the request data, or None if they are not a
+        list of ids.
+        """
+        serializer = snapshotSerializers.SnapshotIdsSerializer(data=request.data)
+        return serializer.validated_data['ids'] if serializer.is_valid() else None
+
+    @action(methods=['post'], detail=False)
+    def bulk_delete(self, request):
+        """
+        Deletes multiple snapshots of the requesting user in a single transaction, either all 
+        snapshots listed in 'ids' or all snapshots matching the list filter query parameters.
+        """
+        queryset = self.get_user_snapshots(request)
+
+        if 'ids' in request.data:
+            ids = self.get_requested_ids(request)
+            if ids is None:
+                return Response({'error': "'ids' must be a list of snapshot ids."}, status=400)
+            queryset = queryset.filter(id__in=ids)
+        elif not any(f in request.query_params for f in ['created_after', 'created_before', 'seen', 'format']):
+            return Response({'error': "Either 'ids' or at least one filter is required."}, status=400)
+
+        deleted = snapshotModels.CamerafySnapshot.objects.delete_snapshots(queryset.values_list('id', flat=True))
+
+        return Response({'result': {'deleted': deleted}})
+
+    @action(methods=['get'], detail=False)
+    def unseen(self, request):
+        """
+        Returns the number of unseen snapshots of the requesting user.
+        """
+        unseen = snapshotModels.CamerafySnapshotUserStats.objects.unseen(request.user.id) if request.user.is_authenticated else 0
+        return Response({'result': {'unseen': unseen}})
+
+    @action(methods=['get'], detail=False)
+    def usage(self, request):
+        """
+        Returns number of snapshots, bytes used and storage quota of the requesting user.
+        """
+        if not request.user.is_authenticated:
+            return Response({'result': {'snapshots': 0, 'bytes_used': 0, 'quota': None}})
+        return Response({'result': snapshotModels.CamerafySnapshotUserStats.objects.usage(request.user.id)})
+
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def stream_token(self, request):
+        """
+        Returns a short-lived token authenticating the requesting user's event stream, see 'events'.
+        """
+        token, expires = signing.stream_token(request.user.id)
+        return Response({'result': {'token': token, 'expires': expires}})
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAuthenticated],
+        authentication_classes=[*api_settings.DEFAULT_AUTHENTICATION_CLASSES, StreamTokenAuthentication])
+    def events(self, request):
+        """
+        Streams the 'snapshot.created', 'snapshot.updated' (thumbnail ready), 'snapshot.deleted' and
+        'snapshot.seen' events of the requesting user as server-sent events, so clients only fetch
+        the changed snapshots. EventSource clients, which cannot send the API token, authenticate
+        with '?token=<token>' of a 'stream_token'; it is only checked when connecting.
+        Reconnecting clients receive the events they missed since their 'Last-Event-ID' header or
+        '?last_event_id=' parameter, or a 'resync' event if these are no longer known. Served
+        natively by the ASGI application, under WSGI every connected client occupies a worker thread.
+        """
+        last_event_id = events.parse_last_event_id(request.META.get('HTTP_LAST_EVENT_ID') or request.query_params.get('last_event_id'))
+        subscription = events.event_layer.subscribe(request.user.id, last_event_id)
+
+        response = StreamingHttpResponse(events.stream_events(subscription), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # keep nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @action(methods=['get'], detail=False, permission_classes=[permissions.IsAdminUser])
+    def top_consumers(self, request):
+        """
+        Returns the users using the most storage, at most '?limit=<n>' (default 20).
+        """
+        limit = request.query_params.get('limit', '20')
+        if not limit.isdigit():
+            return Response({'error': "'limit' must be a positive number."}, status=400)
+
+        stats = snapshotModels.CamerafySnapshotUserStats.objects.select_related('user').order_by('-bytes_used')[:min(int(limit), 1000)]
+        return Response({'result': [{
+            'userid': s.user_id,
+            'username': s.user.username,
+            'snapshots': s.snapshot_count,
+            'bytes_used': s.bytes_used,
+            'quota': s.quota if s.quota is not None else settings.CAMERAFY_DEFAULT_QUOTA
+        } for s in stats]})
+
+    @action(methods=['post'], detail=False, permission_classes=[permissions.IsAdminUser])
+    def quota(self, request):
+        """
+        Sets the storage 'quota' in bytes of user 'userid'. Without 'quota' the default quota applies.
+        """
+        missing_data = verify_request_data(request.data, [
+            'userid'
+        ])
+
+        if len(missing_data):
+            return Response({'error': f"Missing required data field '{', '.join(missing_data)}'."}, status=400)
+
+        try:
+            user_id = request.data['userid']
+            user = User.objects.get(id=user_id)
+            quota = int(request.data['quota']) if request.data.get('quota') not in (None, '') else None
+        except User.DoesNotExist:
+            return Response({'error': f"User id '{user_id}' is unknown."}, status=400)
+        except (TypeError, ValueError):
+            return Response({'error': "'quota' must be a number of bytes."}, status=400)
+
+        snapshotModels.CamerafySnapshotUserStats.objects.update_or_create(user=user, defaults={'quota': quota})
+
+        return Response({'result': snapshotModels.CamerafySnapshotUserStats.objects.usage(user.id)})
+
+    @action(methods=['post'], detail=False)
+    def mark_seen(self, request):
+        """
+        Sets the 'seen' flag of multiple snapshots of the requesting user with a single update, 
+        either of all snapshots listed in 'ids' or of all snapshots matching the list filter query
+        parameters. Snapshots are marked as unseen if 'seen' is false.
+        """
+        queryset = self.get_user_snapshots(request)
+
+        if 'ids' in request.data:
+            ids = self.get_requested_ids(request)
+            if ids is None:
+                return Response({'error': "'ids' must be a list of snapshot ids."}, status=400)
+        elif any(f in request.query_params for f in ['created_after', 'created_before', 'seen', 'format']):
+            ids = queryset.values_list('id', flat=True)
+        else:
+            return Response({'error': "Either 'ids' or at least one filter is required."}, status=400)
+
+        seen = request.data.get('seen', True)
+        if isinstance(seen, str):
+            if seen.lower() not in ('true', 'false', '1', '0'):
+                return Response({'error': "'seen' must be 'true' or 'false'."}, status=400)
+            seen = seen.lower() in ('true', '1')
+
+        updated = snapshotModels.CamerafySnapshot.objects.set_seen(request.user.id, ids, bool(seen))
+
+        return Response({'result': {
+            'updated': updated,
+            'unseen': snapshotModels.CamerafySnapshotUserStats.objects.unseen(request.user.id)
+        }})
 
     @action(methods=['get'], detail=True)
     def download(self, request, *args, **kwargs):
         """
-        Downloads an image as base64 encoded string.
+        Downloads an image as base64 encoded string. If requested with '?mode=binary' the raw image 
+        file is streamed instead, supporting 'Range' and 'If-Modified-Since' request headers. Cold
+        snapshots are transparently restored to their upload format. '?mode=url' returns an expiring
+        signed URL of the image instead, which is served without the API. Binary downloads are 
+        transcoded to WebP, PNG or JPEG if the 'Accept' header asks for it, both modes can request a
+        format explicitly with '?format=<webp|png|jpg|original>'.
         """
         snapshot = self.get_object()
+        mode = request.query_params.get('mode', 'base64')
+        binary = mode == 'binary'
+
+        if mode == 'url':
+            # the signed URL is fetched without going through the API, see backend.api.signing
+            snapshotModels.CamerafySnapshot.objects.set_seen(snapshot.author_id, [snapshot.id])
+            format = snapshot.format if snapshot.tier == snapshotModels.CamerafySnapshot.TIER_COLD else None
+            return Response({'result': {'url': signed_media_url(snapshot.image.name, request.user.id, format, request)}})
+
+        format = variants.negotiate_format(request, snapshot.format, use_accept=binary)
+
+        def respond():
+            image = tiering.open_image(snapshot)
+            if format is not None:
+                image = variants.get_variant(
+                    f"{snapshot.id}|{snapshot.image.name}", local_file(image).path, format, snapshot.format, (snapshot.width, snapshot.height))
+
+            if binary:
+                response = media_response(
+                    request, 
+                    image, 
+                    variants.VARIANT_FORMATS[format] if format is not None else snapshotModels.IMAGE_FORMAT_MIME_TYPES[snapshot.format], 
+                    filename=f"{snapshot.title}.{(format or snapshot.format).lower()}")
+                patch_vary_headers(response, ['Accept'])
+                return response
+
+            base64_image = ""
+            with open_media(image) as f:
+                base64_image = base64.b64encode(f.read())
+
+            return Response({'result': 
+            {
+                'title': snapshot.title,
+                'width': snapshot.width,
+                'hegith': snapshot.height,
+                'format': format or snapshot.format,
+                'base64_image': base64_image,
+            }})
 
-        base64_image = ""
-        with open(snapshot.image.path, 'rb') as f:
-            image = File(f)
-            base64_image = base64.b64encode(image.read())
+        response = retry_evicted(respond)
 
         # mark this snapshot as 'seen'
-        snapshot.seen = True
-        snapshot.save()
+        snapshotModels.CamerafySnapshot.objects.set_seen(snapshot.author_id, [snapshot.id])
+
+        return response
+
+    @action(methods=['get'], detail=False)
+    def export(self, request):
+        """
+        Downloads the snapshots of the requesting user matching the list filter query parameters 
+        (e.g. '?seen=false' for unseen snapshots only) as ZIP archive. The archive is streamed while
+        it is generated, images are stored in their upload format without recompression.
+        """
+        snapshots = self.get_user_snapshots(request).order_by('created', 'id').only(
+            'id', 'title', 'format', 'created', 'image', 'tier')
+
+        response = StreamingHttpResponse(export.stream_snapshots_zip(snapshots.iterator()), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="snapshots-{request.user.username}.zip"'
+        return response
+
+    @action(methods=['get'], detail=True)
+    def thumbnail(self, request, *args, **kwargs):
+        """
+        Downloads the snapshot's thumbnail image. The closest available size can be requested 
+        with '?width=<width>', the format is negotiated like for binary downloads.
+        """
+        snapshot = self.get_object()
+
+        width = request.query_params.get('width')
+        thumbnail = snapshot.closest_thumbnail(int(width)) if width is not None and width.isdigit() else snapshot.thumbnail
+        if thumbnail is None:
+            return Response({'error': f"Thumbnail of snapshot '{snapshot.id}' is {snapshot.thumbnail_status}."}, status=404)
+
+        format = variants.negotiate_format(request, thumbnail.format)
+
+        def respond():
+            image = thumbnail.image
+            if format is not None:
+                image = variants.get_variant(f"{snapshot.id}|{thumbnail.width}|{thumbnail.image.name}", local_file(image).path, format)
+
+            return media_response(
+                request,
+                image,
+                variants.VARIANT_FORMATS[format] if format is not None else snapshotModels.IMAGE_FORMAT_MIME_TYPES[thumbnail.format],
+                filename=f"{snapshot.title}-{thumbnail.width}.{(format or thumbnail.format).lower()}")
+
+        response = retry_evicted(respond)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    @action(methods=['get'], detail=True)
+    def similar(self, request, *args, **kwargs):
+        """
+        Returns the requesting user's snapshots which are near-duplicates of this snapshot, closest
+        first. The maximum number of differing perceptual hash bits can be given with 
+        '?distance=<n>' (0-64).
+        """
+        snapshot = self.get_object()
+        if snapshot.phash is None:
+            return Response({'error': f"Perceptual hash of snapshot '{snapshot.id}' is {snapshot.thumbnail_status}."}, status=404)
+
+        distance = request.query_params.get('distance', str(settings.CAMERAFY_DUPLICATE_DISTANCE))
+        if not distance.isdigit() or int(distance) > similarity.HASH_BITS:
+            return Response({'error': "'distance' must be a number of bits between 0 and 64."}, status=400)
+
+        matches = snapshotModels.CamerafySnapshot.objects.similar(snapshot.author_id, snapshot.phash, int(distance), exclude_id=snapshot.id)
+        titles = dict(snapshotModels.CamerafySnapshot.objects.filter(id__in=[id for id, _ in matches]).values_list('id', 'title'))
+
+        return Response({'result': [{'id': id, 'title': titles[id], 'distance': d} for id, d in matches if id in titles]})
+
+    def get_atlas(self, request):
+        """
+        Returns the atlas key and the thumbnails of the requested page.
+        """
+        page = self.paginate_queryset(self.get_user_snapshots(request).prefetch_related('thumbnails'))
+
+        width = request.query_params.get('thumbnail_width')
+        thumbnails = [(s, s.closest_thumbnail(int(width)) if width is not None and width.isdigit() else s.thumbnail) for s in page]
+        thumbnails = [(s, t) for s, t in thumbnails if t is not None]
+
+        # the key changes with the page's contents, so a cached atlas is never outdated
+        content = ';'.join(f"{s.id}:{t.id}:{t.image.name}" for s, t in thumbnails)
+        key = hashlib.sha1(f"{settings.CAMERAFY_ATLAS_COLUMNS}|{content}".encode()).hexdigest()
+        return key, thumbnails
+
+    def build_atlas(self, key, thumbnails):
+        """
+        Returns the tuple (index, image) of the cached atlas with given key, building it if
+        necessary. The index holds the atlas' dimensions, format and entries, the image is the
+        cached atlas image file.
+        """
+        extension = f".{settings.CAMERAFY_ATLAS_FORMAT.lower()}"
+        index_file = atlas_cache.get(key, '.json')
+        image = atlas_cache.get(key, extension)
+        if index_file is None or image is None:
+            width, height, data, boxes = imaging.create_atlas(
+                [local_file(t.image).path for s, t in thumbnails], 
+                settings.CAMERAFY_ATLAS_COLUMNS,
+                settings.CAMERAFY_ATLAS_FORMAT)
+            index = {
+                'width': width,
+                'height': height,
+                'format': settings.CAMERAFY_ATLAS_FORMAT,
+                'entries': [{'id': s.id, 'x': x, 'y': y, 'width': w, 'height': h} for (s, t), (x, y, w, h) in zip(thumbnails, boxes)]
+            }
+            image = atlas_cache.put(key, lambda f: f.write(data), extension)
+            atlas_cache.put(key, lambda f: f.write(json.dumps(index).encode()), '.json')
+        else:
+            with open(index_file.path, 'rb') as f:
+                index = json.load(f)
+        return index, image
+
+    @action(methods=['get'], detail=False)
+    def atlas(self, request):
+        """
+        Returns the index of the thumbnail atlas of the requested snapshot list page, that is the 
+        position of each snapshot's thumbnail in the atlas image. The atlas image itself is served
+        by 'atlas/image' for the same query parameters.
+        """
+        key, thumbnails = self.get_atlas(request)
+        atlas, _ = retry_evicted(lambda: self.build_atlas(key, thumbnails))
 
         return Response({'result': 
         {
-            'title': snapshot.title,
-            'width': snapshot.width,
-            'hegith': snapshot.height,
-            'format': snapshot.format,
-            'base64_image': base64_image,
+            'key': key,
+            'width': atlas['width'],
+            'height': atlas['height'],
+            'format': atlas['format'],
+            'entries': atlas['entries'],
         }})
 
+    @action(methods=['get'], detail=False, url_path='atlas/image')
+    def atlas_image(self, request):
+        """
+        Returns the thumbnail atlas image of the requested snapshot list page.
+        """
+        key, thumbnails = self.get_atlas(request)
+
+        if request.META.get('HTTP_IF_NONE_MATCH') == f'"{key}"':
+            return HttpResponseNotModified()
+
+        def respond():
+            atlas, image = self.build_atlas(key, thumbnails)
+            return media_response(request, image, snapshotModels.IMAGE_FORMAT_MIME_TYPES[atlas['format']])
+
+        response = retry_evicted(respond)
+        response['ETag'] = f'"{key}"'
+        return response
+
     @action(methods=['post'], detail=False, permission_classes=[IsCamerafySession])
     def upload(self, request):
         """
-        Allows the Camerafy application to upload a snapshot for a specific user. This method will
-        automatically derive a thumbnail from the uploaded snapshot.
+        Allows the Camerafy application to upload a snapshot for a specific user. Format and 
+        dimensions are read from the image header, 'format', 'width' and 'height' are optional 
+        (except for RAW and TGA 1.0 images) and rejected if they do not match. With 'dedupe' set, a near-duplicate
+        of one of the user's snapshots is not stored and the existing snapshot is returned. A thumbnail is derived from the
+        uploaded snapshot in the background, its progress is reported via the snapshot's 
+        'thumbnail_status'.
         """
 
         missing_data = verify_request_data(request.data, [
             'userid',
-            'file', 
-            'width', 
-            'height',
-            'format'
+            'file'
         ])
 
         if len(missing_data):
@@ -95,52 +471,89 @@ class snapshots(
         
         try:
             user_id = request.data['userid']
-            snapshot = request.data['file']
-            title = f"snapshot-{int(time.time())}"
-            format = request.data['format']
-            width = request.data['width']
-            height = request.data['height']
 
             # retrieve snapshow author
             user = User.objects.get(id=user_id)
-            
-            # create downscaled thumbnail version of image
-            thumbnail_img = Image.open(snapshot).resize((160, 90))
-            in_memory_file = BytesIO()
-            thumbnail_img.save(in_memory_file, format)
-            in_memory_file.seek(0)
-            thumbnail_size = in_memory_file.getbuffer().nbytes
-            thumbnail_img = File(in_memory_file, f"{title}.{format}")
-
-            with transaction.atomic():
-                # create the thumbnail image
-                thumbnail = models.CamerafySnapshotThumbnail.objects.create(
-                    author=user,
-                    format=format,
-                    width=160,
-                    height=90,
-                    size=thumbnail_size,
-                    image=thumbnail_img
-                )
-
-                # rename save file for uploaded snapshot
-                snapshot.name = f"{title}.{format}"
-
-                snapshotObj = snapshotModels.CamerafySnapshot.objects.create(
-                    author=user,
-                    title=title,
-                    description=request.data['description'] if 'description' in request.data else '',
-                    image=snapshot,
-                    thumbnail=thumbnail,
-                    format=format,
-                    width=width,
-                    height=height,
-                    size=len(snapshot),
-                    seen=False
-                )
+
+            snapshotObj = snapshotModels.CamerafySnapshot.objects.create_snapshot(
+                author=user,
+                image=request.data['file'],
+                format=request.data.get('format'),
+                width=request.data.get('width'),
+                height=request.data.get('height'),
+                description=request.data['description'] if 'description' in request.data else '',
+                dedupe=str(request.data.get('dedupe', settings.CAMERAFY_DEDUPE_UPLOADS)).lower() in ('true', '1')
+            )
+        except User.DoesNotExist:
+            return Response({'error': f"User id '{user_id}' is unknown."}, status=400)
+        except snapshotModels.DuplicateSnapshot as e:
+            return Response({'result': {'id': e.snapshot.id, 'thumbnail_status': e.snapshot.thumbnail_status, 'duplicate': True}})
+        except snapshotModels.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=413)
+        except Exception as e:
+            return Response({'error': str(e)}, status=400)
+
+        return Response({'result': {'id': snapshotObj.id, 'thumbnail_status': snapshotObj.thumbnail_status}})
+
+    @action(methods=['post'], detail=False, permission_classes=[IsCamerafySession])
+    def upload_batch(self, request):
+        """
+        Allows the Camerafy application to upload a batch of snapshots for a specific user in a 
+        single multipart request. Images are sent as repeated 'file' fields, the optional 'format',
+        'width', 'height' and 'description' are either given once for all images or once per image.
+        Batches are never deduplicated, regardless of CAMERAFY_DEDUPE_UPLOADS, as all images are
+        stored with a single insert; 'dedupe' is rejected. The perceptual hashes are still computed
+        along with the thumbnails, so later uploads are deduplicated against the batch.
+        """
+
+        missing_data = verify_request_data(request.data, [
+            'userid',
+            'file'
+        ])
+
+        if len(missing_data):
+            return Response({'error': f"Missing required data field '{', '.join(missing_data)}'."}, status=400)
+
+        if str(request.data.get('dedupe', '')).lower() in ('true', '1'):
+            return Response({'error': "'dedupe' is not supported for batch uploads."}, status=400)
+
+        files = request.data.getlist('file')
+        images = [{'image': f} for f in files]
+        for field in ['format', 'width', 'height', 'description']:
+            values = request.data.getlist(field) if field in request.data else ['']
+            if len(values) == 1:
+                values = values * len(files)
+            if len(values) != len(files):
+                return Response({'error': f"Expected one '{field}' or one per file, got {len(values)} for {len(files)} files."}, status=400)
+            for image, value in zip(images, values):
+                image[field] = value
+
+        try:
+            user_id = request.data['userid']
+
+            # retrieve snapshow author
+            user = User.objects.get(id=user_id)
+
+            snapshotObjs = snapshotModels.CamerafySnapshot.objects.create_snapshots(user, images)
         except User.DoesNotExist:
             return Response({'error': f"User id '{user_id}' is unknown."}, status=400)
+        except snapshotModels.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=413)
         except Exception as e:
             return Response({'error': str(e)}, status=400)
 
-        return Response({'result': {'id': snapshotObj.id}})
+        return Response({'result': [{'id': s.id, 'title': s.title, 'thumbnail_status': s.thumbnail_status} for s in snapshotObjs]})
+
+    @action(methods=['get'], detail=False, permission_classes=[IsCamerafySession | IsCamerafyEditor])
+    def thumbnail_queue(self, request):
+        """
+        Returns queue depth and processing latency of the background thumbnail generation.
+        """
+        return Response({'result': thumbnail_pool.stats()})
+
+    @action(methods=['get'], detail=False, permission_classes=[IsCamerafySession | IsCamerafyEditor])
+    def thumbnail_cache(self, request):
+        """
+        Returns hit, miss and eviction counters of the in-memory cache of encoded thumbnails.
+        """
+        return Response({'result': thumbnail_cache.stats()})
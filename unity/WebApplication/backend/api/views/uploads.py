@@ -0,0 +1,187 @@
+import os
+import re
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import viewsets, mixins
+from rest_framework.response import Response
+from rest_framework.decorators import action
+
+from .common import verify_request_data
+
+from ..models import snapshots as snapshotModels
+from ..permissions import IsCamerafySession
+from ..uploads import upload_writer
+
+CONTENT_RANGE_HEADER_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+SHA256_RE = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+class snapshot_uploads(
+    mixins.DestroyModelMixin,
+    viewsets.GenericViewSet):
+    """
+    Resumable chunked snapshot upload endpoint. An upload is created first, then its data is sent in
+    byte ranges with PUT requests and finally turned into a snapshot with 'finalize'. The current
+    offset can be queried at any time to resume an interrupted upload.
+    """
+
+    permission_classes = [IsCamerafySession]
+
+    queryset = snapshotModels.CamerafySnapshotUpload.objects.all()
+
+    def _offset_response(self, upload, status=200):
+        response = Response({'result': {'id': upload.id, 'offset': upload.offset, 'size': upload.size}}, status=status)
+        response['Upload-Offset'] = str(upload.offset)
+        return response
+
+    def create(self, request, *args, **kwargs):
+
+        missing_data = verify_request_data(request.data, [
+            'userid'
+        ])
+
+        if len(missing_data):
+            return Response({'error': f"Missing required data field '{', '.join(missing_data)}'."}, status=400)
+
+        try:
+            user_id = request.data['userid']
+
+            # retrieve snapshot author
+            user = User.objects.get(id=user_id)
+
+            # reject uploads not fitting into the quota right away
+            if 'size' in request.data and not snapshotModels.CamerafySnapshotUserStats.objects.has_quota(user.id, int(request.data['size'])):
+                raise snapshotModels.QuotaExceeded(f"Storing {request.data['size']} more bytes would exceed the storage quota.")
+
+            upload = snapshotModels.CamerafySnapshotUpload.objects.create(
+                author=user,
+                description=request.data['description'] if 'description' in request.data else '',
+                format=request.data.get('format', '').upper(),
+                width=request.data.get('width') or None,
+                height=request.data.get('height') or None,
+                size=int(request.data['size']) if 'size' in request.data else None
+            )
+            upload_writer.create(upload)
+        except User.DoesNotExist:
+            return Response({'error': f"User id '{user_id}' is unknown."}, status=400)
+        except snapshotModels.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=413)
+        except Exception as e:
+            return Response({'error': str(e)}, status=400)
+
+        return self._offset_response(upload, status=201)
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Returns the number of bytes received so far.
+        """
+        return self._offset_response(self.get_object())
+
+    def update(self, request, *args, **kwargs):
+        """
+        Appends the raw request body to the upload. The position of the data has to be given by a
+        'Content-Range: bytes <start>-<end>/<total>' header and must match the current offset.
+        """
+        upload = self.get_object()
+
+        content_range = CONTENT_RANGE_HEADER_RE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if content_range is None:
+            return Response({'error': "Missing or invalid 'Content-Range' header."}, status=400)
+
+        start, end, total = content_range.groups()
+        start, end = int(start), int(end)
+        if end < start:
+            return Response({'error': "Invalid 'Content-Range' header."}, status=400)
+
+        if start != upload.offset:
+            response = Response({'error': f"Upload continues at offset {upload.offset}.", 'offset': upload.offset}, status=409)
+            response['Upload-Offset'] = str(upload.offset)
+            return response
+
+        if total != '*' and upload.size is None:
+            upload.size = int(total)
+
+        if upload.size is not None and end >= upload.size:
+            return Response({'error': f"Range exceeds the upload size of {upload.size} bytes."}, status=400)
+
+        chunk_path = upload_writer.receive(upload, request.stream, end - start + 1) if request.stream is not None else None
+        try:
+            received = os.path.getsize(chunk_path) if chunk_path is not None else 0
+            with transaction.atomic():
+                # advance the offset before writing, the updated row stays locked until the chunk has
+                # been appended, so a concurrent request for the same offset fails instead of
+                # interleaving its data
+                if not snapshotModels.CamerafySnapshotUpload.objects.filter(id=upload.id, offset=start).update(
+                        offset=start + received, size=upload.size, updated=timezone.now()):
+                    return Response({'error': "Upload has been modified concurrently."}, status=409)
+                if chunk_path is not None:
+                    upload_writer.append(upload, chunk_path)
+        finally:
+            if chunk_path is not None:
+                os.remove(chunk_path)
+
+        upload.offset = start + received
+        return self._offset_response(upload)
+
+    partial_update = update
+
+    def perform_destroy(self, instance):
+        """
+        Aborts the upload and removes the partially received data.
+        """
+        upload_writer.discard(instance.id)
+        instance.delete()
+
+    @action(methods=['post'], detail=True)
+    def finalize(self, request, *args, **kwargs):
+        """
+        Turns the completely received upload into a snapshot. If 'sha256' is given, the received
+        data is verified against it; on a mismatch the upload is removed and has to be started over.
+        The upload is claimed in the transaction creating the snapshot, so it fails with 409 if it
+        has been finalized concurrently or a chunk advanced its offset in the meantime. If the
+        snapshot cannot be created, e.g. because of the quota, the upload is kept unchanged.
+        """
+        upload = self.get_object()
+
+        if upload.size is not None and upload.offset != upload.size:
+            return Response({'error': f"Upload incomplete, received {upload.offset} of {upload.size} bytes."}, status=400)
+
+        sha256 = request.data.get('sha256')
+        if sha256 is not None and not (isinstance(sha256, str) and SHA256_RE.match(sha256)):
+            return Response({'error': "'sha256' must be a hex encoded SHA-256 digest."}, status=400)
+
+        upload_id = upload.id
+        try:
+            with transaction.atomic():
+                # claim the upload, nothing is deleted if another request finalized it or appended a
+                # chunk since it has been read, the row stays locked until the snapshot is created
+                claimed, _ = snapshotModels.CamerafySnapshotUpload.objects.filter(id=upload_id, offset=upload.offset).delete()
+                if not claimed:
+                    return Response({'error': "Upload has been finalized or modified concurrently."}, status=409)
+
+                image = upload_writer.finalize(upload)
+                if sha256 is not None and sha256.lower() != image.content_hash:
+                    snapshot = None
+                else:
+                    snapshot = snapshotModels.CamerafySnapshot.objects.create_snapshot(
+                        author=upload.author,
+                        image=image,
+                        format=upload.format,
+                        width=upload.width,
+                        height=upload.height,
+                        description=upload.description
+                    )
+        except snapshotModels.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=413)
+        except Exception as e:
+            return Response({'error': str(e)}, status=400)
+
+        # remove what is left if the storage did not take over the received file
+        upload_writer.discard(upload_id)
+
+        if snapshot is None:
+            return Response({'error': "Checksum mismatch, received data does not match 'sha256'. The upload has been removed."}, status=400)
+
+        return Response({'result': {'id': snapshot.id, 'thumbnail_status': snapshot.thumbnail_status}})
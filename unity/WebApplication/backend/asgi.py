@@ -0,0 +1,21 @@
+"""
+ASGI config for backend project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. The snapshot event
+stream is served natively, see backend.api.asgi.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+application = get_asgi_application()
+
+from .api.asgi import EventStreamMiddleware  # noqa: E402, needs the configured django
+
+application = EventStreamMiddleware(application)
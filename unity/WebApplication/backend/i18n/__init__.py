@@ -0,0 +1 @@
+default_app_config = 'backend.i18n.apps.I18NConfig'
@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class I18NConfig(AppConfig):
-    name = 'i18n'
+    name = 'backend.i18n'
+
+    def ready(self):
+        # connect the signal receivers invalidating the cached translation bundles
+        from . import signals  # noqa: F401
@@ -0,0 +1,86 @@
+"""
+Compiled translation bundles served by the translations list endpoint. The bundle of a language
+holds every translation key with its translation in that language, both flat and nested by the
+key's segments. It is built with a single joined query and kept in the cache until a language,
+translation key or translation is saved or deleted (see signals). Bulk updates bypass the signals
+and require calling invalidate() explicitly. The cache has to be shared by all backend processes
+(see CACHES), otherwise invalidation only reaches the process which changed the translations.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import FilteredRelation, Q
+
+from . import models
+
+LANGUAGES_CACHE_KEY = 'i18n-languages'
+
+
+def bundle_cache_key(lan_code):
+    return f"i18n-translations:{lan_code}"
+
+
+def supported_languages():
+    """
+    Returns a dict mapping the codes of all languages to their ids.
+    """
+    languages = cache.get(LANGUAGES_CACHE_KEY)
+    if languages is None:
+        languages = dict(models.Language.objects.values_list('lan_code', 'id'))
+        cache.set(LANGUAGES_CACHE_KEY, languages, settings.CAMERAFY_TRANSLATION_CACHE_TIMEOUT)
+    return languages
+
+
+def insert_translation_key(key, translation, nested):
+    """
+    Inserts the translation (a dict with id, revision and value) of a translation key into a
+    nested dict, creating a level for every dot separated segment of the key.
+    """
+    it = nested
+    for segment in key.split('.'):
+        # create key path if it does not exist
+        it = it.setdefault(segment, {})
+    it.update(translation)
+
+
+def build_bundle(language_id):
+    """
+    Returns the bundle {'flat': ..., 'nested': ...} of a language. Keys without translation get
+    an empty translation with id -1.
+    """
+    rows = models.TranslationKey.objects.annotate(
+        language_translation=FilteredRelation('translation', condition=Q(translation__language=language_id))
+    ).order_by('id', 'language_translation__id').values_list(
+        'key', 'language_translation__id', 'language_translation__revision', 'language_translation__translation')
+
+    flat = {}
+    nested = {}
+    for key, id, revision, translation in rows:
+        # a key may have been translated more than once, the first translation wins
+        if key in flat:
+            continue
+        if id is None:
+            id, revision, translation = -1, 0, ""
+        flat[key] = {'id': id, 'revision': revision, 'translation': translation}
+        insert_translation_key(key, {'id': id, 'revision': revision, 'value': translation}, nested)
+
+    return {'flat': flat, 'nested': nested}
+
+
+def get_bundle(lan_code, language_id):
+    """
+    Returns the cached bundle of a language, building it if necessary.
+    """
+    bundle = cache.get(bundle_cache_key(lan_code))
+    if bundle is None:
+        bundle = build_bundle(language_id)
+        cache.set(bundle_cache_key(lan_code), bundle, settings.CAMERAFY_TRANSLATION_CACHE_TIMEOUT)
+    return bundle
+
+
+def invalidate():
+    """
+    Drops the cached bundles of all languages and the cached languages.
+    """
+    # languages may have been renamed since they were cached
+    lan_codes = set(models.Language.objects.values_list('lan_code', flat=True)) | set(cache.get(LANGUAGES_CACHE_KEY) or ())
+    cache.delete_many([LANGUAGES_CACHE_KEY] + [bundle_cache_key(lan_code) for lan_code in lan_codes])
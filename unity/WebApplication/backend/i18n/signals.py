@@ -0,0 +1,16 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import bundles, models
+
+
+@receiver([post_save, post_delete], sender=models.Translation)
+@receiver([post_save, post_delete], sender=models.TranslationKey)
+@receiver([post_save, post_delete], sender=models.Language)
+def translations_changed(sender, instance, **kwargs):
+    """
+    Drops all cached translation bundles, a translation may have been moved to another language.
+    """
+    # invalidating before the commit would let concurrent requests cache the old translations again
+    transaction.on_commit(bundles.invalidate)
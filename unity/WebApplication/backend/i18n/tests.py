@@ -1,3 +1,49 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.db import connection
+from django.test import TransactionTestCase
 
-# Create your tests here.
+from . import bundles, models
+
+
+class BundleTests(TransactionTestCase):
+
+    def setUp(self):
+        # the tables are not created by the initial migration, which replaces itself
+        with connection.schema_editor() as editor:
+            for model in (models.TranslationKey, models.Language, models.Translation):
+                editor.create_model(model)
+        self.addCleanup(self.drop_tables)
+        caches['default'].clear()
+
+        self.language = models.Language.objects.create(lan_code='de-DE', lan_name='German', reg_code='DE', reg_name='Germany')
+        self.key = models.TranslationKey.objects.create(key='menu.open')
+        self.translation = models.Translation.objects.create(
+            translation_key=self.key, language=self.language, translation='Öffnen', revision=1)
+
+    def drop_tables(self):
+        with connection.schema_editor() as editor:
+            for model in (models.Translation, models.Language, models.TranslationKey):
+                editor.delete_model(model)
+
+    def test_bundle(self):
+        bundle = bundles.get_bundle('de-DE', self.language.id)
+        self.assertEqual(bundle['flat'], {'menu.open': {'id': self.translation.id, 'revision': 1, 'translation': 'Öffnen'}})
+        self.assertEqual(bundle['nested'], {'menu': {'open': {'id': self.translation.id, 'revision': 1, 'value': 'Öffnen'}}})
+
+    def test_invalidation_reaches_other_processes(self):
+        self.assertEqual(bundles.supported_languages(), {'de-DE': self.language.id})
+        bundles.get_bundle('de-DE', self.language.id)
+
+        # a cache connection of another process
+        other = DatabaseCache(settings.CACHES['default']['LOCATION'], {})
+        self.assertIsNotNone(other.get(bundles.bundle_cache_key('de-DE')))
+
+        # saving commits right away, so the signal invalidates the bundles
+        self.translation.translation = 'Öffne'
+        self.translation.save()
+
+        self.assertIsNone(other.get(bundles.bundle_cache_key('de-DE')))
+        self.assertIsNone(other.get(bundles.LANGUAGES_CACHE_KEY))
+        self.assertEqual(bundles.get_bundle('de-DE', self.language.id)['flat']['menu.open']['translation'], 'Öffne')
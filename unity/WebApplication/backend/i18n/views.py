@@ -4,6 +4,7 @@ from rest_framework import viewsets, mixins, permissions, authentication
 from rest_framework.response import Response
 from rest_framework.decorators import action, permission_classes
 
+from . import bundles
 from . import models
 from . import serializers
 
@@ -99,35 +100,17 @@ class translations(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
     def list(self, request, *args, **kwargs):
-
-        def insert_translation_key(key_str, translation_obj, _dict):
-            # split key into its elements
-            key_elems = key_str.split('.')
-            num_elems = len(key_elems)
-
-            it = _dict
-            for key in key_elems:
-                # create key path if it does not exist
-                if key not in it:
-                    it[key] = {}
-                it = it[key]
-
-            if translation_obj is not None:
-                it['id'] = translation_obj.id
-                it['revision'] = translation_obj.revision
-                it['value'] = translation_obj.translation
-            else:
-                it['id'] = -1
-                it['revision'] = 0
-                it['value'] = ""
-            
+        """
+        Returns the translations of all translation keys in the requested languages, nested by the
+        key segments or flat. The bundles are cached per language, see bundles.
+        """
         response_data = {}
 
         # get language
         languages = request.query_params['language'] if 'language' in request.query_params else request.data['language'] if 'language' in request.data else None
-        supported_languages = models.Language.objects.values_list('lan_code', flat=True)
+        supported_languages = bundles.supported_languages()
         if languages is None:
-            return Response({'error': "'language' identifier required. Please provide 'language' as url query param '?language=<language>[,<language>]' or as form data '--form language=<language>[,<language>]', where <language> is ISO 639 language tag (e.g. 'de-DE'). Multiple language can be queries by separating them with comma.", 'supported': supported_languages}, 404)
+            return Response({'error': "'language' identifier required. Please provide 'language' as url query param '?language=<language>[,<language>]' or as form data '--form language=<language>[,<language>]', where <language> is ISO 639 language tag (e.g. 'de-DE'). Multiple language can be queries by separating them with comma.", 'supported': list(supported_languages)}, 404)
 
         # should return result as flat structure
         flat = bool(request.query_params['flat']) if 'flat' in request.query_params else bool(request.data['flat']) if 'flat' in request.data else False
@@ -140,24 +123,7 @@ class translations(viewsets.ModelViewSet):
                 response_data[language] = "Not supoprted."
                 continue
 
-            # read all translation keys
-            TKeys = models.TranslationKey.objects.values_list('id', 'key')
-            # read all translations for keys in given language
-            Trans = models.Translation.objects.filter(translation_key__in=[tk[0] for tk in list(TKeys)], language=models.Language.objects.filter(lan_code=language).first().id)
-            
-            # build translation json
-            if flat:
-                response_data[language] = {}
-                for tkey in TKeys:
-                    trans = Trans.filter(translation_key=tkey[0])
-                    if trans.count():
-                        trans = trans.first()
-                        response_data[language][tkey[1]] = {'id': trans.id, 'revision': trans.revision, 'translation': trans.translation}
-                    else:
-                        response_data[language][tkey[1]] = {'id': -1, 'revision': 0, 'translation': ""}
-
-            else:
-                [insert_translation_key(f"{language}.{tkey[1]}", Trans.filter(translation_key=tkey[0]).first() if Trans.filter(translation_key=tkey[0]).count() else None, response_data) for tkey in TKeys]
+            bundle = bundles.get_bundle(language, supported_languages[language])
+            response_data[language] = bundle['flat'] if flat else bundle['nested']
 
         return Response(response_data, status=200)
-        
\ No newline at end of file
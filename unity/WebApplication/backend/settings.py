@@ -25,6 +25,8 @@ with open(os.path.join(BASE_DIR, '../Config/AppConfig.json'), 'r') as f:
 
 # files upload location
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# location of partially received chunked uploads
+CAMERAFY_UPLOAD_DIR = os.path.join(MEDIA_ROOT, 'uploads')
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.2/howto/static-files/
@@ -116,6 +118,15 @@ DATABASES = {
     }
 }
 
+# cache shared by all backend processes through the database, so invalidating e.g. the translation
+# bundles reaches every process, the table is created by 'manage.py createcachetable'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'camerafy_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -169,4 +180,117 @@ REST_FRAMEWORK = {
 }
 
 CORS_ALLOW_CREDENTIALS = True
-CORS_ORIGIN_ALLOW_ALL = True
\ No newline at end of file
+CORS_ORIGIN_ALLOW_ALL = True
+
+# Optionally hand over binary media downloads to the front web server after all permission
+# checks passed. Supported values are None, 'x-sendfile' (Apache/lighttpd) and 'x-accel-redirect' (nginx).
+CAMERAFY_MEDIA_SENDFILE = None
+# internal location the front web server maps to MEDIA_ROOT when using 'x-accel-redirect'
+CAMERAFY_MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# maximum width and height of uploaded snapshots
+CAMERAFY_MAX_IMAGE_SIZE = 16384
+# storage quota in bytes of users without an individual quota, None for unlimited storage
+CAMERAFY_DEFAULT_QUOTA = None
+
+# number of worker processes generating snapshot thumbnails off-request
+CAMERAFY_THUMBNAIL_WORKERS = 2
+# widths of the generated snapshot thumbnails, heights are derived from the snapshot's aspect ratio
+CAMERAFY_THUMBNAIL_WIDTHS = [160, 320, 640]
+
+# number of thumbnail columns in the snapshot gallery atlas
+CAMERAFY_ATLAS_COLUMNS = 10
+# image format of the snapshot gallery atlas
+CAMERAFY_ATLAS_FORMAT = 'JPG'
+# directory of the cache of built atlas images
+CAMERAFY_ATLAS_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'atlas')
+# maximum number of bytes of built atlas images kept on disk
+CAMERAFY_ATLAS_CACHE_BYTES = 256 * 1024 * 1024
+
+# maximum number of bytes of base64 encoded thumbnails kept in memory
+CAMERAFY_THUMBNAIL_CACHE_BYTES = 32 * 1024 * 1024
+
+# snapshots older than this number of days are moved into the cold tier by 'tier_snapshots'
+CAMERAFY_TIER_AFTER_DAYS = 90
+# codec of the cold tier, one of 'png' (optimized PNG), 'webp' (lossless WebP) or 'zstd'
+CAMERAFY_TIER_CODEC = 'webp'
+# directory of the cache of cold snapshots restored to their upload format
+CAMERAFY_HOT_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'hot')
+# maximum number of bytes of restored cold snapshots kept on disk
+CAMERAFY_HOT_CACHE_BYTES = 512 * 1024 * 1024
+
+# directory of the cache of snapshots transcoded into the format negotiated with the client
+CAMERAFY_VARIANT_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'variants')
+# maximum number of bytes of transcoded snapshots kept on disk
+CAMERAFY_VARIANT_CACHE_BYTES = 512 * 1024 * 1024
+# quality of transcoded snapshots in lossy formats (JPG, WEBP)
+CAMERAFY_VARIANT_QUALITY = 90
+
+# tone mapping of HDR snapshots (EXR) for thumbnails and transcoded variants, the operator is one
+# of 'aces', 'reinhard' or 'clamp', the exposure is given in stops
+CAMERAFY_HDR_TONE_MAP = {
+    'operator': 'aces',
+    'exposure': 0.0,
+    'gamma': 2.2,
+}
+
+# maximum number of differing bits of the perceptual hashes of two snapshots considered duplicates
+CAMERAFY_DUPLICATE_DISTANCE = 6
+# reject uploads of near-duplicates of a user's existing snapshots unless the upload asks otherwise,
+# batch uploads are never deduplicated
+CAMERAFY_DEDUPE_UPLOADS = False
+# seconds the packed perceptual hashes of a user's snapshots are kept in the cache for near-duplicate
+# searches, changes invalidate them right away
+CAMERAFY_SIMILARITY_CACHE_TIMEOUT = 60 * 60
+
+# location of the signed media URLs, see backend.api.signing
+CAMERAFY_SIGNED_MEDIA_URL = '/api/media/'
+# key media URLs are signed with, shared with front web servers or CDNs verifying them; derived
+# from SECRET_KEY if None
+CAMERAFY_MEDIA_SIGNING_KEY = None
+# minimum number of seconds a signed media URL is valid
+CAMERAFY_SIGNED_URL_TTL = 15 * 60
+# expiry timestamps are rounded up to multiples of this number of seconds, so URLs stay cacheable
+CAMERAFY_SIGNED_URL_GRANULARITY = 5 * 60
+
+# event layer pushing snapshot changes to clients, 'memory' for a single server process or
+# 'database' for several processes sharing the events through the database
+CAMERAFY_EVENT_LAYER = 'memory'
+# number of seconds between keep-alive comments sent to idle event streams
+CAMERAFY_EVENT_HEARTBEAT = 15
+# number of seconds between two polls of the database event layer
+CAMERAFY_EVENT_POLL_INTERVAL = 1.0
+# number of seconds the database event layer keeps events to replay them to reconnecting clients
+CAMERAFY_EVENT_RETENTION = 60 * 60
+# number of seconds an event stream token is valid for connecting, streams outlive their token
+CAMERAFY_STREAM_TOKEN_TTL = 60
+
+# storage of all media files, 'django.core.files.storage.FileSystemStorage' keeps them below
+# MEDIA_ROOT, 'backend.api.storage.S3Storage' in the bucket configured by CAMERAFY_S3_STORAGE, which
+# allows running several backend nodes sharing the media (requires boto3)
+DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+# bucket of the S3 storage, endpoint_url selects S3 compatible stores (e.g. MinIO); files larger
+# than multipart_threshold bytes are transferred in parts of multipart_chunk_size bytes by
+# max_workers threads, all requests share a pool of max_connections connections
+CAMERAFY_S3_STORAGE = {
+    'bucket': 'camerafy-media',
+    'location': '',
+    'endpoint_url': None,
+    'region_name': None,
+    'access_key': None,
+    'secret_key': None,
+    'multipart_threshold': 16 * 1024 * 1024,
+    'multipart_chunk_size': 8 * 1024 * 1024,
+    'max_workers': 8,
+    'max_connections': 32,
+}
+# directory of the local copies of media files of remote storages, e.g. for creating thumbnails
+CAMERAFY_MEDIA_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'media')
+# maximum number of bytes of local copies of media files kept on disk
+CAMERAFY_MEDIA_CACHE_BYTES = 1024 * 1024 * 1024
+# seconds compiled translation bundles are kept in the cache, changes invalidate them right away,
+# see backend.i18n.bundles
+CAMERAFY_TRANSLATION_CACHE_TIMEOUT = 60 * 60
+# seconds after the last received data an unfinished chunked upload expires and is removed by the
+# expire_snapshot_uploads command
+CAMERAFY_UPLOAD_EXPIRY = 24 * 60 * 60
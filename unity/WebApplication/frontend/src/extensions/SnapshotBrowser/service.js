@@ -2,14 +2,60 @@ import backend from '../../services/backend'
 
 class SnapshotService
 {
+    // lists all snapshots page by page, the thumbnails of each page are loaded as a single atlas
+    // image; each snapshot's 'preview' holds the atlas image url and its thumbnail's box in it
     async list()
     {
-        return await backend.get('api/snapshots/');
+        var next = 'api/snapshots/';
+        var snapshots = [];
+        while(next != null)
+        {
+            const response = await backend.get(next);
+            if(response === null)
+                return null;
+            // the atlas of a page is requested with the same query parameters as the page
+            const previews = await this.previews(next.includes('?') ? next.substring(next.indexOf('?')) : '');
+            snapshots = snapshots.concat(response.results.map(snapshot => ({...snapshot, preview: previews[snapshot.id] || null})));
+            // 'next' is an absolute url
+            next = response.next !== null ? response.next.replace(`${backend.backendUrl}/`, '') : null;
+        }
+
+        return snapshots;
+    }
+
+    // returns the previews of the snapshots of a page by id
+    async previews(query)
+    {
+        const response = await backend.get(`api/snapshots/atlas/${query}`);
+        if(response === null || response.result === undefined || response.result.entries.length === 0)
+            return {};
+
+        const url = await backend.image(`api/snapshots/atlas/image/${query}`);
+        if(url === null)
+            return {};
+
+        const atlas = response.result;
+        const previews = {};
+        for(const entry of atlas.entries)
+            previews[entry.id] = { url: url, atlasWidth: atlas.width, atlasHeight: atlas.height, x: entry.x, y: entry.y, width: entry.width, height: entry.height };
+        return previews;
     }
 
+    // retrieves a single snapshot, its preview is its smallest thumbnail instead of an atlas
     async retrieve(id) 
     {
-        return await backend.get(`api/snapshots/${id}/`);
+        const snapshot = await backend.get(`api/snapshots/${id}/`);
+        if(snapshot === null || snapshot.id === undefined)
+            return snapshot;
+
+        const url = snapshot.thumbnail_status === 'ready' ? await backend.image(`api/snapshots/${id}/thumbnail/`) : null;
+        return {...snapshot, preview: url !== null ? { url: url } : null};
+    }
+
+    async unseen()
+    {
+        const response = await backend.get('api/snapshots/unseen/');
+        return response !== null ? response.result.unseen : 0;
     }
 
     async download(id) 
@@ -21,6 +67,53 @@ class SnapshotService
     {
         return await backend.delete(`api/snapshots/${id}/`);
     }
+
+    // subscribes to the snapshot events of the logged in user, handlers maps event types
+    // ('snapshot.created', 'snapshot.updated', 'snapshot.deleted', 'snapshot.seen', 'resync') to
+    // functions receiving the event data; the returned stream reconnects by itself until closed
+    events(handlers)
+    {
+        const stream = { source: null, lastEventId: null, timer: null, closed: false };
+        const reconnect = () => { stream.timer = setTimeout(connect, 5000); };
+        const connect = async () =>
+        {
+            // EventSource cannot send headers, so it authenticates with a short-lived stream token
+            // instead of passing the user's token as query parameter
+            const response = await backend.post('api/snapshots/stream_token/', {});
+            if(stream.closed)
+                return;
+            if(response === null || response.result === undefined)
+                return reconnect();
+
+            const params = new URLSearchParams({ token: response.result.token });
+            if(stream.lastEventId !== null)
+                params.set('last_event_id', stream.lastEventId);
+            const source = new EventSource(`${backend.backendUrl}/api/snapshots/events/?${params}`);
+            for(const type in handlers)
+                source.addEventListener(type, event => {
+                    if(event.lastEventId)
+                        stream.lastEventId = event.lastEventId;
+                    handlers[type](JSON.parse(event.data));
+                });
+            // the browser retries with the same url by itself, which fails once the token expired
+            source.onerror = () => {
+                if(source.readyState === EventSource.CLOSED)
+                    reconnect();
+            };
+            stream.source = source;
+        };
+
+        connect();
+        return {
+            close: () =>
+            {
+                stream.closed = true;
+                clearTimeout(stream.timer);
+                if(stream.source !== null)
+                    stream.source.close();
+            }
+        };
+    }
 }
 
 export default new SnapshotService();
\ No newline at end of file
@@ -39,6 +39,31 @@ class backend
         }
     }
 
+    // fetches an image, e.g. a thumbnail atlas, and returns an object url to show it with, which
+    // has to be released with URL.revokeObjectURL() once it is no longer shown
+    async image(endpoint)
+    {
+        try
+        {
+            const response = await fetch(`${this.backendUrl}/${endpoint}`, {
+                method: 'GET',
+                mode: 'cors',
+                headers: {
+                    'Authorization': CamerafyUser.token !== null ? `Token ${CamerafyUser.token}` : ""
+                },
+            });
+            if(!response.ok)
+                return null;
+
+            return URL.createObjectURL(await response.blob());
+        }
+        catch(err)
+        {
+            console.log(err);
+            return null;
+        }
+    }
+
     async get(endpoint) { return await this.send('GET', endpoint, null); }
     async post(endpoint, data) { return await this.send('POST', endpoint, data); }
     async put(endpoint, data) { return await this.send('PUT', endpoint, data); }
@@ -9,6 +9,9 @@ pushd frontend & npm install & popd
 :: apply initial migrations
 python manage.py migrate
 
+:: create the table of the shared cache
+python manage.py createcachetable
+
 :: install default langauges
 python manage.py loaddata backend/i18n/default_languages.json
 :: install default camerafy permission groups